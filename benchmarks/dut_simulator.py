@@ -0,0 +1,422 @@
+"""
+Local Device Under Test (DUT) simulator. It replaces the three external parts that a Machine talks to:
+- the libLogHelper UDP traffic (ECC byte + #HEADER/#BEGIN/#IT/#SDC/#ERR/#END messages)
+- the telnet server of the board
+- the Lindy IP power switch
+Everything runs on the loopback, so the server can be exercised without any board.
+"""
+import http.server
+import multiprocessing
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+# ECC status byte sent by libLogHelper as the first byte of each message
+ECC_DISABLED = 0xD
+ECC_ENABLED = 0xE
+
+_TELNET_PROMPT = b"$ "
+# Machine calls read_very_eager right after sending the username,
+# a real board takes a while to answer, without this delay the password prompt would be consumed
+_TELNET_PROMPT_DELAY = 0.1
+_OS_REBOOT_CMD = b"/sbin/reboot"
+
+
+class DUTTrafficSender(threading.Thread):
+    """ Send libLogHelper-like messages to the server at a configurable rate.
+    Each iteration produces one #IT message, every sdc_interval iterations an #SDC is sent
+    followed by errors_per_sdc #ERR lines
+    """
+
+    def __init__(self, server_address: tuple, iterations_per_second: float = 10.0, sdc_interval: int = 0,
+                 errors_per_sdc: int = 0, max_iterations: int = None, ecc_status: int = ECC_DISABLED,
+                 header: str = "simulated benchmark", duplicate_interval: int = 0, sequence_numbers: bool = False,
+                 swap_interval: int = 0):
+        """
+        :param server_address: (ip, port) where the Machine receives the messages
+        :param iterations_per_second: iteration rate, 0 sends as fast as possible
+        :param sdc_interval: send an SDC every sdc_interval iterations, 0 never sends SDCs
+        :param errors_per_sdc: number of #ERR lines after each #SDC
+        :param max_iterations: stop (and send #END) after max_iterations, None runs until stop()
+        :param ecc_status: ECC_DISABLED or ECC_ENABLED
+        :param header: content of the #HEADER message
+        :param duplicate_interval: send every duplicate_interval-th message twice (a retransmission), 0 never
+        :param sequence_numbers: add the #SEQ:<n> prefix to the messages
+        :param swap_interval: send every swap_interval-th message after the next one (out of order), 0 never
+        """
+        super(DUTTrafficSender, self).__init__(daemon=True)
+        self.__server_address = server_address
+        self.__interval = 1.0 / iterations_per_second if iterations_per_second else 0.0
+        self.__sdc_interval = sdc_interval
+        self.__errors_per_sdc = errors_per_sdc
+        self.__max_iterations = max_iterations
+        self.__ecc_byte = bytes([ecc_status])
+        self.__header = header
+        self.__duplicate_interval = duplicate_interval
+        self.__sequence_numbers = sequence_numbers
+        self.__swap_interval = swap_interval
+        self.__sequence = 0
+        self.__swapped_data = None
+        self.__stop_event = threading.Event()
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sent_messages = 0
+        self.sent_bytes = 0
+
+    def __send(self, message: str) -> None:
+        if self.__sequence_numbers:
+            message = f"#SEQ:{self.__sequence} {message}"
+        self.__sequence += 1
+        data = self.__ecc_byte + message.encode("ascii")
+        self.sent_messages += 1
+        self.sent_bytes += len(data)
+        if self.__swap_interval and self.__sequence % self.__swap_interval == 0:
+            self.__swapped_data = data
+            return
+        self.__socket.sendto(data, self.__server_address)
+        if self.__duplicate_interval and self.__sequence % self.__duplicate_interval == 0:
+            self.__socket.sendto(data, self.__server_address)
+        if self.__swapped_data is not None:
+            self.__socket.sendto(self.__swapped_data, self.__server_address)
+            self.__swapped_data = None
+
+    def run(self) -> None:
+        self.__send(f"#HEADER {self.__header}")
+        self.__send("#BEGIN")
+        iteration = 0
+        acc_time, acc_errors = 0.0, 0
+        next_iteration_time = time.monotonic()
+        while self.__stop_event.is_set() is False:
+            if self.__max_iterations is not None and iteration >= self.__max_iterations:
+                self.__send("#END")
+                break
+            kernel_time = self.__interval
+            acc_time += kernel_time
+            if self.__sdc_interval and iteration % self.__sdc_interval == self.__sdc_interval - 1:
+                acc_errors += max(self.__errors_per_sdc, 1)
+                self.__send(f"#SDC Ite:{iteration} KerTime:{kernel_time:.6f} AccTime:{acc_time:.6f} "
+                            f"KerErr:{self.__errors_per_sdc} AccErr:{acc_errors}")
+                for error_i in range(self.__errors_per_sdc):
+                    self.__send(f"#ERR Ite:{iteration} pos:[{error_i}] expected:1.000000 read:0.999999")
+            self.__send(f"#IT Ite:{iteration} KerTime:{kernel_time:.6f} AccTime:{acc_time:.6f}")
+            iteration += 1
+            if self.__interval:
+                next_iteration_time += self.__interval
+                self.__stop_event.wait(max(next_iteration_time - time.monotonic(), 0))
+        self.__socket.close()
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+
+
+def _traffic_process_main(stop_event, counters, sender_parameters: dict) -> None:
+    sender = DUTTrafficSender(**sender_parameters)
+    sender.start()
+    while stop_event.wait(0.1) is False and sender.is_alive():
+        pass
+    sender.stop()
+    sender.join()
+    counters[0], counters[1] = sender.sent_messages, sender.sent_bytes
+
+
+class DUTTrafficProcess:
+    """ DUTTrafficSender running on a separate process, so the traffic generation
+    does not compete for the GIL with the server being measured
+    """
+
+    def __init__(self, **sender_parameters):
+        self.__stop_event = multiprocessing.Event()
+        self.__counters = multiprocessing.Array("q", 2)
+        self.__process = multiprocessing.Process(target=_traffic_process_main, daemon=True,
+                                                 args=(self.__stop_event, self.__counters, sender_parameters))
+
+    def start(self) -> None:
+        self.__process.start()
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+
+    def join(self) -> None:
+        self.__process.join()
+
+    @property
+    def sent_messages(self) -> int:
+        return self.__counters[0]
+
+    @property
+    def sent_bytes(self) -> int:
+        return self.__counters[1]
+
+
+class FakeTelnetServer(threading.Thread):
+    """ Minimal telnet server that follows the login sequence expected by Machine.__telnet_login.
+    When disabled the listening socket is closed, so the client gets a connection refused, like a DUT that is booting
+    """
+
+    def __init__(self, ip: str, port: int, on_command=None):
+        """
+        :param ip: IP to listen
+        :param port: telnet port
+        :param on_command: callable(bytes) called for each command line received after the login,
+            the bytes it returns are sent as the command output
+        """
+        super(FakeTelnetServer, self).__init__(daemon=True)
+        self.__address = (ip, port)
+        self.__on_command = on_command
+        self.__server_socket = None
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.received_commands = list()
+
+    def enable(self) -> None:
+        with self.__lock:
+            if self.__server_socket is None:
+                self.__server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.__server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.__server_socket.bind(self.__address)
+                self.__server_socket.listen()
+                self.__server_socket.settimeout(0.1)
+
+    def disable(self) -> None:
+        with self.__lock:
+            if self.__server_socket is not None:
+                self.__server_socket.close()
+                self.__server_socket = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.__server_socket is not None
+
+    def run(self) -> None:
+        while self.__stop_event.is_set() is False:
+            with self.__lock:
+                server_socket = self.__server_socket
+            if server_socket is None:
+                self.__stop_event.wait(0.05)
+                continue
+            try:
+                connection, _ = server_socket.accept()
+            except (socket.timeout, OSError):
+                continue
+            threading.Thread(target=self.__session, args=(connection,), daemon=True).start()
+        self.disable()
+
+    def __session(self, connection: socket.socket) -> None:
+        with connection, connection.makefile("rb") as reader:
+            try:
+                connection.sendall(b"login: ")
+                reader.readline()
+                time.sleep(_TELNET_PROMPT_DELAY)
+                connection.sendall(b"Password: ")
+                reader.readline()
+                connection.sendall(_TELNET_PROMPT)
+                for line in reader:
+                    command = line.strip()
+                    if command:
+                        self.received_commands.append(command)
+                        if self.__on_command:
+                            output = self.__on_command(command)
+                            if output:
+                                connection.sendall(output)
+                    connection.sendall(_TELNET_PROMPT)
+            except OSError:
+                pass
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+
+
+class _PowerSwitchRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        led = urllib.parse.parse_qs(url.query).get("led", [""])[0]
+        # Consume the body, if any
+        self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+        if url.path not in ("/ons.cgi", "/offs.cgi") or "1" not in led:
+            self.send_error(404)
+            return
+        self.server.switch_outlet(outlet=led.index("1") + 1, status_on=url.path == "/ons.cgi")
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class FakePowerSwitch(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Lindy IP power switch simulator. In the machine yaml use
+    power_switch_model: lindy and power_switch_ip: <ip>:<port>
+    """
+    daemon_threads = True
+
+    def __init__(self, ip: str = "127.0.0.1", port: int = 0):
+        super(FakePowerSwitch, self).__init__((ip, port), _PowerSwitchRequestHandler)
+        self.__outlet_callbacks = dict()
+        self.outlet_status = dict()
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def switch_ip(self) -> str:
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+    def attach(self, outlet: int, callback) -> None:
+        """ Call callback(status_on: bool) when the outlet changes """
+        self.__outlet_callbacks[outlet] = callback
+
+    def switch_outlet(self, outlet: int, status_on: bool) -> None:
+        self.outlet_status[outlet] = status_on
+        if outlet in self.__outlet_callbacks:
+            self.__outlet_callbacks[outlet](status_on)
+
+    def start(self) -> None:
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class SimulatedDUT:
+    """ A board made of a fake telnet server and a traffic sender, powered by a FakePowerSwitch outlet.
+    The exec command sent through telnet starts the traffic, the kill command stops it.
+    """
+
+    def __init__(self, hostname: str, server_address: tuple, telnet_port: int, power_switch: FakePowerSwitch,
+                 outlet: int, boot_time: float = 0.5, ip: str = "127.0.0.1", traffic_process: bool = False,
+                 app_auto_start_time: float = None, **traffic_parameters):
+        """
+        :param hostname: DUT hostname
+        :param server_address: (ip, port) where the Machine receives the messages
+        :param telnet_port: port of the fake telnet server
+        :param power_switch: switch that powers this DUT
+        :param outlet: outlet of the switch
+        :param boot_time: seconds between the power ON and telnet being available
+        :param ip: IP of the DUT
+        :param traffic_process: generate the traffic on a separate process (DUTTrafficProcess)
+        :param app_auto_start_time: if set, the app starts by itself this many seconds after the boot starts
+        :param traffic_parameters: parameters passed to DUTTrafficSender
+        """
+        self.hostname = hostname
+        self.ip = ip
+        self.telnet_port = telnet_port
+        self.server_address = server_address
+        self.outlet = outlet
+        self.__boot_time = boot_time
+        self.__app_auto_start_time = app_auto_start_time
+        self.__traffic_parameters = traffic_parameters
+        self.__sender_class = DUTTrafficProcess if traffic_process else DUTTrafficSender
+        self.__lock = threading.Lock()
+        self.__sender = None
+        self.__boot_timer = None
+        self.__app_auto_start_timer = None
+        # Number of exec commands that will be ignored (the app crashes right after starting)
+        self.__crashing_starts = 0
+        self.__power_switch = power_switch
+        self.__telnet = FakeTelnetServer(ip=ip, port=telnet_port, on_command=self.__on_command)
+        power_switch.attach(outlet=outlet, callback=self.__on_power)
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        # time.monotonic of each time the app (traffic) was started
+        self.app_start_times = list()
+
+    def start(self) -> None:
+        self.__telnet.start()
+
+    def stop(self) -> None:
+        self.__cancel_boot()
+        self.__stop_traffic()
+        self.__telnet.stop()
+
+    def __on_power(self, status_on: bool) -> None:
+        if status_on:
+            self.__schedule_boot()
+        else:
+            self.__shutdown()
+
+    def __schedule_boot(self) -> None:
+        self.__cancel_boot()
+        with self.__lock:
+            self.__boot_timer = threading.Timer(self.__boot_time, self.__telnet.enable)
+            self.__boot_timer.daemon = True
+            self.__boot_timer.start()
+            if self.__app_auto_start_time is not None:
+                self.__app_auto_start_timer = threading.Timer(self.__app_auto_start_time, self.__start_traffic)
+                self.__app_auto_start_timer.daemon = True
+                self.__app_auto_start_timer.start()
+
+    def __cancel_boot(self) -> None:
+        with self.__lock:
+            for timer in (self.__boot_timer, self.__app_auto_start_timer):
+                if timer:
+                    timer.cancel()
+
+    def __shutdown(self) -> None:
+        self.__cancel_boot()
+        self.__stop_traffic()
+        self.__telnet.disable()
+
+    def __on_command(self, command: bytes) -> None:
+        if _OS_REBOOT_CMD in command:
+            self.__crashing_starts = 0
+            self.__shutdown()
+            self.__schedule_boot()
+        elif command.startswith(b"nohup"):
+            self.__stop_traffic()
+            if self.__crashing_starts > 0:
+                self.__crashing_starts -= 1
+            else:
+                self.__start_traffic()
+        else:
+            # Any other command is considered the kill command
+            self.__stop_traffic()
+
+    def __start_traffic(self) -> None:
+        with self.__lock:
+            self.__sender = self.__sender_class(server_address=self.server_address, **self.__traffic_parameters)
+            self.__sender.start()
+            self.app_start_times.append(time.monotonic())
+
+    def __stop_traffic(self) -> None:
+        with self.__lock:
+            if self.__sender is not None:
+                self.__sender.stop()
+                self.__sender.join()
+                self.sent_messages += self.__sender.sent_messages
+                self.sent_bytes += self.__sender.sent_bytes
+                self.__sender = None
+
+    def hang_app(self) -> None:
+        """ The benchmark stops sending messages, a soft app reboot fixes it """
+        self.__stop_traffic()
+
+    def hang_app_until_os_reboot(self, crashing_starts: int = 3) -> None:
+        """ The benchmark stops, and the next crashing_starts app starts die immediately,
+        or until a soft OS reboot
+        """
+        self.__crashing_starts = crashing_starts
+        self.__stop_traffic()
+
+    def hang_os(self) -> None:
+        """ The OS freezes, only a power cycle fixes it """
+        self.__shutdown()
+
+    def machine_parameters(self, json_files: list, max_timeout_time: int = 1, boot_waiting_time: int = 10,
+                           disable_os_soft_reboot: bool = True, boot_heartbeat: bool = False) -> dict:
+        """ Content of the machine yaml file for this simulated DUT """
+        return {
+            "ip": self.ip, "receive_port": self.server_address[1], "hostname": self.hostname,
+            "username": "carol", "password": "carol", "telnet_port": self.telnet_port,
+            "power_switch_ip": self.__power_switch.switch_ip, "power_switch_port": self.outlet,
+            "power_switch_model": "lindy", "boot_waiting_time": boot_waiting_time,
+            "max_timeout_time": max_timeout_time, "disable_os_soft_reboot": disable_os_soft_reboot,
+            "json_files": json_files, "boot_heartbeat": boot_heartbeat,
+        }
+
+
+def free_port(kind: int = socket.SOCK_STREAM, ip: str = "127.0.0.1") -> int:
+    """ Ask the OS for a free port on the loopback """
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind((ip, 0))
+        return sock.getsockname()[1]
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+"""
+Replay a traffic capture recorded by a Machine (capture_dir on the machine yaml file).
+The datagrams can be sent to a running server (UDP) with the original timing, accelerated
+or as fast as possible, or passed directly to the message pipeline of the Machine (deduplication, reordering,
+classification, ingest budget and DUT log rotation) to measure its throughput and to compare the DUT logs
+generated by two server versions.
+
+Usage (from the repository root):
+    python -m benchmarks.replay_capture CAPTURE --udp 127.0.0.1:1024 --speed 1
+    python -m benchmarks.replay_capture CAPTURE --log-dir /tmp/replay
+"""
+import argparse
+import collections
+import glob
+import os
+import socket
+import time
+
+from server.deduplication import DEFAULT_DEDUP_WINDOW, split_sequence_number
+from server.dut_logging import DUTLogging, EndStatus
+from server.message_pipeline import MessagePipeline, classify_message
+from server.traffic_capture import dut_logs_digest, read_capture
+
+REPLAY_LOGGER_NAME = "REPLAY"
+
+
+def replay_udp(capture_file: str, server_address: tuple, speed: float = 1.0) -> dict:
+    """ Send the datagrams of a capture to a server
+    :param capture_file: path of the capture file
+    :param server_address: (ip, port) of the Machine receive socket
+    :param speed: 1 keeps the original timing, 10 is ten times faster, 0 sends as fast as possible
+    :return: dict with the number of datagrams and the time spent
+    """
+    datagrams = 0
+    start_time = time.monotonic()
+    first_timestamp_ns = None
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for timestamp_ns, data in read_capture(capture_file=capture_file):
+            if speed > 0:
+                if first_timestamp_ns is None:
+                    first_timestamp_ns = timestamp_ns
+                wait_time = (timestamp_ns - first_timestamp_ns) / 1e9 / speed - (time.monotonic() - start_time)
+                if wait_time > 0:
+                    time.sleep(wait_time)
+            sock.sendto(data, server_address)
+            datagrams += 1
+    return {"datagrams": datagrams, "duration": time.monotonic() - start_time}
+
+
+def replay_pipeline(capture_file: str, log_dir: str, hostname: str = "replay",
+                    dedup_window: float = DEFAULT_DEDUP_WINDOW, reorder_window: float = None,
+                    max_err_rate: float = None, max_it_rate: float = None) -> dict:
+    """ Pass the datagrams of a capture to the message pipeline of the Machine, as fast as possible.
+    A new DUT log starts at each #HEADER, as the app restarts of the captured campaign
+    :param capture_file: path of the capture file
+    :param log_dir: directory of the generated DUT logs
+    :param hostname: hostname on the DUT log names
+    :param dedup_window: same as the machine yaml dedup_window, 0 disables the deduplication
+    :param reorder_window: same as the machine yaml reorder_window, None disables the reordering
+    :param max_err_rate: same as the machine yaml max_err_rate, None is unlimited
+    :param max_it_rate: same as the machine yaml max_it_rate, None is unlimited
+    :return: dict with the counters per message type, the throughput and the digest of the generated logs
+    """
+    message_types = collections.Counter()
+    pipeline = MessagePipeline(dedup_window=dedup_window, reorder_window=reorder_window, max_err_rate=max_err_rate,
+                               max_it_rate=max_it_rate,
+                               on_message=lambda message_type, message, keep: message_types.update([message_type]))
+    datagrams = 0
+    now = 0.0
+    start_time = time.perf_counter()
+    for timestamp_ns, data in read_capture(capture_file=capture_file):
+        datagrams += 1
+        # The capture time is used, so the windows and the budget behave as on the campaign
+        now = timestamp_ns / 1e9
+        _, unsequenced_data = split_sequence_number(message=data)
+        if pipeline.dut_logging is None or classify_message(buffer=unsequenced_data,
+                                                            data_size=len(unsequenced_data)) == "#HEADER":
+            if pipeline.dut_logging:
+                pipeline.finish_log(end_status=EndStatus.SOFT_APP_REBOOT, now=now)
+            pipeline.start_log(dut_logging=DUTLogging(log_dir=log_dir, test_name="replay", test_header=capture_file,
+                                                      hostname=hostname, logger_name=REPLAY_LOGGER_NAME))
+        pipeline.receive(buffer=data, message=data, now=now)
+    if pipeline.dut_logging:
+        pipeline.finish_log(end_status=EndStatus.NORMAL_END, now=now)
+    elapsed = time.perf_counter() - start_time
+    log_files = sorted(glob.glob(os.path.join(log_dir, "**", f"*_{hostname}.log"), recursive=True))
+    return {
+        "datagrams": datagrams, "duplicates": pipeline.duplicates, "reordered": pipeline.reordered,
+        "lost": pipeline.lost, "shed": pipeline.shed, "message_types": dict(message_types),
+        "msgs_per_s": datagrams / elapsed if elapsed else 0.0,
+        "log_files": log_files, "digest": dut_logs_digest(log_files=log_files),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Replay a traffic capture recorded by a Machine')
+    parser.add_argument('capture_file', help="Path to the capture file")
+    parser.add_argument('--udp', metavar="IP:PORT", help="Send the datagrams to a running server")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed with --udp, 1 keeps the original timing, 0 sends as fast as possible")
+    parser.add_argument('--log-dir', help="Pass the datagrams to the message pipeline and write the logs here")
+    parser.add_argument('--dedup-window', type=float, default=DEFAULT_DEDUP_WINDOW,
+                        help="Deduplication window of the pipeline replay, 0 disables it")
+    parser.add_argument('--reorder-window', type=float, help="Reorder window of the pipeline replay (#SEQ:<n>)")
+    parser.add_argument('--max-err-rate', type=float, help="#ERR lines per second written by the pipeline replay")
+    parser.add_argument('--max-it-rate', type=float, help="#IT lines per second written by the pipeline replay")
+    args = parser.parse_args()
+    if bool(args.udp) == bool(args.log_dir):
+        parser.error("Use one of --udp or --log-dir")
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    if args.udp:
+        ip, _, port = args.udp.rpartition(":")
+        result = replay_udp(capture_file=args.capture_file, server_address=(ip, int(port)), speed=args.speed)
+        print(f"Sent {result['datagrams']} datagrams in {result['duration']:.2f}s")
+    else:
+        os.makedirs(args.log_dir, exist_ok=True)
+        result = replay_pipeline(capture_file=args.capture_file, log_dir=args.log_dir,
+                                 dedup_window=args.dedup_window, reorder_window=args.reorder_window,
+                                 max_err_rate=args.max_err_rate, max_it_rate=args.max_it_rate)
+        print(f"Replayed {result['datagrams']} datagrams ({result['duplicates']} duplicates) "
+              f"at {result['msgs_per_s']:.0f} msgs/s")
+        print(f"Message types: {result['message_types']}")
+        print(f"DUT logs digest: {result['digest']}")
+
+
+if __name__ == '__main__':
+    main()
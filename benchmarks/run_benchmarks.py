@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+"""
+End-to-end server benchmarks based on the DUT simulator.
+Measures the server ingest throughput, the DUTLogging write throughput,
+the recovery latency of each reboot tier and the CPU/memory used by N simulated boards.
+The results can be saved as a baseline and compared against it to detect regressions.
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks --save-baseline
+    python -m benchmarks.run_benchmarks --compare
+    python -m benchmarks.run_benchmarks --capture CAPTURE  # also replay a recorded campaign traffic
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from benchmarks.dut_simulator import FakePowerSwitch, SimulatedDUT, free_port
+from benchmarks.replay_capture import replay_pipeline
+from server.dut_logging import DUTLogging, EndStatus
+from server.event_log import event_logging_setup, EVENT_LOGGER_NAME
+from server.logger_formatter import logging_setup, logging_shutdown
+from server.machine import Machine
+
+BENCHMARK_LOGGER_NAME = "BENCHMARK"
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# Relative difference from the baseline accepted before reporting a regression
+DEFAULT_TOLERANCE = 0.25
+# Time waiting for the simulated DUTs to boot and start the app
+_STARTUP_TIMEOUT = 30
+# Maximum time in seconds to import the server modules (on top of the interpreter startup)
+IMPORT_TIME_BUDGET = 0.15
+# Modules imported by server.py at startup, the optional features are imported when they are enabled
+_SERVER_MODULES = ("server.config", "server.dut_logging", "server.event_log", "server.logger_formatter",
+                   "server.machine", "server.reboot_machine")
+
+
+class _SimulatedFleet:
+    """ N simulated DUTs, each one monitored by a Machine thread """
+
+    def __init__(self, work_dir: str, boards: int, disable_os_soft_reboot: bool = True, create_machines: bool = True,
+                 boot_heartbeat: bool = False, machine_parameters: dict = None, **traffic_parameters):
+        self.work_dir = work_dir
+        self.log_dir = os.path.join(work_dir, "logs")
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.power_switch = FakePowerSwitch()
+        self.duts = list()
+        self.machines = list()
+        self.machine_cfg_files = list()
+        json_file = os.path.join(work_dir, "simulated_benchmark.json")
+        with open(json_file, "w") as fp:
+            json.dump([{"killcmd": "killall -9 simulated", "exec": "/home/carol/simulated",
+                        "codename": "simulated", "header": "simulated benchmark"}], fp)
+
+        for board in range(boards):
+            receive_port = free_port(kind=socket.SOCK_DGRAM)
+            dut = SimulatedDUT(hostname=f"simulated{board}", server_address=("127.0.0.1", receive_port),
+                               telnet_port=free_port(), power_switch=self.power_switch, outlet=board + 1,
+                               **traffic_parameters)
+            machine_cfg = os.path.join(work_dir, f"{dut.hostname}.yaml")
+            parameters = dut.machine_parameters(json_files=[json_file], disable_os_soft_reboot=disable_os_soft_reboot,
+                                                boot_heartbeat=boot_heartbeat)
+            # Extra keys of the machine yaml files, ex: dedup_window
+            parameters.update(machine_parameters or dict())
+            with open(machine_cfg, "w") as fp:
+                yaml.safe_dump(parameters, fp)
+            self.duts.append(dut)
+            self.machine_cfg_files.append(machine_cfg)
+            if create_machines:
+                self.machines.append(Machine(configuration_file=machine_cfg, server_ip="127.0.0.1",
+                                             logger_name=BENCHMARK_LOGGER_NAME, server_log_path=self.log_dir))
+
+    def start_simulators(self) -> None:
+        self.power_switch.start()
+        for dut in self.duts:
+            dut.start()
+
+    def start(self) -> None:
+        self.start_simulators()
+        for machine in self.machines:
+            machine.start()
+        self.wait_for_apps()
+
+    def wait_for_apps(self) -> None:
+        deadline = time.monotonic() + _STARTUP_TIMEOUT
+        while any(not dut.app_start_times for dut in self.duts):
+            if time.monotonic() > deadline:
+                raise TimeoutError("The simulated DUTs did not start the app")
+            time.sleep(0.05)
+
+    def stop(self) -> None:
+        for dut in self.duts:
+            dut.stop()
+        for machine in self.machines:
+            machine.stop()
+        for machine in self.machines:
+            machine.join()
+        self.power_switch.stop()
+
+    def logged_messages(self) -> int:
+        """ Number of DUT messages written on the DUT logs """
+        messages = 0
+        for log_file in glob.glob(os.path.join(self.log_dir, "*", "**", "*.log"), recursive=True):
+            with open(log_file, "rb") as fp:
+                messages += sum(1 for line in fp if not line.startswith(b"#SERVER_"))
+        return messages
+
+
+@contextlib.contextmanager
+def _benchmark_logging(work_dir: str):
+    """ The server logging is configured as in server.py, but the console goes to /dev/null """
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stderr(devnull):
+            logging_setup(logger_name=BENCHMARK_LOGGER_NAME, log_file=os.path.join(work_dir, "server.log"))
+        event_logging_setup(event_log_file=os.path.join(work_dir, "server_events.jsonl"))
+        try:
+            yield
+        finally:
+            logging_shutdown(logger_name=BENCHMARK_LOGGER_NAME)
+            logging_shutdown(logger_name=EVENT_LOGGER_NAME)
+
+
+def _cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def benchmark_dut_log_write(num_messages: int = 100000) -> dict:
+    """ DUTLogging throughput without the network """
+    message = bytes([0xD]) + b"#IT Ite:123456 KerTime:0.012345 AccTime:1234.567890"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dut_logging = DUTLogging(log_dir=tmp_dir, test_name="benchmark", test_header="benchmark",
+                                 hostname="simulated", logger_name=BENCHMARK_LOGGER_NAME)
+        start_time = time.perf_counter()
+        for _ in range(num_messages):
+            dut_logging(message=message)
+        dut_logging.finish_this_dut_log(end_status=EndStatus.NORMAL_END)
+        elapsed = time.perf_counter() - start_time
+    return {
+        "dut_log_write_msgs_per_s": {"value": num_messages / elapsed, "higher_is_better": True},
+        "dut_log_write_mb_per_s": {"value": num_messages * len(message) / elapsed / 1e6, "higher_is_better": True},
+    }
+
+
+def benchmark_server_ingest(boards: int, duration: float, iterations_per_second: float) -> dict:
+    """ Messages per second written by the server for N boards, plus the CPU and memory of the server process.
+    The traffic is generated on separate processes
+    """
+    with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+        fleet = _SimulatedFleet(work_dir=work_dir, boards=boards, traffic_process=True,
+                                iterations_per_second=iterations_per_second, sdc_interval=100, errors_per_sdc=10)
+        fleet.start()
+        messages_before = fleet.logged_messages()
+        cpu_before, start_time = _cpu_time(), time.monotonic()
+        time.sleep(duration)
+        cpu_elapsed, elapsed = _cpu_time() - cpu_before, time.monotonic() - start_time
+        messages_during = fleet.logged_messages() - messages_before
+        fleet.stop()
+        sent = sum(dut.sent_messages for dut in fleet.duts)
+        logged = fleet.logged_messages()
+        del fleet
+    return {
+        "ingest_msgs_per_s": {"value": messages_during / elapsed, "higher_is_better": True},
+        "ingest_delivery_ratio": {"value": logged / sent if sent else 0.0, "higher_is_better": True},
+        "ingest_cpu_percent": {"value": 100.0 * cpu_elapsed / elapsed, "higher_is_better": False},
+        "ingest_max_rss_mb": {"value": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                              "higher_is_better": False},
+    }
+
+
+def benchmark_recovery_latency() -> dict:
+    """ Time from the DUT failure to the app running again, for each reboot tier """
+    scenarios = {
+        # tier: (fault injection, disable_os_soft_reboot)
+        "soft_app_reboot": (SimulatedDUT.hang_app, True),
+        "soft_os_reboot": (SimulatedDUT.hang_app_until_os_reboot, False),
+        "hard_reboot": (SimulatedDUT.hang_os, True),
+    }
+    results = dict()
+    for tier, (inject_fault, disable_os_soft_reboot) in scenarios.items():
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, disable_os_soft_reboot=disable_os_soft_reboot,
+                                    iterations_per_second=20)
+            fleet.start()
+            dut = fleet.duts[0]
+            # Let the app run for a while
+            time.sleep(1)
+            starts_before = len(dut.app_start_times)
+            fault_time = time.monotonic()
+            inject_fault(dut)
+            deadline = fault_time + 60
+            while len(dut.app_start_times) == starts_before and time.monotonic() < deadline:
+                time.sleep(0.01)
+            recovered = len(dut.app_start_times) > starts_before
+            latency = dut.app_start_times[-1] - fault_time if recovered else float("inf")
+            fleet.stop()
+            del fleet, dut
+        results[f"recovery_{tier}_s"] = {"value": latency, "higher_is_better": False}
+    return results
+
+
+def benchmark_capture_replay(capture_file: str) -> dict:
+    """ Throughput of the deduplication/DUTLogging pipeline with a recorded campaign traffic """
+    with tempfile.TemporaryDirectory() as tmp_dir, _benchmark_logging(tmp_dir):
+        result = replay_pipeline(capture_file=capture_file, log_dir=tmp_dir)
+    return {"replay_pipeline_msgs_per_s": {"value": result["msgs_per_s"], "higher_is_better": True}}
+
+
+def benchmark_import_time(repetitions: int = 5) -> dict:
+    """ Time to import the server modules on a fresh interpreter, minus the interpreter startup """
+    repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def _best_time(code: str) -> float:
+        best = float("inf")
+        for _ in range(repetitions):
+            start_time = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=repository_dir, check=True)
+            best = min(best, time.perf_counter() - start_time)
+        return best
+
+    import_time = _best_time(f"import {', '.join(_SERVER_MODULES)}") - _best_time("pass")
+    return {"server_import_s": {"value": max(import_time, 0.0), "higher_is_better": False}}
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """ Return the list of metrics that are worse than the baseline by more than tolerance """
+    regressions = list()
+    for name, metric in results.items():
+        if name not in baseline:
+            continue
+        reference, value = baseline[name]["value"], metric["value"]
+        if metric["higher_is_better"]:
+            regressed = value < reference * (1 - tolerance)
+        else:
+            regressed = value > reference * (1 + tolerance)
+        if regressed:
+            regressions.append(f"{name}: {value:.4g} (baseline {reference:.4g})")
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Server benchmarks using simulated DUTs')
+    parser.add_argument('--boards', type=int, default=4, help="Number of simulated boards for the ingest benchmark")
+    parser.add_argument('--duration', type=float, default=5.0, help="Duration of the ingest benchmark in seconds")
+    parser.add_argument('--rate', type=float, default=1000.0, help="Iterations per second of each simulated board")
+    parser.add_argument('--skip-recovery', default=False, action="store_true",
+                        help="Do not run the recovery latency benchmark (it takes about one minute)")
+    parser.add_argument('--capture', help="Traffic capture (capture_dir on the machine yaml) to replay")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_FILE, help="Path to the baseline JSON file")
+    parser.add_argument('--save-baseline', default=False, action="store_true", help="Save the results as baseline")
+    parser.add_argument('--compare', default=False, action="store_true", help="Compare the results with the baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative difference accepted before reporting a regression")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results = dict()
+    results.update(benchmark_import_time())
+    results.update(benchmark_dut_log_write())
+    results.update(benchmark_server_ingest(boards=args.boards, duration=args.duration,
+                                           iterations_per_second=args.rate))
+    if args.skip_recovery is False:
+        results.update(benchmark_recovery_latency())
+    if args.capture:
+        results.update(benchmark_capture_replay(capture_file=args.capture))
+
+    for name, metric in results.items():
+        print(f"{name:32s} {metric['value']:12.4f}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump(results, fp, indent=2)
+            fp.write("\n")
+        print(f"Baseline saved on {args.baseline}")
+
+    regressions = list()
+    # The import time budget is enforced even without a baseline
+    if results["server_import_s"]["value"] > IMPORT_TIME_BUDGET:
+        regressions.append(f"server_import_s: {results['server_import_s']['value']:.4g} "
+                           f"(budget {IMPORT_TIME_BUDGET:.4g})")
+    if args.compare:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions.extend(compare_with_baseline(results=results, baseline=baseline, tolerance=args.tolerance))
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
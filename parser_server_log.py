@@ -1,25 +1,32 @@
 #!/usr/bin/python3
 import argparse
 import re
+import typing
 
-import pandas as pd
+# pandas is only imported when a file is parsed, so --help and the modules that import this one are fast
+if typing.TYPE_CHECKING:
+    import pandas as pd
 
 
 def parse_args() -> argparse.Namespace:
     """ Parse the args and return an args namespace and the tostring from the args    """
     parser = argparse.ArgumentParser(description='Radiation setup parser for the server logs')
     # parser = argparse.ArgumentParser(description='PyTorch DNN radiation setup')
-    parser.add_argument('--logfile', help="Path to the logfile", required=True)
+    parser.add_argument('--logfile', help="Path to the logfile")
+    parser.add_argument('--eventfile', help="Path to the JSON lines event file (server_event_log_file)")
 
     args, remaining_argv = parser.parse_known_args()
+    if args.logfile is None and args.eventfile is None:
+        parser.error("--logfile or --eventfile is required")
 
     return args
 
 
-def main() -> None:
-    args = parse_args()
+def parse_log_file(logfile: str) -> "pd.DataFrame":
+    """ Recover the reboot events from the human server log """
+    import pandas as pd
     lines = list()
-    with open(args.logfile) as log_fp:
+    with open(logfile) as log_fp:
         for line in log_fp:
             m = re.match(r"(\d+)-(\d+)-(\d+) (\d+):(\d+):(\d+) (.*) (\S+).py:(\d+)", line)
             day, month, year, hour, minutes, seconds, detail, src_file, src_line = m.groups()
@@ -28,15 +35,34 @@ def main() -> None:
                 line["hard_reboot"] = 1
             if "SUCCESSFUL OS REBOOT" in detail:
                 line["os_reboot"] = 1
-            if "SUCCESSFUL SOFT REBOOT CMDS" in detail:
+            # Machine logs "SUCCESSFULLY SEND THE SOFT REBOOT CMDS"
+            if "SOFT REBOOT CMDS" in detail:
                 line["app_reboot"] = 1
             m = re.match(r".*HOSTNAME:(\S+) .*", detail)
             if m:
                 line["hostname"] = m.group(1)
             lines.append(line)
 
-    df = pd.DataFrame(lines).fillna(0)
-    print(df[df["hostname"] == 0])
+    return pd.DataFrame(lines).fillna(0)
+
+
+def parse_event_file(eventfile: str) -> "pd.DataFrame":
+    """ Load the reboot events from the JSON lines event log, one column per reboot tier """
+    import pandas as pd
+    df = pd.read_json(eventfile, lines=True)
+    df = df[(df["event"] == "reboot") & (df["status"] == "SUCCESS")]
+    tier_columns = {"HARD_REBOOT": "hard_reboot", "SOFT_OS_REBOOT": "os_reboot", "SOFT_APP_REBOOT": "app_reboot"}
+    df = pd.get_dummies(df["tier"].map(tier_columns), dtype=int).assign(hostname=df["hostname"])
+    return df
+
+
+def main() -> None:
+    args = parse_args()
+    if args.eventfile:
+        df = parse_event_file(eventfile=args.eventfile)
+    else:
+        df = parse_log_file(logfile=args.logfile)
+        print(df[df["hostname"] == 0])
     df = df.groupby(["hostname"]).sum()
     print(df)
 
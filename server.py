@@ -4,6 +4,7 @@ import errno
 import logging
 import os
 import signal
+import socket
 import sys
 import threading
 import traceback
@@ -11,9 +12,14 @@ import typing
 
 import yaml
 
-from server.logger_formatter import logging_setup
+from server.config import ConfigError, load_fleet_config
+from server.dut_logging import set_max_open_log_files
+from server.event_log import event_logging_setup
+from server.logger_formatter import logging_setup, logging_dropped_records
 from server.machine import Machine
-from server.print_manager import ConsoleCursesManager
+from server.reboot_machine import check_curl_available
+
+# The optional features are imported only when they are enabled, to keep the server startup fast
 
 # Logger name in the main server thread
 PARENT_LOGGER_NAME: str = os.path.basename(str(__file__).lower().replace(".py", ""))
@@ -21,11 +27,24 @@ PARENT_LOGGER_NAME: str = os.path.basename(str(__file__).lower().replace(".py",
 # Those global variables are necessary to stop all the threads when an exception is raised
 # Machine List
 MACHINE_LIST: list = list()
-CONSOLE_CURSES_MANAGER: typing.Optional[ConsoleCursesManager] = None
+CONSOLE_CURSES_MANAGER: typing.Optional["server.print_manager.ConsoleCursesManager"] = None
+LIVE_API_SERVER: typing.Optional["server.live_api.LiveApiServer"] = None
+ARTIFACT_RETRIEVAL: typing.Optional["server.artifact_retrieval.ArtifactRetrievalScheduler"] = None
+BEAM_CONTROL: typing.Optional["server.beam_control.BeamControlServer"] = None
+FEDERATION_CLIENT: typing.Optional["server.federation.FederationClient"] = None
 
 THREAD_JOIN_TIMEOUT: float = 1.0
 
 
+def __fleet_state() -> list:
+    """ Metrics of all the machines, the process supervisor returns the metrics of its workers """
+    fleet_state = list()
+    for machine in MACHINE_LIST:
+        machine_metrics = machine.metrics
+        fleet_state.extend(machine_metrics if isinstance(machine_metrics, list) else [machine_metrics])
+    return fleet_state
+
+
 def __end_daemon_machines():
     # FIXME: This does not work when the end is before the threads are not started yet
     """ General end for all machines """
@@ -40,6 +59,22 @@ def __end_daemon_machines():
         except RuntimeError as e:
             logging.error(f"Error while joining thread: {e}")
 
+    if LIVE_API_SERVER is not None:
+        LIVE_API_SERVER.stop()
+
+    if ARTIFACT_RETRIEVAL is not None:
+        ARTIFACT_RETRIEVAL.stop()
+
+    if BEAM_CONTROL is not None:
+        BEAM_CONTROL.stop()
+
+    if FEDERATION_CLIENT is not None:
+        FEDERATION_CLIENT.stop()
+
+    dropped_records = logging_dropped_records(logger_name=PARENT_LOGGER_NAME)
+    if dropped_records:
+        logger.warning(f"Logging queue was full, dropped records:{dropped_records}")
+
     if CONSOLE_CURSES_MANAGER is not None:
         CONSOLE_CURSES_MANAGER.stop()
         try:
@@ -93,11 +128,23 @@ def main():
                         help='Path to an YAML FILE that contains the server parameters. '
                              'Default is ./server_parameters.yaml')
     parser.add_argument('--enable_curses', default=False, action="store_true", help='Enable curses display')
+    parser.add_argument('--processes', metavar='N', type=int, default=1,
+                        help='Split the machines across N worker processes. Default is 1, all machines are '
+                             'threads of the server process')
+    parser.add_argument('--check', default=False, action="store_true",
+                        help='Only verify the configuration files, curl and the power switches, then exit')
     args = parser.parse_args()
     # load yaml file
     with open(args.config, 'r') as fp:
         server_parameters = yaml.load(fp, Loader=yaml.SafeLoader)
 
+    if args.check:
+        from server.preflight import run_preflight_checks
+        preflight_results = run_preflight_checks(server_parameters=server_parameters)
+        for result in preflight_results:
+            print(f"[{'OK' if result.passed else 'FAIL':^4}] {result.name}: {result.detail}")
+        sys.exit(0 if all(result.passed for result in preflight_results) else 1)
+
     server_log_file = server_parameters['server_log_file']
     server_log_store_dir = server_parameters['server_log_store_dir']
     server_ip = server_parameters['server_ip']
@@ -105,26 +152,105 @@ def main():
     # log in the stdout
     global CONSOLE_CURSES_MANAGER
     if args.enable_curses is True:
+        from server.print_manager import ConsoleCursesManager
         CONSOLE_CURSES_MANAGER = ConsoleCursesManager(daemon=True)
         CONSOLE_CURSES_MANAGER.start()
 
     logger = logging_setup(logger_name=PARENT_LOGGER_NAME, log_file=server_log_file, enable_curses=args.enable_curses)
     logger.info(f"Python version: {sys.version_info.major}.{sys.version_info.minor} machine:{server_ip}")
+    # The structured event log is optional
+    if "server_event_log_file" in server_parameters:
+        event_logging_setup(event_log_file=server_parameters["server_event_log_file"])
 
     # If a path does not exist, create it
     if os.path.isdir(server_log_store_dir) is False:
         os.mkdir(server_log_store_dir)
 
+    # Stage timers and the diagnostics dump on SIGUSR1 are optional, they are also passed to the worker processes
+    diagnostics = None
+    if server_parameters.get("instrumentation", False):
+        from server.instrumentation import DEFAULT_PROFILE_DURATION, DiagnosticsDumper, enable_instrumentation
+        enable_instrumentation()
+        diagnostics = dict(output_dir=server_parameters.get("diagnostics_dir", server_log_store_dir),
+                           profile_duration=server_parameters.get("profile_duration", DEFAULT_PROFILE_DURATION))
+        diagnostics_dumper = DiagnosticsDumper(logger_name=PARENT_LOGGER_NAME, **diagnostics)
+        diagnostics_dumper.install_signal_handler()
+        logger.info(f"Instrumentation enabled, run kill -USR1 {os.getpid()} to dump the diagnostics")
+
+    # The budget of open DUT log files is split between the worker processes
+    max_open_files = None
+    if "max_open_dut_log_files" in server_parameters:
+        max_open_files = max(server_parameters["max_open_dut_log_files"] // max(args.processes, 1), 1)
+        set_max_open_log_files(max_open_files=max_open_files)
+
+    # All the machines are validated before any socket is bound or any switch is touched
+    machine_cfg_files = [m["cfg_file"] for m in server_parameters["machines"] if m['enabled']]
+    try:
+        machine_configs = load_fleet_config(cfg_files=machine_cfg_files,
+                                            cache_file=server_parameters.get("config_cache_file"))
+    except ConfigError as err:
+        logger.error(f"Invalid configuration, no machine was started:\n{err}")
+        sys.exit(1)
+    # The default switches are controlled with curl, better to fail now than on the first power cycle
+    if any(machine_config.power_switch_model == "default" for machine_config in machine_configs):
+        try:
+            check_curl_available()
+        except OSError as err:
+            logger.error(f"{err}, no machine was started")
+            sys.exit(1)
+
+    # The live API is optional, it must be started before the machines, so they publish their messages on it
+    global LIVE_API_SERVER
+    if "live_api_port" in server_parameters:
+        from server.live_api import LiveApiServer
+        LIVE_API_SERVER = LiveApiServer(host=server_parameters.get("live_api_host", "127.0.0.1"),
+                                        port=server_parameters["live_api_port"], fleet_state=__fleet_state,
+                                        logger_name=PARENT_LOGGER_NAME, daemon=True)
+        LIVE_API_SERVER.start()
+
+    # Beam pause/resume through a unix socket (optional), see server/beam_control.py
+    global BEAM_CONTROL
+    if "beam_control_socket" in server_parameters:
+        from server.beam_control import BeamControlServer
+        BEAM_CONTROL = BeamControlServer(socket_path=server_parameters["beam_control_socket"],
+                                         machines=lambda: list(MACHINE_LIST), logger_name=PARENT_LOGGER_NAME,
+                                         daemon=True)
+        logger.info(f"Starting {BEAM_CONTROL}")
+        BEAM_CONTROL.start()
+
+    # Events and metrics streamed to the aggregator of all the beamlines (optional), see server/federation.py
+    global FEDERATION_CLIENT
+    if "federation_aggregator" in server_parameters:
+        from server.federation import FederationClient
+        FEDERATION_CLIENT = FederationClient(aggregator_address=server_parameters["federation_aggregator"],
+                                             instance=server_parameters.get("federation_instance",
+                                                                            socket.gethostname()),
+                                             fleet_state=__fleet_state, logger_name=PARENT_LOGGER_NAME,
+                                             daemon=True)
+        logger.info(f"Starting {FEDERATION_CLIENT}")
+        FEDERATION_CLIENT.start()
+
     # noinspection SpellCheckingInspection
     # set the exception hook
     threading.excepthook = __machine_thread_exception_handler
 
     try:
+        if args.processes > 1:
+            from server.process_supervisor import MachineProcessSupervisor
+            # Start the worker processes, each one runs the threads of a subset of the machines
+            supervisor = MachineProcessSupervisor(machine_cfg_files=machine_cfg_files, processes=args.processes,
+                                                  server_ip=server_ip, logger_name=PARENT_LOGGER_NAME,
+                                                  server_log_path=server_log_store_dir,
+                                                  max_open_log_files=max_open_files, diagnostics=diagnostics)
+            logger.info(f"Starting {supervisor}")
+            supervisor.start()
+            MACHINE_LIST.append(supervisor)
         # Start the server threads
-        for m in server_parameters["machines"]:
-            if m['enabled']:
-                machine = Machine(configuration_file=m["cfg_file"], server_ip=server_ip, logger_name=PARENT_LOGGER_NAME,
-                                  server_log_path=server_log_store_dir)
+        for machine_config in machine_configs:
+            if args.processes <= 1:
+                machine = Machine(configuration_file=machine_config.cfg_file, server_ip=server_ip,
+                                  logger_name=PARENT_LOGGER_NAME, server_log_path=server_log_store_dir,
+                                  machine_config=machine_config)
 
                 logger.info(f"Starting a new thread to listen at {machine}")
                 machine.start()
@@ -135,6 +261,23 @@ def main():
         # Unknown exit
         sys.exit(-1)
 
+    # The artifacts are retrieved periodically from the running DUTs (optional)
+    global ARTIFACT_RETRIEVAL
+    if "artifact_retrieval_interval" in server_parameters:
+        from server.artifact_retrieval import DEFAULT_PARALLEL_TRANSFERS, ArtifactRetrievalScheduler, ArtifactRetriever
+        retriever = ArtifactRetriever(
+            store_dir=server_parameters.get("artifact_store_dir", os.path.join(server_log_store_dir, "artifacts")),
+            logger_name=PARENT_LOGGER_NAME,
+            parallel_transfers=server_parameters.get("artifact_parallel_transfers", DEFAULT_PARALLEL_TRANSFERS),
+            bwlimit_kbps=server_parameters.get("artifact_bwlimit_kbps", 0)
+        )
+        ARTIFACT_RETRIEVAL = ArtifactRetrievalScheduler(
+            retriever=retriever, machine_configs=machine_configs, fleet_state=__fleet_state,
+            interval=server_parameters["artifact_retrieval_interval"], logger_name=PARENT_LOGGER_NAME, daemon=True
+        )
+        logger.info(f"Starting {ARTIFACT_RETRIEVAL}")
+        ARTIFACT_RETRIEVAL.start()
+
     print(f"Done. Exiting.")
 
 
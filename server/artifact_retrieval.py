@@ -0,0 +1,337 @@
+"""
+Retrieval of the files produced on the DUTs (outputs, corrupted tensors, kernel logs...),
+listed on the artifact_paths of each machine YAML file.
+The transfers use rsync over SSH, so an interrupted file resumes and a changed file only sends its delta.
+Each DUT has a mirror directory (the rsync destination), and each new file version is stored once
+on a checksum-indexed object store, with one JSON line per retrieved file on index.jsonl.
+The transfers run in parallel across the DUTs, with a bandwidth limit to not disturb the UDP messages.
+
+Usage after a run (from the repository root):
+    python -m server.artifact_retrieval -c server_parameters.yaml [--hosts HOSTNAME ...]
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+import typing
+
+from .config import MachineConfig, load_fleet_config
+
+# Number of DUTs transferring at the same time, each DUT has a single transfer at a time
+DEFAULT_PARALLEL_TRANSFERS = 4
+# Maximum time of an rsync call, a larger file resumes on the next retrieval
+DEFAULT_TRANSFER_TIMEOUT = 600
+_SSH_CONNECT_TIMEOUT = 10
+_HASH_BLOCK_SIZE = 1 << 20
+# rsync keeps the interrupted files here (inside the mirror), the next call resumes them
+_PARTIAL_DIR = ".rsync-partial"
+# The scheduler looks for paused DUTs this often (in seconds)
+_SCHEDULER_POLL_INTERVAL = 10.0
+
+
+class RetrievalResult(typing.NamedTuple):
+    hostname: str
+    remote_path: str
+    passed: bool
+    new_files: int
+    new_bytes: int
+    duration: float
+    detail: str
+
+
+class ArtifactStore:
+    """ Checksum-indexed storage of the retrieved files """
+
+    def __init__(self, store_dir: str):
+        """
+        :param store_dir: directory of the mirrors, the objects and the index
+        """
+        self.__store_dir = store_dir
+        self.__index_file = os.path.join(store_dir, "index.jsonl")
+        self.__lock = threading.Lock()
+        # (hostname, file on the mirror) -> (size, mtime_ns) of the last version stored
+        self.__known_versions = dict()
+        os.makedirs(os.path.join(store_dir, "objects"), exist_ok=True)
+        if os.path.isfile(self.__index_file):
+            with open(self.__index_file) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted server
+                        continue
+                    self.__known_versions[(entry["hostname"], entry["file"])] = (entry["size"], entry["mtime_ns"])
+
+    def mirror_dir(self, hostname: str) -> str:
+        """ rsync destination of a DUT, the unchanged files are not transferred again """
+        return os.path.join(self.__store_dir, "mirror", hostname)
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.__store_dir, "objects", sha256[:2], sha256)
+
+    def index_mirror(self, hostname: str, remote_path: str) -> typing.Tuple[int, int]:
+        """ Store the new or changed files of the mirror of a DUT
+        :param hostname: DUT hostname
+        :param remote_path: path on the DUT that was retrieved, rsync replicates it inside the mirror
+        :return: number of new file versions and their size
+        """
+        mirror_dir = self.mirror_dir(hostname=hostname)
+        local_path = os.path.join(mirror_dir, remote_path.strip("/"))
+        if os.path.isfile(local_path):
+            local_files = [local_path]
+        else:
+            local_files = list()
+            for root, dirs, files in os.walk(local_path):
+                dirs[:] = [directory for directory in dirs if directory != _PARTIAL_DIR]
+                local_files.extend(os.path.join(root, file) for file in files)
+        new_files, new_bytes = 0, 0
+        for local_file in sorted(local_files):
+            stat = os.stat(local_file)
+            mirror_file = os.path.relpath(local_file, mirror_dir)
+            version = (stat.st_size, stat.st_mtime_ns)
+            with self.__lock:
+                if self.__known_versions.get((hostname, mirror_file)) == version:
+                    continue
+            sha256 = self.__store_object(local_file=local_file)
+            entry = {"hostname": hostname, "file": mirror_file, "sha256": sha256, "size": stat.st_size,
+                     "mtime_ns": stat.st_mtime_ns, "retrieved": time.time()}
+            with self.__lock:
+                with open(self.__index_file, "a") as fp:
+                    fp.write(json.dumps(entry) + "\n")
+                self.__known_versions[(hostname, mirror_file)] = version
+            new_files += 1
+            new_bytes += stat.st_size
+        return new_files, new_bytes
+
+    def __store_object(self, local_file: str) -> str:
+        digest = hashlib.sha256()
+        with open(local_file, "rb") as fp:
+            for block in iter(lambda: fp.read(_HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+        object_path = self.object_path(sha256=sha256)
+        # The same content retrieved from another DUT or on a previous run is stored only once
+        if os.path.exists(object_path) is False:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{threading.get_ident()}.tmp"
+            try:
+                os.link(local_file, tmp_path)
+            except OSError:
+                shutil.copy2(local_file, tmp_path)
+            os.replace(tmp_path, object_path)
+        return sha256
+
+    def entries(self, hostname: str = None) -> typing.List[dict]:
+        """ Entries of the index
+        :param hostname: only the entries of this DUT, default is all
+        """
+        if os.path.isfile(self.__index_file) is False:
+            return list()
+        entries = list()
+        with open(self.__index_file) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if hostname is None or entry["hostname"] == hostname:
+                    entries.append(entry)
+        return entries
+
+
+class ArtifactRetriever:
+    """ Retrieve the artifact_paths of many DUTs in parallel """
+
+    def __init__(self, store_dir: str, logger_name: str, parallel_transfers: int = DEFAULT_PARALLEL_TRANSFERS,
+                 bwlimit_kbps: int = 0, transfer_timeout: float = DEFAULT_TRANSFER_TIMEOUT,
+                 rsync_command: str = "rsync"):
+        """
+        :param store_dir: directory of the ArtifactStore
+        :param logger_name: Main logger name to store the logging information
+        :param parallel_transfers: number of DUTs transferring at the same time
+        :param bwlimit_kbps: total bandwidth in KiB/s shared by the parallel transfers, 0 is unlimited
+        :param transfer_timeout: maximum time in seconds of each rsync call
+        :param rsync_command: rsync executable
+        """
+        self.__store = ArtifactStore(store_dir=store_dir)
+        self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__parallel_transfers = max(parallel_transfers, 1)
+        self.__bwlimit_kbps = bwlimit_kbps
+        self.__transfer_timeout = transfer_timeout
+        self.__rsync_command = rsync_command
+        # A DUT that is still transferring from the last retrieval is skipped
+        self.__busy_hosts = set()
+        self.__busy_lock = threading.Lock()
+
+    def __rsync_arguments(self, machine_config: MachineConfig, remote_path: str) -> typing.Tuple[list, dict]:
+        """ rsync command line and environment to retrieve a remote path """
+        ssh_command = (f"ssh -o ConnectTimeout={_SSH_CONNECT_TIMEOUT} -o StrictHostKeyChecking=accept-new "
+                       f"-o ServerAliveInterval={_SSH_CONNECT_TIMEOUT}")
+        arguments, environment = list(), None
+        # The DUTs are password protected, sshpass passes the password through the environment
+        if shutil.which("sshpass"):
+            arguments = ["sshpass", "-e"]
+            environment = dict(os.environ, SSHPASS=machine_config.password)
+        else:
+            ssh_command += " -o BatchMode=yes"
+        arguments += [self.__rsync_command, "--archive", "--relative", "--compress", "--partial",
+                      f"--partial-dir={_PARTIAL_DIR}", f"--timeout={int(self.__transfer_timeout)}", "-e", ssh_command]
+        if self.__bwlimit_kbps > 0:
+            arguments.append(f"--bwlimit={max(self.__bwlimit_kbps // self.__parallel_transfers, 1)}")
+        arguments += [f"{machine_config.username}@{machine_config.ip}:{remote_path}",
+                      self.__store.mirror_dir(hostname=machine_config.hostname) + "/"]
+        return arguments, environment
+
+    def __retrieve_machine(self, machine_config: MachineConfig) -> typing.List[RetrievalResult]:
+        results = list()
+        os.makedirs(self.__store.mirror_dir(hostname=machine_config.hostname), exist_ok=True)
+        for remote_path in machine_config.artifact_paths:
+            start_time = time.monotonic()
+            arguments, environment = self.__rsync_arguments(machine_config=machine_config, remote_path=remote_path)
+            try:
+                process = subprocess.run(arguments, env=environment, stdin=subprocess.DEVNULL,
+                                         capture_output=True, text=True, timeout=self.__transfer_timeout)
+                passed, detail = process.returncode == 0, process.stderr.strip()[-500:]
+            except (OSError, subprocess.TimeoutExpired) as error:
+                passed, detail = False, f"{type(error).__name__}: {error}"
+            # The files of an interrupted transfer that arrived are also stored
+            new_files, new_bytes = self.__store.index_mirror(hostname=machine_config.hostname,
+                                                             remote_path=remote_path)
+            results.append(RetrievalResult(hostname=machine_config.hostname, remote_path=remote_path,
+                                           passed=passed, new_files=new_files, new_bytes=new_bytes,
+                                           duration=time.monotonic() - start_time, detail=detail))
+            if passed is False:
+                self.__logger.error(f"Failed to retrieve {remote_path} from {machine_config.hostname}: {detail}")
+        return results
+
+    def __retrieve_machine_once(self, machine_config: MachineConfig) -> typing.List[RetrievalResult]:
+        try:
+            return self.__retrieve_machine(machine_config=machine_config)
+        finally:
+            with self.__busy_lock:
+                self.__busy_hosts.discard(machine_config.hostname)
+
+    def retrieve(self, machine_configs: typing.List[MachineConfig]) -> typing.List[RetrievalResult]:
+        """ Retrieve the artifact_paths of the machines, parallel_transfers DUTs at a time
+        :param machine_configs: list of MachineConfig, the ones without artifact_paths are ignored
+        :return: list of RetrievalResult, one per remote path
+        """
+        selected = list()
+        with self.__busy_lock:
+            for machine_config in machine_configs:
+                if machine_config.artifact_paths and machine_config.hostname not in self.__busy_hosts:
+                    self.__busy_hosts.add(machine_config.hostname)
+                    selected.append(machine_config)
+        results = list()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__parallel_transfers,
+                                                   thread_name_prefix="ArtifactRetrieval") as executor:
+            for machine_results in executor.map(self.__retrieve_machine_once, selected):
+                results.extend(machine_results)
+        new_files = sum(result.new_files for result in results)
+        new_bytes = sum(result.new_bytes for result in results)
+        self.__logger.info(f"Artifact retrieval from {len(selected)} DUTs: {new_files} new files ({new_bytes} bytes), "
+                           f"{sum(not result.passed for result in results)} failed transfers")
+        return results
+
+    @property
+    def store(self) -> ArtifactStore:
+        return self.__store
+
+
+class ArtifactRetrievalScheduler(threading.Thread):
+    """ Retrieve the artifacts of the DUTs during the beam pauses, when their app is killed,
+    so ssh and rsync never run on a DUT while its benchmark is being timed.
+    Each DUT is retrieved at most once per interval
+    """
+
+    def __init__(self, retriever: ArtifactRetriever, machine_configs: typing.List[MachineConfig],
+                 fleet_state: typing.Callable[[], list], interval: float, logger_name: str, *args, **kwargs):
+        """
+        :param retriever: ArtifactRetriever
+        :param machine_configs: list of MachineConfig of the fleet
+        :param fleet_state: function that returns the metrics of all the machines
+        :param interval: minimum time in seconds between two retrievals of a DUT
+        :param logger_name: Main logger name to store the logging information
+        """
+        super(ArtifactRetrievalScheduler, self).__init__(*args, **kwargs)
+        self.__retriever = retriever
+        self.__machine_configs = {config.hostname: config for config in machine_configs if config.artifact_paths}
+        self.__fleet_state = fleet_state
+        self.__interval = interval
+        self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__stop_event = threading.Event()
+        # hostname -> time.monotonic of its last retrieval
+        self.__last_retrieval = dict()
+
+    def __str__(self) -> str:
+        return f"Artifact retrieval of {sorted(self.__machine_configs)} during the beam pauses, every {self.__interval}s"
+
+    def idle_machines(self, now: float = None) -> typing.List[MachineConfig]:
+        """ Machines paused for the beam (their app is killed) that were not retrieved in the last interval """
+        now = time.monotonic() if now is None else now
+        idle = list()
+        for machine_metrics in self.__fleet_state():
+            machine_config = self.__machine_configs.get(machine_metrics["hostname"])
+            last_retrieval = self.__last_retrieval.get(machine_metrics["hostname"])
+            if machine_config and machine_metrics.get("paused") and (last_retrieval is None or
+                                                                     now - last_retrieval >= self.__interval):
+                idle.append(machine_config)
+        return idle
+
+    def retrieve_idle_machines(self) -> typing.List[RetrievalResult]:
+        """ Retrieve the idle machines now, they are not retrieved again before the interval """
+        machine_configs = self.idle_machines()
+        if not machine_configs:
+            return list()
+        now = time.monotonic()
+        for machine_config in machine_configs:
+            self.__last_retrieval[machine_config.hostname] = now
+        return self.__retriever.retrieve(machine_configs=machine_configs)
+
+    def run(self) -> None:
+        # The beam pauses can be short, the fleet is checked more often than the interval
+        while self.__stop_event.wait(timeout=min(self.__interval, _SCHEDULER_POLL_INTERVAL)) is False:
+            try:
+                self.retrieve_idle_machines()
+            except Exception:
+                # An unexpected error would reach the server excepthook, which stops all the machines
+                self.__logger.exception("Artifact retrieval failed")
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+
+
+def main() -> None:
+    import yaml
+
+    parser = argparse.ArgumentParser(description='Retrieve the artifact_paths of the DUTs')
+    parser.add_argument('-c', '--config', metavar='PATH_YAML_FILE', default="server_parameters.yaml",
+                        help='Path to the server parameters YAML file. Default is ./server_parameters.yaml')
+    parser.add_argument('--hosts', nargs="+", help="Only these DUT hostnames, default is all the enabled machines")
+    args = parser.parse_args()
+    with open(args.config) as fp:
+        server_parameters = yaml.load(fp, Loader=yaml.SafeLoader)
+    logging.basicConfig(level=logging.INFO)
+    machine_configs = load_fleet_config(cfg_files=[m["cfg_file"] for m in server_parameters["machines"] if m['enabled']])
+    if args.hosts:
+        machine_configs = [config for config in machine_configs if config.hostname in args.hosts]
+    retriever = ArtifactRetriever(
+        store_dir=server_parameters.get("artifact_store_dir",
+                                        os.path.join(server_parameters["server_log_store_dir"], "artifacts")),
+        logger_name="artifact_retrieval",
+        parallel_transfers=server_parameters.get("artifact_parallel_transfers", DEFAULT_PARALLEL_TRANSFERS),
+        bwlimit_kbps=server_parameters.get("artifact_bwlimit_kbps", 0),
+    )
+    for result in retriever.retrieve(machine_configs=machine_configs):
+        print(f"[{'OK' if result.passed else 'FAIL':^4}] {result.hostname}:{result.remote_path} "
+              f"{result.new_files} new files ({result.new_bytes} bytes) in {result.duration:.1f}s {result.detail}")
+
+
+if __name__ == '__main__':
+    main()
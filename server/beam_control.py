@@ -0,0 +1,129 @@
+"""
+Beam pause/resume control through a local (unix) socket.
+When the facility interrupts the beam, the pause command makes all the machines kill their apps in parallel
+and finish the DUT logs (#SERVER_DUE:beam pause); the command windows and the timeouts stop meanwhile.
+The resume command starts the current benchmark of every DUT again, without rebooting them.
+
+Usage (from the repository root):
+    python -m server.beam_control /tmp/radiation_server.sock pause
+    python -m server.beam_control /tmp/radiation_server.sock resume
+    python -m server.beam_control /tmp/radiation_server.sock status
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import threading
+import typing
+
+BEAM_COMMANDS = ("pause", "resume", "status")
+_COMMAND_TIMEOUT = 5
+_MAX_COMMAND_SIZE = 64
+
+
+class BeamControlServer(threading.Thread):
+    """ Answer the pause/resume/status commands sent to a unix socket, one JSON line per command """
+
+    def __init__(self, socket_path: str, machines: typing.Callable[[], list], logger_name: str, *args, **kwargs):
+        """
+        :param socket_path: path of the unix socket, an old socket file is replaced
+        :param machines: function that returns the machines (Machine or MachineProcessSupervisor)
+        :param logger_name: Main logger name to store the logging information
+        """
+        super(BeamControlServer, self).__init__(*args, **kwargs)
+        self.__socket_path = socket_path
+        self.__machines = machines
+        self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__paused = False
+        self.__stop_event = threading.Event()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.__server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__server_socket.bind(socket_path)
+        # Only the user that runs the server can pause the fleet
+        os.chmod(socket_path, 0o600)
+        self.__server_socket.listen()
+        self.__server_socket.settimeout(1)
+
+    def __str__(self) -> str:
+        return f"Beam control on {self.__socket_path}"
+
+    def pause(self) -> None:
+        """ Pause all the machines, each Machine kills its app on its own thread, so the DUTs are paused in parallel
+        """
+        self.__paused = True
+        for machine in self.__machines():
+            machine.pause()
+        self.__logger.warning("BEAM PAUSE requested, killing the apps of all the machines")
+
+    def resume(self) -> None:
+        self.__paused = False
+        for machine in self.__machines():
+            machine.resume()
+        self.__logger.warning("BEAM RESUME requested, starting the apps of all the machines")
+
+    def status(self) -> dict:
+        return {"paused": self.__paused, "machines": len(self.__machines())}
+
+    def __handle(self, connection: socket.socket) -> None:
+        with connection:
+            connection.settimeout(_COMMAND_TIMEOUT)
+            command = connection.recv(_MAX_COMMAND_SIZE).decode("ascii", errors="replace").strip().lower()
+            if command == "pause":
+                self.pause()
+            elif command == "resume":
+                self.resume()
+            elif command != "status":
+                connection.sendall(json.dumps({"error": f"unknown command {command!r}, "
+                                                        f"the possible ones are {BEAM_COMMANDS}"}).encode() + b"\n")
+                return
+            connection.sendall(json.dumps(self.status()).encode() + b"\n")
+
+    def run(self) -> None:
+        while self.__stop_event.is_set() is False:
+            try:
+                connection, _ = self.__server_socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                self.__handle(connection=connection)
+            except OSError as error:
+                self.__logger.error(f"Beam control command failed: {error}")
+        self.__server_socket.close()
+        if os.path.exists(self.__socket_path):
+            os.unlink(self.__socket_path)
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+
+    @property
+    def paused(self) -> bool:
+        return self.__paused
+
+
+def send_beam_command(socket_path: str, command: str) -> dict:
+    """ Send a command to a running server
+    :param socket_path: beam_control_socket of the server parameters
+    :param command: one of BEAM_COMMANDS
+    :return: status of the server after the command
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(_COMMAND_TIMEOUT)
+        client.connect(socket_path)
+        client.sendall(command.encode("ascii") + b"\n")
+        return json.loads(client.makefile("rb").readline())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Pause or resume all the machines of a running server')
+    parser.add_argument('socket_path', help="beam_control_socket of the server parameters")
+    parser.add_argument('command', choices=BEAM_COMMANDS)
+    args = parser.parse_args()
+    print(json.dumps(send_beam_command(socket_path=args.socket_path, command=args.command)))
+
+
+if __name__ == '__main__':
+    main()
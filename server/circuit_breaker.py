@@ -0,0 +1,135 @@
+"""
+Crash-loop detection with circuit breakers.
+A breaker counts the failures on a time window instead of sequential counters,
+so a DUT (or a benchmark) that sends a few good messages between the crashes is still detected.
+CLOSED: normal operation. OPEN: too many failures on the window, the DUT is quarantined (or the benchmark skipped).
+HALF_OPEN: the quarantine time is over, one trial is allowed before closing the breaker again.
+"""
+import collections
+import enum
+import logging
+import time
+
+from .event_log import ServerEvent, log_server_event
+
+
+class BreakerState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class CircuitBreaker:
+    """ Time-windowed failure tracker with circuit-breaker states.
+    The transitions are written on the server log and on the event log
+    """
+
+    def __init__(self, name: str, logger_name: str, failure_threshold: int, window: float, open_time: float,
+                 max_open_time: float = None, probation_time: float = 0.0, **event_fields):
+        """
+        :param name: name of the breaker on the logs, ex: the DUT hostname or the benchmark codename
+        :param logger_name: Main logger name to store the logging information
+        :param failure_threshold: number of failures on the window that opens the breaker
+        :param window: failure window in seconds
+        :param open_time: time in seconds that the breaker stays open the first time
+        :param max_open_time: the open time doubles each time a trial fails, up to this value
+        :param probation_time: time in seconds that a half-open trial must run before the breaker closes
+        :param event_fields: extra fields written on the event log, ex: hostname
+        """
+        self.__name = name
+        self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__failure_threshold = failure_threshold
+        self.__window = window
+        self.__base_open_time = open_time
+        self.__max_open_time = open_time if max_open_time is None else max_open_time
+        self.__probation_time = probation_time
+        self.__event_fields = event_fields
+        self.__failures = collections.deque()
+        self.__state = BreakerState.CLOSED
+        self.__open_time = open_time
+        self.__state_change_time = time.monotonic()
+        self.__trips = 0
+
+    def __str__(self) -> str:
+        return f"CircuitBreaker {self.__name} STATE:{self.__state} FAILURES:{len(self.__failures)}"
+
+    def __transition(self, new_state: BreakerState, now: float) -> None:
+        old_state, self.__state = self.__state, new_state
+        self.__state_change_time = now
+        message = f"CIRCUIT BREAKER {self.__name} {old_state}->{new_state} FAILURES:{len(self.__failures)} " \
+                  f"WINDOW:{self.__window}s"
+        if new_state == BreakerState.OPEN:
+            self.__trips += 1
+            self.__logger.error(f"{message} OPEN_TIME:{self.__open_time}s TRIPS:{self.__trips}")
+        else:
+            self.__logger.info(message)
+        log_server_event(ServerEvent.CIRCUIT_BREAKER, failed=new_state == BreakerState.OPEN, breaker=self.__name,
+                         old_state=old_state.name, state=new_state.name, failures=len(self.__failures),
+                         open_time=self.__open_time, trips=self.__trips, **self.__event_fields)
+
+    def __expire_failures(self, now: float) -> None:
+        while self.__failures and now - self.__failures[0] > self.__window:
+            self.__failures.popleft()
+
+    def record_failure(self, now: float = None) -> BreakerState:
+        """ Count a failure, it may open the breaker
+        :param now: time.monotonic timestamp
+        :return: the state after the failure
+        """
+        now = time.monotonic() if now is None else now
+        self.__failures.append(now)
+        self.__expire_failures(now=now)
+        if self.__state == BreakerState.HALF_OPEN:
+            # The trial failed, stay away for longer
+            self.__open_time = min(self.__open_time * 2, self.__max_open_time)
+            self.__transition(new_state=BreakerState.OPEN, now=now)
+        elif self.__state == BreakerState.CLOSED and len(self.__failures) >= self.__failure_threshold:
+            self.__transition(new_state=BreakerState.OPEN, now=now)
+        return self.__state
+
+    def record_success(self, now: float = None) -> BreakerState:
+        """ A healthy operation, it only matters while the breaker is half-open.
+        It is cheap enough to be called for every good message
+        :param now: time.monotonic timestamp
+        :return: the state after the success
+        """
+        if self.__state != BreakerState.HALF_OPEN:
+            return self.__state
+        now = time.monotonic() if now is None else now
+        if now - self.__state_change_time >= self.__probation_time:
+            self.__failures.clear()
+            self.__open_time = self.__base_open_time
+            self.__transition(new_state=BreakerState.CLOSED, now=now)
+        return self.__state
+
+    def allow(self, now: float = None) -> bool:
+        """ Check if the operation is allowed, an open breaker becomes half-open after the open time
+        :param now: time.monotonic timestamp
+        :return: False while the breaker is open
+        """
+        if self.__state != BreakerState.OPEN:
+            return True
+        now = time.monotonic() if now is None else now
+        if now - self.__state_change_time >= self.__open_time:
+            self.__transition(new_state=BreakerState.HALF_OPEN, now=now)
+            return True
+        return False
+
+    def remaining_open_time(self, now: float = None) -> float:
+        """ Time in seconds until the breaker becomes half-open, 0 if it is not open """
+        if self.__state != BreakerState.OPEN:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return max(self.__open_time - (now - self.__state_change_time), 0.0)
+
+    @property
+    def state(self) -> BreakerState:
+        return self.__state
+
+    @property
+    def trips(self) -> int:
+        """ Number of times that the breaker opened """
+        return self.__trips
@@ -1,32 +1,119 @@
 import collections
+import dataclasses
 import json
 import logging
+import os
 import time
 import typing
 
+from .circuit_breaker import BreakerState, CircuitBreaker
+from .config import COMMAND_WINDOW_CLOCKS, ConfigError, load_benchmarks
+from .error_rate_monitor import poisson_confidence_interval
+
 _ONE_HOUR_WINDOW = 3600
 
+# A benchmark that crashes the DUT this many times in the window is skipped for a while
+_BENCHMARK_MAX_CRASHES_IN_WINDOW = 10
+_BENCHMARK_CRASH_WINDOW = 3600
+_BENCHMARK_SKIP_TIME = 3600
+_BENCHMARK_MAX_SKIP_TIME = 4 * 3600
+# After the skip time the benchmark runs again, it must run this long without crashing to be trusted again
+_BENCHMARK_PROBATION_TIME = 300
+# The benchmark is exposed to the beam from its first #IT or #BEGIN to the last message before the failure
+_EXPOSURE_START_TYPES = ("#IT", "#BEGIN")
+# A benchmark that never reaches its first #IT or #BEGIN does not accumulate exposure, on the effective clock
+# its window is closed anyway after this many command windows of wall time
+_EFFECTIVE_WINDOW_WALL_FACTOR = 3
+
 
 class CommandFactory:
-    def __init__(self, json_files_list: list, logger_name: str, command_window: int = _ONE_HOUR_WINDOW):
+    def __init__(self, json_files_list: list, logger_name: str, command_window: int = _ONE_HOUR_WINDOW,
+                 hostname: str = None, benchmarks: typing.Sequence = None, window_clock: str = "effective",
+                 exposure_file: str = None):
+        """
+        :param json_files_list: JSON files that contain the benchmarks
+        :param logger_name: Main logger name to store the logging information
+        :param command_window: time in seconds that each benchmark runs before the rotation
+        :param hostname: DUT hostname, used on the event log
+        :param benchmarks: BenchmarkConfig list already validated (server.config), the JSON files are not read again
+        :param window_clock: wall, the command window counts the time since the selection of the benchmark,
+               or effective, it only counts the exposure time (boot waits and reboots are not counted), capped to
+               _EFFECTIVE_WINDOW_WALL_FACTOR command windows since the selection of the benchmark
+        :param exposure_file: JSON file that keeps the exposure totals of each benchmark across server restarts
+        """
+        if window_clock not in COMMAND_WINDOW_CLOCKS:
+            raise ValueError(f"window_clock must be one of {COMMAND_WINDOW_CLOCKS}")
         self.__command_window = command_window
-        self.__json_data_list = list()
+        self.__effective_window = window_clock == "effective"
         self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
-        for json_file in json_files_list:
-            try:
-                with open(json_file) as fp:
-                    machine_dict = json.load(fp)
-                    # The json files contain a list of dicts
-                    self.__json_data_list.extend(machine_dict)
-            except FileNotFoundError:
-                self.__logger.exception(f"Incorrect path for {json_file}, file not found")
-                raise
+        if benchmarks is None:
+            benchmarks = list()
+            for json_file in json_files_list:
+                try:
+                    benchmarks.extend(load_benchmarks(json_file=json_file))
+                except ConfigError:
+                    self.__logger.exception(f"Incorrect benchmark file {json_file}")
+                    raise
+        # The commands are dicts, as the start timestamp is stored on them
+        self.__json_data_list = [dataclasses.asdict(benchmark) for benchmark in benchmarks]
+
+        # One crash-loop breaker per benchmark, shared by the commands with the same codename
+        self.__breakers = {
+            command["codename"]: CircuitBreaker(name=command["codename"], logger_name=logger_name,
+                                                failure_threshold=_BENCHMARK_MAX_CRASHES_IN_WINDOW,
+                                                window=_BENCHMARK_CRASH_WINDOW, open_time=_BENCHMARK_SKIP_TIME,
+                                                max_open_time=_BENCHMARK_MAX_SKIP_TIME,
+                                                probation_time=_BENCHMARK_PROBATION_TIME,
+                                                hostname=hostname, codename=command["codename"])
+            for command in self.__json_data_list
+        }
 
         # Transform __json_data_list into a FIFO to manage the codes testing
         self.__cmd_queue = collections.deque()
         self.__check_and_refill_the_queue()
-        self.__current_command = self.__cmd_queue.pop()
+        self.__current_command = None
+        self.__current_breaker = None
+        self.__stop_condition_reached = None
+        self.__sdcs = self.__iterations = self.__crashes = 0
+        # time.time when the beam was paused, the command window does not run during the pause
+        self.__pause_timestamp = None
+
+        # Exposure of the current selection, and the exposure interval that is still open (time.monotonic)
+        self.__window_exposure = 0.0
+        self.__exposure_start = self.__exposure_last = None
+        self.__exposure_start_counts = (0, 0)
+        # codename -> exposure (s), iterations and SDCs received during the exposure, exposure intervals
+        self.__exposure_file = exposure_file
+        self.__exposure_totals = {command["codename"]: {"exposure": 0.0, "iterations": 0, "sdcs": 0, "runs": 0}
+                                  for command in self.__json_data_list}
+        if exposure_file and os.path.isfile(exposure_file):
+            try:
+                with open(exposure_file) as fp:
+                    for codename, totals in json.load(fp).items():
+                        self.__exposure_totals[codename] = {key: totals[key] for key in
+                                                            ("exposure", "iterations", "sdcs", "runs")}
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as error:
+                self.__logger.error(f"Ignoring the exposure totals {exposure_file} of {hostname}: {error}")
+        self.__select_next_command()
+
+    def __select_next_command(self):
+        """ Pop the next command and reset the counters of the stop conditions.
+        The benchmarks with an open circuit breaker are skipped, if all of them are open the last one is used
+        """
+        if self.__current_command is not None:
+            self.end_exposure()
+        for _ in range(len(self.__json_data_list)):
+            self.__check_and_refill_the_queue()
+            self.__current_command = self.__cmd_queue.pop()
+            self.__current_breaker = self.__breakers[self.__current_command["codename"]]
+            if self.__current_breaker.allow():
+                break
+            self.__logger.warning(f"Skipping {self.__current_command['codename']}, it is crashing the DUT "
+                                  f"(breaker open for {self.__current_breaker.remaining_open_time():.0f}s)")
         self.__current_command["start_timestamp"] = time.time()
+        self.__stop_condition_reached = None
+        self.__sdcs = self.__iterations = self.__crashes = 0
+        self.__window_exposure = 0.0
 
     def __check_and_refill_the_queue(self):
         """ Fill or re-fill the command queue """
@@ -35,13 +122,132 @@ class CommandFactory:
             self.__logger.info("Re-filling the queue of commands")
             self.__cmd_queue = collections.deque(self.__json_data_list)
 
+    def __check_stop_conditions(self):
+        """ Evaluate the stop conditions of the current command, only called when a counter changes """
+        stop_conditions = self.__current_command.get("stop_conditions")
+        if not stop_conditions or self.__stop_condition_reached:
+            return
+        target_sdcs = stop_conditions.get("target_sdcs")
+        target_iterations = stop_conditions.get("target_iterations")
+        max_crashes = stop_conditions.get("max_crashes")
+        max_ci_width = stop_conditions.get("max_ci_width")
+        if target_sdcs is not None and self.__sdcs >= target_sdcs:
+            self.__stop_condition_reached = f"reached {self.__sdcs} SDCs"
+        elif target_iterations is not None and self.__iterations >= target_iterations:
+            self.__stop_condition_reached = f"reached {self.__iterations} iterations"
+        elif max_crashes is not None and self.__crashes >= max_crashes:
+            self.__stop_condition_reached = f"reached {self.__crashes} crashes"
+        elif max_ci_width is not None and self.__sdcs > 0:
+            # Relative width of the 95% confidence interval of the SDC count
+            lower, upper = poisson_confidence_interval(count=self.__sdcs)
+            ci_width = (upper - lower) / self.__sdcs
+            if ci_width <= max_ci_width:
+                self.__stop_condition_reached = f"reached a SDC confidence interval width of {ci_width:.3f}"
+
+    def record_message(self, connection_type: str, now: float = None) -> float:
+        """ Count the messages of the current command for the stop conditions and the exposure time
+        :param connection_type: #IT, #SDC (the other types are not counted)
+        :param now: time.monotonic of the reception
+        :return: exposure time in seconds added by this message, for the rolling rates (ErrorRateMonitor)
+        """
+        now = time.monotonic() if now is None else now
+        exposure = 0.0
+        if self.__exposure_start is not None:
+            exposure = now - self.__exposure_last
+            self.__exposure_last = now
+        elif connection_type in _EXPOSURE_START_TYPES:
+            self.__exposure_start = self.__exposure_last = now
+            self.__exposure_start_counts = (self.__iterations, self.__sdcs)
+        if connection_type == "#IT":
+            self.__iterations += 1
+            self.__current_breaker.record_success()
+            self.__check_stop_conditions()
+        elif connection_type == "#SDC":
+            self.__sdcs += 1
+            self.__check_stop_conditions()
+        return exposure
+
+    def record_crash(self):
+        """ Count a crash of the current command for the stop conditions and the crash-loop breaker """
+        self.end_exposure()
+        self.__crashes += 1
+        if self.__current_breaker.record_failure() == BreakerState.OPEN:
+            self.__stop_condition_reached = "keeps crashing the DUT"
+        self.__check_stop_conditions()
+
+    def end_exposure(self) -> None:
+        """ The app of the current command stopped (crash, kill, beam pause), its exposure ends on its last message.
+        The exposure starts again with the next #IT or #BEGIN
+        """
+        if self.__exposure_start is None:
+            return
+        exposure = self.__exposure_last - self.__exposure_start
+        iterations, sdcs = self.__exposure_start_counts
+        self.__exposure_start = self.__exposure_last = None
+        self.__window_exposure += exposure
+        totals = self.__exposure_totals[self.__current_command["codename"]]
+        totals["exposure"] += exposure
+        totals["iterations"] += self.__iterations - iterations
+        totals["sdcs"] += self.__sdcs - sdcs
+        totals["runs"] += 1
+        self.__save_exposure_totals()
+
+    def __save_exposure_totals(self) -> None:
+        if not self.__exposure_file:
+            return
+        tmp_file = f"{self.__exposure_file}.tmp"
+        try:
+            with open(tmp_file, "w") as fp:
+                json.dump(self.__exposure_totals, fp)
+            os.replace(tmp_file, self.__exposure_file)
+        except OSError as error:
+            self.__logger.error(f"Could not write the exposure totals {self.__exposure_file}: {error}")
+
+    @property
+    def effective_time(self) -> float:
+        """ Exposure time in seconds of the current command since its selection, including the running app """
+        if self.__exposure_start is None:
+            return self.__window_exposure
+        return self.__window_exposure + self.__exposure_last - self.__exposure_start
+
+    @property
+    def exposure_totals(self) -> dict:
+        """ Exposure time, iterations, SDCs and exposure intervals of each benchmark, for the cross-sections.
+        The running app is not included until its exposure ends
+        """
+        return {codename: dict(totals) for codename, totals in self.__exposure_totals.items()}
+
+    def pause(self):
+        """ Freeze the command window of the current command (beam pause) """
+        self.end_exposure()
+        if self.__pause_timestamp is None:
+            self.__pause_timestamp = time.time()
+
+    def resume(self):
+        """ The current command keeps the time it had left before the pause """
+        if self.__pause_timestamp is not None:
+            self.__current_command["start_timestamp"] += time.time() - self.__pause_timestamp
+            self.__pause_timestamp = None
+
+    @property
+    def stop_condition_reached(self) -> typing.Optional[str]:
+        """ Description of the stop condition reached by the current command, None if no condition was reached
+        """
+        return self.__stop_condition_reached
+
     @property
     def is_command_window_timed_out(self):
-        """ Only checks if the self.__current_command is outside execute window
+        """ Checks if the self.__current_command is outside execute window, or reached one of its stop conditions
         :return:
         """
+        if self.__stop_condition_reached:
+            return True
         now = time.time()
         time_diff = now - self.__current_command["start_timestamp"]
+        if self.__effective_window:
+            if time_diff > _EFFECTIVE_WINDOW_WALL_FACTOR * self.__command_window:
+                return True
+            return self.effective_time > self.__command_window
         return time_diff > self.__command_window
 
     def get_commands_and_test_info(self, encode: str = 'ascii') -> typing.Tuple[bytes, bytes, str, str]:
@@ -53,10 +259,12 @@ class CommandFactory:
         """
         self.__check_and_refill_the_queue()
 
-        # verify the timestamp first
+        # verify the timestamp and the stop conditions first
         if self.is_command_window_timed_out:
-            self.__current_command = self.__cmd_queue.pop()
-            self.__current_command["start_timestamp"] = time.time()
+            if self.__stop_condition_reached:
+                self.__logger.info(f"{self.__current_command['codename']} {self.__stop_condition_reached}, "
+                                   f"rotating to the next benchmark")
+            self.__select_next_command()
 
         # Following Pablo approach we need to make the process detach from the terminal
         # 'nohup exec_code+...' &\r\n'
@@ -78,3 +286,15 @@ class CommandFactory:
         """
         cmd_kill = self.__current_command["killcmd"].replace("nohup", "")
         return f"{cmd_kill} \r\n".encode(encoding='ascii')
+
+    @property
+    def current_codename(self) -> str:
+        """ Get the codename of the current command
+        """
+        return self.__current_command["codename"]
+
+    @property
+    def benchmark_breakers(self) -> dict:
+        """ State of the crash-loop breaker of each benchmark
+        """
+        return {codename: breaker.state.name for codename, breaker in self.__breakers.items()}
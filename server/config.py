@@ -0,0 +1,294 @@
+"""
+Typed configuration of the machines (YAML) and benchmarks (JSON).
+All the files are validated before any socket is bound or any switch is touched,
+and the compiled configuration can be cached (JSON), keyed by the files mtime/size and content hash.
+"""
+import dataclasses
+import hashlib
+import json
+import os
+import stat
+import typing
+
+import yaml
+
+from .deduplication import DEFAULT_DEDUP_WINDOW
+from .error_rate_monitor import DEFAULT_RATE_WINDOW
+from .reboot_policy import REBOOT_POLICIES
+
+# Keys accepted on the optional "stop_conditions" dict of each benchmark (JSON files)
+STOP_CONDITIONS = ("target_sdcs", "target_iterations", "max_crashes", "max_ci_width")
+# effective: the command window counts the time the benchmark was running, wall: the time since it was selected
+COMMAND_WINDOW_CLOCKS = ("effective", "wall")
+# Bump it when the dataclasses change, so old caches are ignored
+_CACHE_VERSION = 11
+
+
+class ConfigError(ValueError):
+    """ Invalid machine or benchmark configuration, the message contains all the problems found """
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class BenchmarkConfig:
+    """ One entry of a benchmark JSON file """
+    exec: str
+    killcmd: str
+    codename: str
+    header: str
+    stop_conditions: dict = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class MachineConfig:
+    """ Content of a machine YAML file, with the benchmarks of its JSON files """
+    cfg_file: str
+    ip: str
+    hostname: str
+    username: str
+    password: str
+    power_switch_ip: str
+    power_switch_port: int
+    power_switch_model: str
+    boot_waiting_time: float
+    max_timeout_time: float
+    receive_port: int
+    json_files: tuple
+    benchmarks: tuple
+    telnet_port: int = 23
+    disable_os_soft_reboot: bool = False
+    rate_window: float = DEFAULT_RATE_WINDOW
+    beam_flux: typing.Optional[float] = None
+    boot_heartbeat: bool = False
+    dedup_window: float = DEFAULT_DEDUP_WINDOW
+    reorder_window: typing.Optional[float] = None
+    capture_dir: typing.Optional[str] = None
+    artifact_paths: tuple = ()
+    reboot_policy: str = "fixed"
+    receive_timestamps: bool = False
+    max_err_rate: typing.Optional[float] = None
+    max_it_rate: typing.Optional[float] = None
+    command_window_clock: str = "effective"
+    # Crash loop: crash_loop_reboots power cycles in crash_loop_window seconds, each one without crash_loop_uptime
+    # seconds of #IT since the previous power cycle
+    crash_loop_reboots: int = 6
+    crash_loop_window: float = 3600
+    crash_loop_uptime: float = 300
+
+
+# Expected type of each YAML/JSON key, int is accepted where a float is expected
+_MACHINE_KEY_TYPES = {
+    "ip": str, "hostname": str, "username": str, "password": str, "power_switch_ip": str,
+    "power_switch_port": int, "power_switch_model": str, "boot_waiting_time": float, "max_timeout_time": float,
+    "receive_port": int, "json_files": list, "telnet_port": int, "disable_os_soft_reboot": bool,
+    "rate_window": float, "beam_flux": float, "boot_heartbeat": bool, "dedup_window": float, "reorder_window": float,
+    "capture_dir": str, "artifact_paths": list, "reboot_policy": str,
+    "receive_timestamps": bool, "max_err_rate": float, "max_it_rate": float, "command_window_clock": str,
+    "crash_loop_reboots": int, "crash_loop_window": float, "crash_loop_uptime": float,
+}
+_OPTIONAL_MACHINE_KEYS = {"telnet_port", "disable_os_soft_reboot", "rate_window", "beam_flux", "boot_heartbeat",
+                          "dedup_window", "reorder_window", "capture_dir", "artifact_paths", "reboot_policy",
+                          "receive_timestamps", "max_err_rate", "max_it_rate", "command_window_clock",
+                          "crash_loop_reboots", "crash_loop_window", "crash_loop_uptime"}
+_BENCHMARK_KEY_TYPES = {"exec": str, "killcmd": str, "codename": str, "header": str, "stop_conditions": dict}
+_OPTIONAL_BENCHMARK_KEYS = {"stop_conditions"}
+_POWER_SWITCH_MODELS = ("default", "lindy")
+
+
+def _check_keys(data: dict, key_types: dict, optional_keys: set, source: str) -> typing.List[str]:
+    """ Return the list of problems of a YAML/JSON dict """
+    if not isinstance(data, dict):
+        return [f"{source}: expected a dict, found {type(data).__name__}"]
+    errors = list()
+    for key in data.keys() - key_types.keys():
+        errors.append(f"{source}: unknown key '{key}'")
+    for key, key_type in key_types.items():
+        if key not in data:
+            if key not in optional_keys:
+                errors.append(f"{source}: missing key '{key}'")
+            continue
+        value = data[key]
+        accepted_types = (int, float) if key_type is float else key_type
+        # bool is a subclass of int, it is not accepted as a number
+        if not isinstance(value, accepted_types) or (key_type is not bool and isinstance(value, bool)):
+            errors.append(f"{source}: '{key}' must be {key_type.__name__}, found {value!r}")
+    return errors
+
+
+def load_benchmarks(json_file: str) -> typing.Tuple[BenchmarkConfig, ...]:
+    """ Load and validate a benchmark JSON file
+    :param json_file: path to the JSON file, it contains a list of benchmarks
+    :return: tuple of BenchmarkConfig
+    :raise ConfigError: if the file is missing or invalid
+    """
+    try:
+        with open(json_file) as fp:
+            entries = json.load(fp)
+    except (OSError, json.JSONDecodeError) as error:
+        raise ConfigError(f"{json_file}: {error}")
+    if not isinstance(entries, list):
+        raise ConfigError(f"{json_file}: expected a list of benchmarks")
+    errors, benchmarks = list(), list()
+    for i, entry in enumerate(entries):
+        source = f"{json_file}[{i}]"
+        entry_errors = _check_keys(data=entry, key_types=_BENCHMARK_KEY_TYPES, optional_keys=_OPTIONAL_BENCHMARK_KEYS,
+                                   source=source)
+        if not entry_errors:
+            unknown_conditions = set(entry.get("stop_conditions", dict())) - set(STOP_CONDITIONS)
+            if unknown_conditions:
+                entry_errors.append(f"{source}: unknown stop conditions {sorted(unknown_conditions)}, "
+                                    f"the possible ones are {STOP_CONDITIONS}")
+        errors.extend(entry_errors)
+        if not entry_errors:
+            benchmarks.append(BenchmarkConfig(**entry))
+    if errors:
+        raise ConfigError("\n".join(errors))
+    return tuple(benchmarks)
+
+
+def load_machine_config(cfg_file: str) -> MachineConfig:
+    """ Load and validate a machine YAML file and its benchmark JSON files
+    :param cfg_file: path to the machine YAML file
+    :return: MachineConfig
+    :raise ConfigError: with all the problems found on the files
+    """
+    try:
+        with open(cfg_file, 'r') as fp:
+            machine_parameters = yaml.load(fp, Loader=yaml.SafeLoader)
+    except (OSError, yaml.YAMLError) as error:
+        raise ConfigError(f"{cfg_file}: {error}")
+    errors = _check_keys(data=machine_parameters, key_types=_MACHINE_KEY_TYPES, optional_keys=_OPTIONAL_MACHINE_KEYS,
+                         source=cfg_file)
+    if errors:
+        raise ConfigError("\n".join(errors))
+    if machine_parameters["power_switch_model"] not in _POWER_SWITCH_MODELS:
+        errors.append(f"{cfg_file}: power_switch_model must be one of {_POWER_SWITCH_MODELS}")
+    if machine_parameters.get("reboot_policy", "fixed") not in REBOOT_POLICIES:
+        errors.append(f"{cfg_file}: reboot_policy must be one of {tuple(REBOOT_POLICIES)}")
+    if machine_parameters.get("command_window_clock", "effective") not in COMMAND_WINDOW_CLOCKS:
+        errors.append(f"{cfg_file}: command_window_clock must be one of {COMMAND_WINDOW_CLOCKS}")
+    for positive_key in ("max_err_rate", "max_it_rate", "crash_loop_reboots", "crash_loop_window",
+                         "crash_loop_uptime"):
+        if machine_parameters.get(positive_key, 1) <= 0:
+            errors.append(f"{cfg_file}: {positive_key} must be positive")
+    if not machine_parameters["json_files"]:
+        errors.append(f"{cfg_file}: json_files is empty")
+    if not all(isinstance(path, str) and path for path in machine_parameters.get("artifact_paths", [])):
+        errors.append(f"{cfg_file}: artifact_paths must be a list of remote paths")
+    benchmarks = list()
+    for json_file in machine_parameters["json_files"]:
+        try:
+            benchmarks.extend(load_benchmarks(json_file=json_file))
+        except ConfigError as error:
+            errors.append(str(error))
+    if errors:
+        raise ConfigError("\n".join(errors))
+    machine_parameters["json_files"] = tuple(machine_parameters["json_files"])
+    machine_parameters["artifact_paths"] = tuple(machine_parameters.get("artifact_paths", ()))
+    return MachineConfig(cfg_file=cfg_file, benchmarks=tuple(benchmarks), **machine_parameters)
+
+
+def check_fleet_duplicates(machine_configs: typing.List[MachineConfig]) -> typing.List[str]:
+    """ Two machines cannot share the receive port, the IP, the hostname (log directory) or a switch outlet
+    :param machine_configs: list of MachineConfig
+    :return: list of problems
+    """
+    unique_fields = {
+        "receive_port": lambda config: config.receive_port,
+        "ip": lambda config: config.ip,
+        "hostname": lambda config: config.hostname,
+        "power switch outlet": lambda config: f"{config.power_switch_ip}:{config.power_switch_port}",
+    }
+    errors = list()
+    for field_name, get_value in unique_fields.items():
+        owners = dict()
+        for config in machine_configs:
+            owners.setdefault(get_value(config), list()).append(config.cfg_file)
+        for value, cfg_files in owners.items():
+            if len(cfg_files) > 1:
+                errors.append(f"duplicate {field_name} {value} on {cfg_files}")
+    return errors
+
+
+def _file_fingerprint(path: str) -> typing.Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _file_hash(path: str) -> str:
+    with open(path, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def _machine_config_from_dict(data: dict) -> MachineConfig:
+    """ Rebuild a MachineConfig from dataclasses.asdict, JSON turns the tuples into lists """
+    benchmarks = tuple(BenchmarkConfig(**benchmark) for benchmark in data["benchmarks"])
+    return MachineConfig(**dict(data, benchmarks=benchmarks, json_files=tuple(data["json_files"]),
+                                artifact_paths=tuple(data["artifact_paths"])))
+
+
+def _load_cache(cache_file: str, cfg_files: list) -> typing.Optional[typing.List[MachineConfig]]:
+    """ Return the cached configuration if none of its files changed.
+    Any problem with the cache is a miss, the configuration is parsed again
+    """
+    try:
+        with open(cache_file) as fp:
+            # A cache that another user could have written is not trusted
+            cache_stat = os.fstat(fp.fileno())
+            if cache_stat.st_uid != os.getuid() or cache_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return None
+            cache = json.load(fp)
+        if not isinstance(cache, dict):
+            return None
+        if cache.get("version") != _CACHE_VERSION or cache.get("cfg_files") != cfg_files:
+            return None
+        for path, (fingerprint, content_hash) in cache["files"].items():
+            # The hash is only computed when the mtime/size changed (ex: the file was touched or copied)
+            if _file_fingerprint(path) != tuple(fingerprint) and _file_hash(path) != content_hash:
+                return None
+        return [_machine_config_from_dict(data=data) for data in cache["machine_configs"]]
+    except Exception:
+        return None
+
+
+def _save_cache(cache_file: str, cfg_files: list, machine_configs: typing.List[MachineConfig]) -> None:
+    source_files = list(cfg_files)
+    for config in machine_configs:
+        source_files.extend(config.json_files)
+    cache = {
+        "version": _CACHE_VERSION,
+        "cfg_files": cfg_files,
+        "files": {path: (_file_fingerprint(path), _file_hash(path)) for path in source_files},
+        "machine_configs": [dataclasses.asdict(config) for config in machine_configs],
+    }
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fp:
+        json.dump(cache, fp)
+    os.replace(tmp_file, cache_file)
+
+
+def load_fleet_config(cfg_files: list, cache_file: str = None) -> typing.List[MachineConfig]:
+    """ Load and validate all the machines before starting any of them
+    :param cfg_files: list of machine YAML files
+    :param cache_file: optional path of the compiled configuration cache
+    :return: list of MachineConfig in the same order as cfg_files
+    :raise ConfigError: with all the problems found on all the files
+    """
+    cfg_files = list(cfg_files)
+    if cache_file:
+        machine_configs = _load_cache(cache_file=cache_file, cfg_files=cfg_files)
+        if machine_configs is not None:
+            return machine_configs
+
+    errors, machine_configs = list(), list()
+    for cfg_file in cfg_files:
+        try:
+            machine_configs.append(load_machine_config(cfg_file=cfg_file))
+        except ConfigError as error:
+            errors.append(str(error))
+    errors.extend(check_fleet_duplicates(machine_configs=machine_configs))
+    if errors:
+        raise ConfigError("\n".join(errors))
+
+    if cache_file:
+        _save_cache(cache_file=cache_file, cfg_files=cfg_files, machine_configs=machine_configs)
+    return machine_configs
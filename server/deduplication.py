@@ -0,0 +1,154 @@
+"""
+Ingest-time deduplication and reordering of the DUT messages.
+UDP can deliver a datagram twice, and libLogHelper retransmits a message after its own timeout,
+so the same #SDC line could be counted twice on the final analysis.
+MessageDeduplicator drops a message equal to one received in the last seconds. It is opt-in: without a sequence number
+a retransmission cannot be told apart from a real repeat (ex: the same #ERR detail on consecutive iterations),
+so the Machine writes each dropped message on a #SERVER_DUPLICATE line.
+ReorderBuffer puts back in order the messages that carry a sequence number (#SEQ:<n> prefix), and drops the
+repeated sequence numbers, which are always retransmissions.
+Both are O(1) per message.
+"""
+import collections
+import typing
+
+# Time in seconds that a message digest is remembered, 0 disables the deduplication
+DEFAULT_DEDUP_WINDOW = 0.0
+# Server line with the content of a message dropped by MessageDeduplicator
+DUPLICATE_LINE_PREFIX = "#SERVER_DUPLICATE"
+# Maximum number of digests remembered for each DUT
+DEFAULT_DEDUP_MAX_ENTRIES = 4096
+# Optional prefix of the message content (after the ECC byte) with the sequence number: #SEQ:<n> <message>
+SEQUENCE_PREFIX = b"#SEQ:"
+# Maximum number of messages waiting for a missing sequence number
+DEFAULT_REORDER_MAX_HELD = 256
+
+
+class MessageDeduplicator:
+    """ Remember the digests of the messages received on the last window seconds """
+
+    def __init__(self, window: float = DEFAULT_DEDUP_WINDOW, max_entries: int = DEFAULT_DEDUP_MAX_ENTRIES):
+        """
+        :param window: time in seconds that a message is remembered
+        :param max_entries: maximum number of digests remembered, the oldest are forgotten first
+        """
+        self.__window = window
+        self.__max_entries = max_entries
+        # digest -> time it was received, and the same entries in the arrival order to expire them
+        self.__seen = dict()
+        self.__arrivals = collections.deque()
+        self.duplicates = 0
+
+    def is_duplicate(self, message: typing.Union[bytes, bytearray, memoryview], now: float) -> bool:
+        """ Check if the message was already received on the window, and remember it
+        :param message: message as received, including the ECC byte
+        :param now: time.monotonic of the reception
+        :return: True if the message is a duplicate and must be dropped
+        """
+        arrivals, seen = self.__arrivals, self.__seen
+        while arrivals and (now - arrivals[0][0] > self.__window or len(arrivals) >= self.__max_entries):
+            arrival_time, digest = arrivals.popleft()
+            if seen.get(digest) == arrival_time:
+                del seen[digest]
+        digest = hash(bytes(message))
+        if digest in seen:
+            self.duplicates += 1
+            return True
+        seen[digest] = now
+        arrivals.append((now, digest))
+        return False
+
+
+def split_sequence_number(message: bytes) -> typing.Tuple[typing.Optional[int], bytes]:
+    """ Remove the #SEQ:<n> prefix of a message
+    :param message: message as received, including the ECC byte
+    :return: sequence number (None if the message has no prefix) and the message without the prefix
+    """
+    if not message.startswith(SEQUENCE_PREFIX, 1):
+        return None, message
+    end = message.find(b" ", len(SEQUENCE_PREFIX) + 1)
+    try:
+        sequence = int(message[len(SEQUENCE_PREFIX) + 1:end if end != -1 else len(message)])
+    except ValueError:
+        return None, message
+    return sequence, message[:1] + (message[end + 1:] if end != -1 else b"")
+
+
+class ReorderBuffer:
+    """ Release the messages in the order of their sequence numbers.
+    A message that arrives before the previous ones waits up to window seconds for them,
+    after that (or when too many messages are waiting) the missing ones are given up as lost.
+    The messages without sequence number are released right away
+    """
+
+    def __init__(self, window: float, max_held: int = DEFAULT_REORDER_MAX_HELD):
+        """
+        :param window: maximum time in seconds that a message waits for the missing ones
+        :param max_held: maximum number of messages waiting
+        """
+        self.__window = window
+        self.__max_held = max_held
+        # sequence number -> message without the prefix
+        self.__held = dict()
+        self.__next_sequence = None
+        # time.monotonic when the oldest missing sequence number started to be waited for
+        self.__gap_start_time = None
+        self.duplicates = 0
+        self.reordered = 0
+        self.lost = 0
+
+    def __release(self, now: float, force: bool = False) -> list:
+        released = list()
+        while self.__held:
+            if self.__next_sequence in self.__held:
+                released.append(self.__held.pop(self.__next_sequence))
+                self.__next_sequence += 1
+                self.__gap_start_time = None
+                continue
+            if self.__gap_start_time is None:
+                self.__gap_start_time = now
+            if force or now - self.__gap_start_time > self.__window or len(self.__held) > self.__max_held:
+                # Give up on the missing messages
+                first_held = min(self.__held)
+                self.lost += first_held - self.__next_sequence
+                self.__next_sequence = first_held
+                self.__gap_start_time = now
+                continue
+            break
+        return released
+
+    def push(self, message: bytes, now: float) -> list:
+        """ Add a received message
+        :param message: message as received, including the ECC byte
+        :param now: time.monotonic of the reception
+        :return: list of messages (without the prefix) that can be processed now, in order
+        """
+        sequence, message = split_sequence_number(message=message)
+        if sequence is None:
+            return self.__release(now=now) + [message]
+        if self.__next_sequence is None:
+            self.__next_sequence = sequence
+        if sequence < self.__next_sequence or sequence in self.__held:
+            self.duplicates += 1
+            return self.__release(now=now)
+        if sequence != self.__next_sequence:
+            self.reordered += 1
+        self.__held[sequence] = message
+        return self.__release(now=now)
+
+    def flush(self, now: float) -> list:
+        """ Release all the waiting messages, ex: before a reboot
+        :param now: time.monotonic
+        :return: list of messages in order
+        """
+        return self.__release(now=now, force=True)
+
+    def reset(self) -> None:
+        """ The app was restarted, its sequence numbers start again """
+        self.__held.clear()
+        self.__next_sequence = None
+        self.__gap_start_time = None
+
+    @property
+    def held(self) -> int:
+        return len(self.__held)
@@ -1,8 +1,15 @@
 """
 Module to log the info received from the devices
 """
+import collections
 import enum
+import itertools
 import logging
+import os
+import struct
+import threading
+import time
+import typing
 from datetime import datetime
 
 
@@ -11,6 +18,7 @@ class EndStatus(enum.Enum):
     SOFT_APP_REBOOT = "#SERVER_DUE:soft APP reboot"
     SOFT_OS_REBOOT = "#SERVER_DUE:soft OS reboot"
     HARD_REBOOT = "#SERVER_DUE:power cycle"
+    BEAM_PAUSE = "#SERVER_DUE:beam pause"
     UNKNOWN = "#SERVER_UNKNOWN"
 
     def __str__(self):
@@ -20,45 +28,221 @@ class EndStatus(enum.Enum):
         return str(self)
 
 
+# First byte of every DUT message, on file_writer defined as: #define ECC_ENABLED 0xE, #define ECC_DISABLED 0xD
+ECC_STATUS_VALUES = {0xD: "OFF", 0xE: "ON"}
+# Open DUT log files shared by all the machines of the process, see set_max_open_log_files
+DEFAULT_MAX_OPEN_LOG_FILES = 128
+# A log file that receives nothing for this time is closed, it is reopened when the next message arrives
+DEFAULT_LOG_FILE_IDLE_TIME = 300.0
+# Receive timestamps sidecar ({log file}.ts): the magic, then the time.time_ns and time.monotonic_ns
+# of the log creation, then one record per message with its time.monotonic_ns and the offset of its line on the log
+RECEIVE_TIMESTAMPS_SUFFIX = ".ts"
+_RECEIVE_TIMESTAMPS_MAGIC = b"RXTS0001"
+_RECEIVE_TIMESTAMPS_HEADER = struct.Struct("<qq")
+_RECEIVE_TIMESTAMP_RECORD = struct.Struct("<QQ")
+
+
+class LogFileManager:
+    """ Budget of open DUT log files shared by all the machines.
+    The files are kept open in an LRU order, when the budget is reached the least recently written file
+    is flushed and closed. A closed file is reopened in append mode on the next write, so the messages
+    keep their order. Each file must have a single writer (its DUTLogging object)
+    """
+    # Interval between the searches for idle files
+    __IDLE_CHECK_INTERVAL = 10.0
+
+    def __init__(self, max_open_files: int = DEFAULT_MAX_OPEN_LOG_FILES,
+                 idle_time: float = DEFAULT_LOG_FILE_IDLE_TIME):
+        """
+        :param max_open_files: maximum number of log files open at the same time
+        :param idle_time: time in seconds without writes before a file is closed
+        """
+        if max_open_files < 1:
+            raise ValueError(f"max_open_files must be at least 1, found {max_open_files}")
+        self.__max_open_files = max_open_files
+        self.__idle_time = idle_time
+        self.__lock = threading.Lock()
+        # path -> [file object, time.monotonic of the last write], the first item is the least recently written
+        self.__open_files = collections.OrderedDict()
+        self.__last_idle_check_time = time.monotonic()
+        self.__opens = 0
+        self.__evictions = 0
+
+    def __str__(self) -> str:
+        return f"LogFileManager OPEN:{len(self.__open_files)}/{self.__max_open_files} " \
+               f"OPENS:{self.__opens} EVICTIONS:{self.__evictions}"
+
+    def __close_least_recent(self) -> None:
+        _, (log_file, _) = self.__open_files.popitem(last=False)
+        log_file.close()
+
+    def __close_idle_files(self, now: float) -> None:
+        self.__last_idle_check_time = now
+        while self.__open_files:
+            _, (_, last_write_time) = next(iter(self.__open_files.items()))
+            if now - last_write_time < self.__idle_time:
+                break
+            self.__close_least_recent()
+
+    def write(self, path: str, data: typing.Union[bytes, memoryview], end_line: bool = False,
+              now: float = None) -> None:
+        """ Write on the log file, opening it if it was closed
+        :param path: log file path
+        :param data: content to write
+        :param end_line: add a new line after the content
+        :param now: time.monotonic timestamp of the write
+        :raise OSError: if the file cannot be opened
+        """
+        now = time.monotonic() if now is None else now
+        with self.__lock:
+            entry = self.__open_files.get(path)
+            if entry is None:
+                if now - self.__last_idle_check_time > self.__IDLE_CHECK_INTERVAL:
+                    self.__close_idle_files(now=now)
+                while len(self.__open_files) >= self.__max_open_files:
+                    self.__close_least_recent()
+                    self.__evictions += 1
+                entry = self.__open_files[path] = [open(path, "ab"), now]
+                self.__opens += 1
+            else:
+                self.__open_files.move_to_end(path)
+                entry[1] = now
+            entry[0].write(data)
+            if end_line:
+                entry[0].write(b"\n")
+
+    def flush(self, path: str) -> None:
+        """ Write the buffered content of the file to the disk, and close the files that are idle """
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__open_files.get(path)
+            if entry:
+                entry[0].flush()
+            if now - self.__last_idle_check_time > self.__IDLE_CHECK_INTERVAL:
+                self.__close_idle_files(now=now)
+
+    def close(self, path: str) -> None:
+        """ Close the file if it is open """
+        with self.__lock:
+            entry = self.__open_files.pop(path, None)
+            if entry:
+                entry[0].close()
+
+    def set_max_open_files(self, max_open_files: int) -> None:
+        if max_open_files < 1:
+            raise ValueError(f"max_open_files must be at least 1, found {max_open_files}")
+        with self.__lock:
+            self.__max_open_files = max_open_files
+            while len(self.__open_files) > self.__max_open_files:
+                self.__close_least_recent()
+                self.__evictions += 1
+
+    @property
+    def open_files(self) -> int:
+        return len(self.__open_files)
+
+    @property
+    def stats(self) -> dict:
+        return {"open_files": len(self.__open_files), "max_open_files": self.__max_open_files,
+                "opens": self.__opens, "evictions": self.__evictions}
+
+
+# Shared by all the DUTLogging objects of the process
+_LOG_FILE_MANAGER = LogFileManager()
+
+
+def set_max_open_log_files(max_open_files: int) -> None:
+    """ Set the budget of open DUT log files of this process, shared by all the machines
+    :param max_open_files: maximum number of log files open at the same time
+    """
+    _LOG_FILE_MANAGER.set_max_open_files(max_open_files=max_open_files)
+
+
+def log_file_manager_stats() -> dict:
+    """ Open files, budget, number of opens and evictions of the shared LogFileManager """
+    return _LOG_FILE_MANAGER.stats
+
+
 class DUTLogging:
     """ Device Under Test (DUT) logging class.
     This class will replace the local log procedure that
     each device used to perform in the past.
+    The messages are written as received, in binary mode. The files are stored on
+    {log_dir}/{date}/{test_name}/ and their handles are managed by a LogFileManager
     """
+    __ECC_VALUES = ECC_STATUS_VALUES
+    # Maximum time in seconds that a message stays in the file buffer
+    __FLUSH_INTERVAL = 1.0
 
-    def __init__(self, log_dir: str, test_name: str, test_header: str, hostname: str, logger_name: str):
+    def __init__(self, log_dir: str, test_name: str, test_header: str, hostname: str, logger_name: str,
+                 file_manager: LogFileManager = None, receive_timestamps: bool = False):
         """ DUTLogging create the log file and writes the header on the first line
-        :param log_dir: directory of the logfile
+        :param log_dir: directory of the DUT logs, the file goes to a date/test_name subdirectory
         :param test_name: Name of the test that will be performed, ex: cuda_lava_fp16, zedboard_lenet_int8, etc.
         :param test_header: Specific characteristics of the test, extracted from the configuration files
         :param hostname: Device hostname
+        :param file_manager: LogFileManager of the file handles, default is the one shared by the process
+        :param receive_timestamps: write the receive time of each message on a sidecar file, see read_receive_timestamps
         """
         self.__log_dir = log_dir
         self.__test_name = test_name
         self.__test_header = test_header
         self.__hostname = hostname
         self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__file_manager = _LOG_FILE_MANAGER if file_manager is None else file_manager
         # Create the file when the first message arrives
         self.__filename = None
+        self.__last_flush_time = 0.0
+        # Records of the sidecar file waiting for the next flush, and the offset of the next line on the log
+        self.__receive_timestamps = bytearray() if receive_timestamps else None
+        self.__log_offset = 0
 
     def __create_file_if_does_not_exist(self, ecc_status: str):
         if self.__filename is None:
             # log example: 2021_11_15_22_08_25_cuda_trip_half_lava_ECC_OFF_fernando.log
             date = datetime.today()
             date_fmt = date.strftime('%Y_%m_%d_%H_%M_%S')
-            log_filename = f"{self.__log_dir}/{date_fmt}_{self.__test_name}_ECC_{ecc_status}_{self.__hostname}.log"
+            # One directory per day and test, so no directory grows with the whole campaign
+            shard_dir = f"{self.__log_dir}/{date.strftime('%Y_%m_%d')}/{self.__test_name}"
+            log_filename = f"{shard_dir}/{date_fmt}_{self.__test_name}_ECC_{ecc_status}_{self.__hostname}.log"
             # Writing the header to the file
             try:
-                with open(log_filename, "w") as log_file:
-                    begin_str = f"#SERVER_BEGIN Y:{date.year} M:{date.month} D:{date.day} "
-                    begin_str += f"TIME:{date.hour}:{date.minute}:{date.second}-{date.microsecond}\n"
-                    log_file.write(f"#SERVER_HEADER {self.__test_header}\n")
-                    log_file.write(begin_str)
-                    self.__filename = log_filename
+                os.makedirs(shard_dir, exist_ok=True)
+                log_filename = self.__claim_log_filename(log_filename=log_filename, date_fmt=date_fmt)
+                begin_str = f"#SERVER_BEGIN Y:{date.year} M:{date.month} D:{date.day} "
+                begin_str += f"TIME:{date.hour}:{date.minute}:{date.second}-{date.microsecond}\n"
+                header_str = f"#SERVER_HEADER {self.__test_header}\n"
+                header_bytes = (header_str + begin_str).encode("ascii")
+                self.__file_manager.write(path=log_filename, data=header_bytes)
+                self.__file_manager.flush(path=log_filename)
+                self.__log_offset = len(header_bytes)
+                if self.__receive_timestamps is not None:
+                    self.__receive_timestamps[:] = _RECEIVE_TIMESTAMPS_MAGIC + _RECEIVE_TIMESTAMPS_HEADER.pack(
+                        time.time_ns(), time.monotonic_ns())
+                self.__last_flush_time = time.monotonic()
+                self.__filename = log_filename
             except (OSError, PermissionError):
                 self.__logger.exception(f"Could not create the file {log_filename}")
 
-    def __call__(self, message: bytes, *args, **kwargs) -> None:
+    @staticmethod
+    def __claim_log_filename(log_filename: str, date_fmt: str) -> str:
+        """ Create the empty log file, the name has only one-second resolution and the writes append,
+        so a log created in the same second for the same DUT and test gets a counter after the time
+        (ex: 2021_11_15_22_08_25-1_cuda_trip_half_lava_ECC_OFF_fernando.log) instead of merging with the other one
+        :param log_filename: log file name without the counter
+        :param date_fmt: time on the file name, the counter goes after it
+        :return: the name of the created file
+        """
+        shard_dir, base_name = os.path.split(log_filename)
+        candidate_filename = log_filename
+        for counter in itertools.count(start=1):
+            try:
+                with open(candidate_filename, "xb"):
+                    return candidate_filename
+            except FileExistsError:
+                candidate_filename = os.path.join(shard_dir, base_name.replace(date_fmt, f"{date_fmt}-{counter}", 1))
+
+    def __call__(self, message: typing.Union[bytes, memoryview], receive_ns: int = None, *args, **kwargs) -> None:
         """ Log a message from the DUT
         :param message: a message is composed of
         <first byte ecc status>
@@ -67,28 +251,60 @@ class DUTLogging:
         #define ECC_DISABLED 0xD
         <message of maximum 1023 bytes>
         1 byte for ecc + 1023 maximum message content = 1024 bytes
+        It can be a memoryview of the receive buffer, the content is written without copying or decoding
+        :param receive_ns: time.monotonic_ns when the message was received, only used with receive_timestamps
         """
-        ecc_values = {0xD: "OFF", 0xE: "ON"}
-        ecc_status = ecc_values[message[0]]
-        self.__create_file_if_does_not_exist(ecc_status=ecc_status)
-        message_content = message[1:].decode("ascii")
+        if self.__filename is None:
+            self.__create_file_if_does_not_exist(ecc_status=self.__ECC_VALUES[message[0]])
 
         if self.__filename:
-            with open(self.__filename, "a") as log_file:
-                message_content += "\n" if "\n" not in message_content else ""
-                log_file.write(message_content)
+            now = time.monotonic()
+            end_line = message[-1] != 0x0A
+            self.__file_manager.write(path=self.__filename, data=message[1:], end_line=end_line, now=now)
+            if self.__receive_timestamps is not None:
+                self.__receive_timestamps += _RECEIVE_TIMESTAMP_RECORD.pack(
+                    time.monotonic_ns() if receive_ns is None else receive_ns, self.__log_offset)
+                self.__log_offset += len(message) - 1 + end_line
+            if now - self.__last_flush_time > self.__FLUSH_INTERVAL:
+                self.__flush_files()
+                self.__last_flush_time = now
         else:
             self.__logger.exception("[ERROR in __call__(message) Unable to open file]")
 
+    def write_server_line(self, line: str) -> None:
+        """ Write a server line between the DUT messages (ex: #SERVER_SHED), if the log file was already created
+        :param line: ascii line without the new line
+        """
+        if self.__filename:
+            data = f"{line}\n".encode("ascii")
+            self.__file_manager.write(path=self.__filename, data=data)
+            self.__log_offset += len(data)
+
+    def __flush_files(self) -> None:
+        self.__file_manager.flush(path=self.__filename)
+        if self.__receive_timestamps:
+            # The records are only written on the flushes, there is no sidecar write per message
+            timestamps_filename = self.__filename + RECEIVE_TIMESTAMPS_SUFFIX
+            self.__file_manager.write(path=timestamps_filename, data=self.__receive_timestamps)
+            self.__file_manager.close(path=timestamps_filename)
+            self.__receive_timestamps.clear()
+
+    def flush(self) -> None:
+        """ Write the buffered messages to the log file """
+        if self.__filename:
+            self.__flush_files()
+            self.__last_flush_time = time.monotonic()
+
     def finish_this_dut_log(self, end_status: EndStatus):
         """ Check if the file exists and put an END in the last line
         :param end_status status of the ending of the log EndStatus
         """
         if self.__filename:
-            with open(self.__filename, "a") as log_file:
-                date_fmt = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
-                log_file.write(f"{end_status} TIME:{date_fmt}\n")
-                self.__filename = None
+            date_fmt = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+            self.__file_manager.write(path=self.__filename, data=f"{end_status} TIME:{date_fmt}\n".encode("ascii"))
+            self.__flush_files()
+            self.__file_manager.close(path=self.__filename)
+            self.__filename = None
 
     def __del__(self):
         # If it is not finished it should
@@ -98,3 +314,22 @@ class DUTLogging:
     @property
     def log_filename(self):
         return self.__filename
+
+
+def read_receive_timestamps(log_filename: str) -> typing.List[typing.Tuple[int, int]]:
+    """ Read the receive timestamps sidecar of a DUT log
+    :param log_filename: DUT log file, the sidecar is log_filename + RECEIVE_TIMESTAMPS_SUFFIX
+    :return: list of (offset of the line on the log, receive time as time.time_ns), one per message.
+        The wall-clock time is derived from the monotonic clock, so it is not affected by a clock change
+    :raise ValueError: if the file is not a receive timestamps sidecar
+    """
+    with open(log_filename + RECEIVE_TIMESTAMPS_SUFFIX, "rb") as fp:
+        content = fp.read()
+    header_size = len(_RECEIVE_TIMESTAMPS_MAGIC) + _RECEIVE_TIMESTAMPS_HEADER.size
+    if not content.startswith(_RECEIVE_TIMESTAMPS_MAGIC) or len(content) < header_size:
+        raise ValueError(f"{log_filename}{RECEIVE_TIMESTAMPS_SUFFIX} is not a receive timestamps file")
+    wall_clock_ns, monotonic_ns = _RECEIVE_TIMESTAMPS_HEADER.unpack_from(content, len(_RECEIVE_TIMESTAMPS_MAGIC))
+    # A record cut by an interrupted server is ignored
+    records_size = (len(content) - header_size) // _RECEIVE_TIMESTAMP_RECORD.size * _RECEIVE_TIMESTAMP_RECORD.size
+    return [(offset, wall_clock_ns + receive_ns - monotonic_ns) for receive_ns, offset in
+            _RECEIVE_TIMESTAMP_RECORD.iter_unpack(memoryview(content)[header_size:header_size + records_size])]
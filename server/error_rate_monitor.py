@@ -0,0 +1,174 @@
+"""
+Online aggregation of the DUT messages. The counts are kept in fixed-size ring buffers of time buckets,
+so the rates of the last minutes are always available without post-processing the logs.
+"""
+import math
+import time
+import typing
+
+from .dut_logging import EndStatus
+
+# Default rolling window in seconds, and the resolution of the window
+DEFAULT_RATE_WINDOW = 600
+DEFAULT_RATE_BUCKET = 10
+# The rates are divided by the exposure on the window, at least this many seconds to avoid a division by zero
+_MIN_EXPOSURE = 1.0
+
+# z value for the 95% confidence interval
+_Z_95 = 1.959964
+
+
+def poisson_confidence_interval(count: int, z: float = _Z_95) -> typing.Tuple[float, float]:
+    """ Confidence interval of a Poisson count (Byar's approximation), used for the SDC counts
+    :param count: number of observed events
+    :param z: z value of the interval, default 95%
+    :return: lower and upper limits of the count
+    """
+    lower = 0.0
+    if count > 0:
+        lower = count * (1 - 1 / (9 * count) - z / (3 * math.sqrt(count))) ** 3
+    upper = (count + 1) * (1 - 1 / (9 * (count + 1)) + z / (3 * math.sqrt(count + 1))) ** 3
+    return max(lower, 0.0), upper
+
+
+class RollingCounter:
+    """ Count events on the last window seconds using a ring of time buckets.
+    add is O(1) and total is O(number of buckets)
+    """
+    __slots__ = ("__bucket_seconds", "__counts", "__bucket_ids")
+
+    def __init__(self, window: float = DEFAULT_RATE_WINDOW, bucket: float = DEFAULT_RATE_BUCKET):
+        num_buckets = max(int(math.ceil(window / bucket)), 1)
+        self.__bucket_seconds = bucket
+        self.__counts = [0] * num_buckets
+        # Which bucket (time // bucket) each position of the ring holds
+        self.__bucket_ids = [-1] * num_buckets
+
+    def add(self, now: float, value: int = 1) -> None:
+        bucket_id = int(now // self.__bucket_seconds)
+        position = bucket_id % len(self.__counts)
+        if self.__bucket_ids[position] != bucket_id:
+            self.__bucket_ids[position] = bucket_id
+            self.__counts[position] = 0
+        self.__counts[position] += value
+
+    def total(self, now: float) -> int:
+        oldest_bucket_id = int(now // self.__bucket_seconds) - len(self.__counts)
+        return sum(count for count, bucket_id in zip(self.__counts, self.__bucket_ids) if bucket_id > oldest_bucket_id)
+
+
+class _BenchmarkCounters:
+    """ Rolling counters of a single benchmark (codename) """
+    __slots__ = ("iterations", "sdcs", "errors", "crashes", "exposure", "first_event_time")
+
+    def __init__(self, window: float, bucket: float, now: float):
+        self.iterations = RollingCounter(window=window, bucket=bucket)
+        self.sdcs = RollingCounter(window=window, bucket=bucket)
+        self.errors = RollingCounter(window=window, bucket=bucket)
+        self.crashes = {end_status: RollingCounter(window=window, bucket=bucket)
+                        for end_status in (EndStatus.SOFT_APP_REBOOT, EndStatus.SOFT_OS_REBOOT, EndStatus.HARD_REBOOT)}
+        # Seconds of beam exposure of the benchmark (see CommandFactory), the boot waits and reboots are not counted
+        self.exposure = RollingCounter(window=window, bucket=bucket)
+        self.first_event_time = now
+
+
+class ErrorRateMonitor:
+    """ Per DUT aggregator of iterations, SDCs, errors and crashes, one set of rolling counters per codename.
+    It is fed by the Machine thread, the snapshot can be taken from any thread.
+    """
+
+    def __init__(self, hostname: str, window: float = DEFAULT_RATE_WINDOW, bucket: float = DEFAULT_RATE_BUCKET,
+                 beam_flux: float = None):
+        """
+        :param hostname: DUT hostname
+        :param window: rolling window in seconds
+        :param bucket: resolution of the window in seconds
+        :param beam_flux: particles/cm^2/s, when set the snapshot also has the cross-sections (cm^2)
+        """
+        self.__hostname = hostname
+        self.__window = window
+        self.__bucket = bucket
+        self.__beam_flux = beam_flux
+        self.__benchmarks = dict()
+
+    def __counters(self, codename: str, now: float) -> _BenchmarkCounters:
+        counters = self.__benchmarks.get(codename)
+        if counters is None:
+            counters = _BenchmarkCounters(window=self.__window, bucket=self.__bucket, now=now)
+            self.__benchmarks[codename] = counters
+        return counters
+
+    def record_message(self, connection_type: str, codename: str, now: float = None, exposure: float = 0.0) -> None:
+        """ Count a DUT message
+        :param connection_type: #IT, #SDC, #ERR (the other types are not counted)
+        :param codename: codename of the benchmark running on the DUT
+        :param now: time.monotonic timestamp of the message
+        :param exposure: exposure time in seconds since the previous message (CommandFactory.record_message)
+        """
+        now = time.monotonic() if now is None else now
+        if exposure:
+            self.__counters(codename=codename, now=now).exposure.add(now=now, value=exposure)
+        if connection_type == "#IT":
+            self.__counters(codename=codename, now=now).iterations.add(now=now)
+        elif connection_type == "#SDC":
+            self.__counters(codename=codename, now=now).sdcs.add(now=now)
+        elif connection_type == "#ERR":
+            self.__counters(codename=codename, now=now).errors.add(now=now)
+
+    def record_crash(self, end_status: EndStatus, codename: str, now: float = None) -> None:
+        """ Count a crash, the end_status is the reboot tier that recovered the DUT
+        :param end_status: EndStatus of the log that was closed due to the crash
+        :param codename: codename of the benchmark running on the DUT
+        :param now: time.monotonic timestamp of the crash
+        """
+        now = time.monotonic() if now is None else now
+        counters = self.__counters(codename=codename, now=now)
+        if end_status in counters.crashes:
+            counters.crashes[end_status].add(now=now)
+
+    def snapshot(self, now: float = None) -> dict:
+        """ Counts and rates of each codename on the rolling window.
+        The rates are divided by the exposure of the benchmark on the window, not by the wall time,
+        so a benchmark that was just selected again or that spent the window rebooting is not diluted
+        :param now: time.monotonic timestamp
+        :return: dict codename -> counts and rates
+        """
+        now = time.monotonic() if now is None else now
+        snapshot = dict()
+        for codename, counters in list(self.__benchmarks.items()):
+            # The window is shorter while the benchmark did not run for the full window
+            elapsed = min(max(now - counters.first_event_time, self.__bucket), self.__window)
+            exposure = counters.exposure.total(now=now)
+            rate_time = max(exposure, _MIN_EXPOSURE)
+            iterations, sdcs = counters.iterations.total(now=now), counters.sdcs.total(now=now)
+            sdc_lower, sdc_upper = poisson_confidence_interval(count=sdcs)
+            crashes = {end_status.name: counter.total(now=now) for end_status, counter in counters.crashes.items()}
+            rates = {
+                "hostname": self.__hostname,
+                "window": elapsed,
+                "exposure": exposure,
+                "iterations": iterations,
+                "sdcs": sdcs,
+                "errors": counters.errors.total(now=now),
+                "crashes": crashes,
+                "iterations_per_s": iterations / rate_time,
+                "sdcs_per_s": sdcs / rate_time,
+                "sdcs_per_s_ci95": (sdc_lower / rate_time, sdc_upper / rate_time),
+                "crashes_per_s": sum(crashes.values()) / rate_time,
+                "sdcs_per_iteration": sdcs / iterations if iterations else 0.0,
+            }
+            if self.__beam_flux:
+                fluence = self.__beam_flux * rate_time
+                rates["sdc_cross_section"] = sdcs / fluence
+                rates["crash_cross_section"] = sum(crashes.values()) / fluence
+            snapshot[codename] = rates
+        return snapshot
+
+    def summary(self, now: float = None) -> str:
+        """ One line summary for the server log """
+        parts = list()
+        for codename, rates in self.snapshot(now=now).items():
+            parts.append(f"{codename}: IT/s:{rates['iterations_per_s']:.3g} SDC:{rates['sdcs']} "
+                         f"SDC/s:{rates['sdcs_per_s']:.3g} ERR:{rates['errors']} CRASHES:{rates['crashes']} "
+                         f"EXPOSURE:{rates['exposure']:.0f}/{rates['window']:.0f}s")
+        return " | ".join(parts)
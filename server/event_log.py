@@ -0,0 +1,78 @@
+"""
+Structured server event log. Each event is written as one JSON object per line,
+so the reboot and power switch events can be loaded directly by the analysis tools
+(for example pandas.read_json(path, lines=True)) without parsing the human log.
+"""
+import enum
+import json
+import logging
+import time
+
+from .logger_formatter import attach_queue_listener
+
+# All the events are sent to this logger, it does not propagate to the human log
+EVENT_LOGGER_NAME = "server_events"
+
+_event_logger = logging.getLogger(EVENT_LOGGER_NAME)
+_event_logger.propagate = False
+_event_logger.addHandler(logging.NullHandler())
+
+
+class ServerEvent(enum.Enum):
+    """ Types of events written on the event log """
+    # A reboot tier was executed, tier is the EndStatus name
+    REBOOT = "reboot"
+    # Result of waiting for the DUT to boot
+    BOOT_WAIT = "boot_wait"
+    # A power switch command (ON or OFF)
+    POWER_SWITCH = "power_switch"
+    # A circuit breaker (DUT or benchmark) changed its state
+    CIRCUIT_BREAKER = "circuit_breaker"
+    # The beam was interrupted (paused=True) or it is back (paused=False)
+    BEAM_PAUSE = "beam_pause"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+def event_from_record(record: logging.LogRecord) -> dict:
+    """ Event dict (timestamp, event type and its fields) of a record of the event logger """
+    event = {"timestamp": record.created, "event": record.msg}
+    event.update(getattr(record, "event_fields", dict()))
+    return event
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """ Format an event record as a single JSON line """
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(event_from_record(record), default=str)
+
+
+def event_logging_setup(event_log_file: str) -> logging.Logger:
+    """ Configure the JSON lines event log. Like the human log, the events
+    are written by a listener thread, so the Machine threads never wait for the file.
+    The events are rare (reboots, switch commands), each one is flushed to the file as soon as it is written,
+    so they are not lost if the server is killed
+    :param event_log_file: path to the JSON lines file
+    :return: the event logger
+    """
+    file_handler = logging.FileHandler(event_log_file, mode='a')
+    file_handler.setFormatter(JsonLinesFormatter())
+    _event_logger.setLevel(logging.INFO)
+    attach_queue_listener(logger_name=EVENT_LOGGER_NAME, handlers=[file_handler])
+    return _event_logger
+
+
+def log_server_event(event: ServerEvent, failed: bool = False, **fields) -> None:
+    """ Log a structured event. If event_logging_setup was not called, the event is discarded
+    :param event: ServerEvent type
+    :param failed: True if the event represents a failure, it is logged with the WARNING level
+    :param fields: event attributes, for example hostname, tier, counter, status and duration
+    """
+    _event_logger.log(logging.WARNING if failed else logging.INFO, event.value, extra={"event_fields": fields})
+
+
+def elapsed_since(start_time: float) -> float:
+    """ Duration in seconds since start_time (taken from time.monotonic) """
+    return round(time.monotonic() - start_time, 6)
@@ -0,0 +1,418 @@
+"""
+Federation of several servers (one per control host) with a central aggregator.
+Each server runs a FederationClient that streams its server events and a compact metrics snapshot of its machines
+to the aggregator, one JSON object per line over TCP. The events are numbered and kept on a bounded local buffer
+until the aggregator acknowledges them, so a disconnected server replays them when the connection is back.
+The metrics are not buffered, only the last snapshot matters.
+The FederationAggregator keeps the fleet view of all the instances, the rolled-up SDC/iteration/reboot counts,
+the hostname -> instance index and the combined event index (events.jsonl), which is reloaded on a restart.
+
+Usage (from the repository root):
+    python -m server.federation aggregator --port 9500 --output-dir federation/
+    python -m server.federation status 127.0.0.1:9500
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+import typing
+import uuid
+
+from .event_log import EVENT_LOGGER_NAME, event_from_record
+
+DEFAULT_FEDERATION_PORT = 9500
+# Interval between the metrics snapshots sent by each server
+DEFAULT_METRICS_INTERVAL = 10.0
+# Events kept while the aggregator does not acknowledge them, the oldest are dropped first
+DEFAULT_MAX_BUFFERED_EVENTS = 100000
+_CONNECT_TIMEOUT = 5
+_MAX_RECONNECT_DELAY = 30
+_POLL_INTERVAL = 0.2
+_EVENTS_FILE = "events.jsonl"
+
+
+def _split_address(address: str) -> typing.Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def compact_metrics(machine_metrics: dict) -> dict:
+    """ Fields of the Machine metrics sent to the aggregator """
+    rates = machine_metrics.get("rates", dict())
+    return {
+        "hostname": machine_metrics["hostname"],
+        "codename": machine_metrics["codename"],
+        "paused": machine_metrics.get("paused", False),
+        "received_messages": machine_metrics["received_messages"],
+        "last_message_age": machine_metrics["last_message_age"],
+        "successful_reboots": machine_metrics["successful_reboots"],
+        "iterations": sum(codename_rates["iterations"] for codename_rates in rates.values()),
+        "sdcs": sum(codename_rates["sdcs"] for codename_rates in rates.values()),
+        "dut_breaker": machine_metrics.get("circuit_breakers", dict()).get("dut"),
+    }
+
+
+class FederationClient(threading.Thread):
+    """ Stream the server events and the machine metrics to the aggregator, reconnecting when it is down """
+
+    def __init__(self, aggregator_address: str, instance: str, fleet_state: typing.Callable[[], list],
+                 logger_name: str, metrics_interval: float = DEFAULT_METRICS_INTERVAL,
+                 max_buffered_events: int = DEFAULT_MAX_BUFFERED_EVENTS, forward_server_events: bool = True,
+                 *args, **kwargs):
+        """
+        :param aggregator_address: host:port of the aggregator
+        :param instance: name of this server on the federation, ex: the control host name
+        :param fleet_state: callable that returns the metrics of all the machines
+        :param logger_name: Main logger name to store the logging information
+        :param metrics_interval: time in seconds between the metrics snapshots
+        :param max_buffered_events: events kept while they are not acknowledged
+        :param forward_server_events: send the events of the event logger (see server.event_log)
+        """
+        super(FederationClient, self).__init__(*args, **kwargs)
+        self.__address = _split_address(aggregator_address)
+        self.__instance = instance
+        # The sequence numbers restart with the process, the session tells them apart on the aggregator
+        self.__session = uuid.uuid4().hex
+        self.__fleet_state = fleet_state
+        self.__metrics_interval = metrics_interval
+        self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__lock = threading.Lock()
+        # (seq, JSON line) of the events not acknowledged yet
+        self.__buffer = collections.deque(maxlen=max_buffered_events)
+        self.__next_seq = 1
+        self.__new_events = threading.Event()
+        self.__stop_event = threading.Event()
+        self.__connected = False
+        self.dropped_events = 0
+        self.__event_handler = None
+        if forward_server_events:
+            self.__event_handler = _FederationEventHandler(client=self)
+            event_logger = logging.getLogger(EVENT_LOGGER_NAME)
+            event_logger.setLevel(logging.INFO)
+            event_logger.addHandler(self.__event_handler)
+
+    def __str__(self) -> str:
+        return f"FederationClient {self.__instance} -> {self.__address[0]}:{self.__address[1]}"
+
+    def publish_event(self, event: dict) -> None:
+        """ Buffer an event until the aggregator acknowledges it, it never blocks """
+        with self.__lock:
+            seq = self.__next_seq
+            self.__next_seq += 1
+            if len(self.__buffer) == self.__buffer.maxlen:
+                self.dropped_events += 1
+            line = json.dumps({"kind": "event", "seq": seq, "event": event}, default=str).encode() + b"\n"
+            self.__buffer.append((seq, line))
+        self.__new_events.set()
+
+    def __acknowledge(self, seq: int) -> None:
+        with self.__lock:
+            while self.__buffer and self.__buffer[0][0] <= seq:
+                self.__buffer.popleft()
+
+    def __pending_lines(self, after_seq: int) -> typing.List[typing.Tuple[int, bytes]]:
+        with self.__lock:
+            return [(seq, line) for seq, line in self.__buffer if seq > after_seq]
+
+    def __metrics_line(self) -> bytes:
+        machines = [compact_metrics(machine_metrics) for machine_metrics in self.__fleet_state()]
+        return json.dumps({"kind": "metrics", "timestamp": time.time(), "machines": machines}).encode() + b"\n"
+
+    def __stream(self, connection: socket.socket) -> None:
+        """ Send the events and the metrics until the connection fails or the client stops """
+        reader = connection.makefile("rb")
+        connection.sendall(json.dumps({"kind": "hello", "instance": self.__instance,
+                                       "session": self.__session}).encode() + b"\n")
+        # The aggregator answers with the last event it has from this session, the next ones are replayed
+        sent_seq = json.loads(reader.readline())["seq"]
+        self.__acknowledge(seq=sent_seq)
+        self.__connected = True
+        self.__logger.info(f"{self} connected, replaying {len(self.__pending_lines(after_seq=sent_seq))} events")
+        next_metrics_time = 0.0
+        received = b""
+        while self.__stop_event.is_set() is False:
+            lines = self.__pending_lines(after_seq=sent_seq)
+            if lines:
+                connection.sendall(b"".join(line for _, line in lines))
+                sent_seq = lines[-1][0]
+            if time.monotonic() >= next_metrics_time:
+                next_metrics_time = time.monotonic() + self.__metrics_interval
+                connection.sendall(self.__metrics_line())
+            # The acknowledgements arrive on the same connection
+            if select.select([connection], [], [], 0)[0]:
+                data = connection.recv(65536)
+                if not data:
+                    raise ConnectionResetError("the aggregator closed the connection")
+                received += data
+                *ack_lines, received = received.split(b"\n")
+                if ack_lines:
+                    self.__acknowledge(seq=json.loads(ack_lines[-1])["seq"])
+            self.__new_events.wait(_POLL_INTERVAL)
+            self.__new_events.clear()
+        # Last snapshot before leaving
+        connection.sendall(self.__metrics_line())
+
+    def run(self) -> None:
+        reconnect_delay = 1
+        while self.__stop_event.is_set() is False:
+            try:
+                with socket.create_connection(self.__address, timeout=_CONNECT_TIMEOUT) as connection:
+                    reconnect_delay = 1
+                    self.__stream(connection=connection)
+            except (OSError, ValueError, KeyError) as error:
+                if self.__connected:
+                    self.__logger.error(f"{self} disconnected: {error}, buffering the events")
+                self.__connected = False
+            self.__connected = False
+            self.__stop_event.wait(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, _MAX_RECONNECT_DELAY)
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+        self.__new_events.set()
+        if self.__event_handler:
+            logging.getLogger(EVENT_LOGGER_NAME).removeHandler(self.__event_handler)
+
+    @property
+    def connected(self) -> bool:
+        return self.__connected
+
+    @property
+    def buffered_events(self) -> int:
+        return len(self.__buffer)
+
+
+class _FederationEventHandler(logging.Handler):
+    """ Logging handler of the event logger that passes the events to the federation client """
+
+    def __init__(self, client: FederationClient):
+        super(_FederationEventHandler, self).__init__(level=logging.INFO)
+        self.__client = client
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.__client.publish_event(event_from_record(record))
+
+
+class _AggregatorRequestHandler(socketserver.StreamRequestHandler):
+    def setup(self) -> None:
+        super(_AggregatorRequestHandler, self).setup()
+        self.server.add_connection(self.connection)
+
+    def finish(self) -> None:
+        self.server.remove_connection(self.connection)
+        super(_AggregatorRequestHandler, self).finish()
+
+    def handle(self) -> None:
+        aggregator = self.server.aggregator
+        instance = None
+        try:
+            hello = json.loads(self.rfile.readline())
+            if hello["kind"] == "query":
+                self.wfile.write(json.dumps(aggregator.fleet_view(), default=str).encode() + b"\n")
+                return
+            session = hello["session"]
+            last_seq = aggregator.connect(instance=hello["instance"], session=session)
+            instance = hello["instance"]
+            self.wfile.write(json.dumps({"kind": "ack", "seq": last_seq}).encode() + b"\n")
+            for line in self.rfile:
+                update = json.loads(line)
+                if update["kind"] == "event":
+                    aggregator.record_event(instance=instance, session=session, seq=update["seq"],
+                                            event=update["event"])
+                    self.wfile.write(json.dumps({"kind": "ack", "seq": update["seq"]}).encode() + b"\n")
+                elif update["kind"] == "metrics":
+                    aggregator.record_metrics(instance=instance, timestamp=update["timestamp"],
+                                              machines=update["machines"])
+        except (OSError, ValueError, KeyError) as error:
+            aggregator.logger.error(f"Federation connection from {self.client_address} failed: {error}")
+        finally:
+            if instance is not None:
+                aggregator.disconnect(instance=instance)
+
+
+class _AggregatorTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address: tuple, aggregator: "FederationAggregator"):
+        self.aggregator = aggregator
+        self.__connections = set()
+        self.__connections_lock = threading.Lock()
+        super(_AggregatorTCPServer, self).__init__(server_address, _AggregatorRequestHandler)
+
+    def add_connection(self, connection: socket.socket) -> None:
+        with self.__connections_lock:
+            self.__connections.add(connection)
+
+    def remove_connection(self, connection: socket.socket) -> None:
+        with self.__connections_lock:
+            self.__connections.discard(connection)
+
+    def close_connections(self) -> None:
+        """ The servers notice that the aggregator stopped, and buffer their events """
+        with self.__connections_lock:
+            for connection in self.__connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class FederationAggregator(threading.Thread):
+    """ Receive the updates of all the servers. It has the same stop/join interface as the Machine threads """
+
+    def __init__(self, host: str, port: int, output_dir: str, logger_name: str, *args, **kwargs):
+        """
+        :param host: address to listen
+        :param port: TCP port to listen, 0 for any free port
+        :param output_dir: directory of the combined event index (events.jsonl)
+        :param logger_name: Main logger name to store the logging information
+        """
+        super(FederationAggregator, self).__init__(*args, **kwargs)
+        self.logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__lock = threading.Lock()
+        # instance -> {"connections", "last_update", "machines"}
+        self.__instances = dict()
+        # (instance, session) -> last event seq stored
+        self.__last_seq = dict()
+        self.__event_counts = collections.Counter()
+        self.__reboot_counts = collections.Counter()
+        os.makedirs(output_dir, exist_ok=True)
+        self.__events_file = os.path.join(output_dir, _EVENTS_FILE)
+        self.__load_events()
+        self.__events_fp = open(self.__events_file, "a")
+        self.__tcp_server = _AggregatorTCPServer(server_address=(host, port), aggregator=self)
+
+    def __str__(self) -> str:
+        host, port = self.address
+        return f"FederationAggregator {host}:{port}"
+
+    def __load_events(self) -> None:
+        """ Rebuild the counters and the last seq of each session from the combined event index """
+        if not os.path.isfile(self.__events_file):
+            return
+        with open(self.__events_file) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of an interrupted aggregator
+                    continue
+                self.__count_event(entry)
+                self.__instances.setdefault(entry["instance"], self.__new_instance())
+                self.__last_seq[(entry["instance"], entry["session"])] = entry["seq"]
+
+    @staticmethod
+    def __new_instance() -> dict:
+        return {"connections": 0, "last_update": None, "machines": dict()}
+
+    def __count_event(self, entry: dict) -> None:
+        event = entry["event"]
+        self.__event_counts[event.get("event")] += 1
+        if event.get("event") == "reboot" and event.get("status") == "SUCCESS":
+            self.__reboot_counts[event.get("tier")] += 1
+
+    def connect(self, instance: str, session: str) -> int:
+        """ A server connected, return the last event seq stored for its session """
+        with self.__lock:
+            self.__instances.setdefault(instance, self.__new_instance())["connections"] += 1
+            self.logger.info(f"Federation instance {instance} connected")
+            return self.__last_seq.get((instance, session), 0)
+
+    def disconnect(self, instance: str) -> None:
+        with self.__lock:
+            self.__instances[instance]["connections"] -= 1
+        self.logger.warning(f"Federation instance {instance} disconnected")
+
+    def record_event(self, instance: str, session: str, seq: int, event: dict) -> None:
+        """ Store an event on the combined index, the replayed events already stored are ignored """
+        with self.__lock:
+            if seq <= self.__last_seq.get((instance, session), 0) or self.__events_fp.closed:
+                return
+            self.__last_seq[(instance, session)] = seq
+            entry = {"instance": instance, "session": session, "seq": seq, "event": event}
+            self.__count_event(entry)
+            self.__events_fp.write(json.dumps(entry, default=str) + "\n")
+            self.__events_fp.flush()
+
+    def record_metrics(self, instance: str, timestamp: float, machines: list) -> None:
+        with self.__lock:
+            instance_state = self.__instances.setdefault(instance, self.__new_instance())
+            instance_state["last_update"] = timestamp
+            instance_state["machines"] = {machine["hostname"]: machine for machine in machines}
+
+    def fleet_view(self) -> dict:
+        """ State of all the instances, the rolled-up counts and the hostname -> instance index """
+        with self.__lock:
+            instances, hosts = dict(), dict()
+            totals = {"machines": 0, "iterations": 0, "sdcs": 0, "received_messages": 0,
+                      "successful_reboots": collections.Counter()}
+            for instance, state in sorted(self.__instances.items()):
+                instances[instance] = {"connected": state["connections"] > 0, "last_update": state["last_update"],
+                                       "machines": list(state["machines"].values())}
+                for hostname, machine in state["machines"].items():
+                    hosts[hostname] = instance
+                    totals["machines"] += 1
+                    for field in ("iterations", "sdcs", "received_messages"):
+                        totals[field] += machine[field]
+                    totals["successful_reboots"].update(machine["successful_reboots"])
+            totals["successful_reboots"] = dict(totals["successful_reboots"])
+            return {"instances": instances, "hosts": hosts, "totals": totals,
+                    "events": dict(self.__event_counts), "reboot_events": dict(self.__reboot_counts)}
+
+    def run(self) -> None:
+        self.logger.info(f"Starting {self}")
+        self.__tcp_server.serve_forever(poll_interval=0.5)
+
+    def stop(self) -> None:
+        if self.is_alive():
+            self.__tcp_server.shutdown()
+        self.__tcp_server.server_close()
+        self.__tcp_server.close_connections()
+        with self.__lock:
+            self.__events_fp.close()
+
+    @property
+    def address(self) -> tuple:
+        return self.__tcp_server.server_address[:2]
+
+
+def query_aggregator(aggregator_address: str) -> dict:
+    """ Fleet view of a running aggregator """
+    with socket.create_connection(_split_address(aggregator_address), timeout=_CONNECT_TIMEOUT) as connection:
+        connection.sendall(json.dumps({"kind": "query"}).encode() + b"\n")
+        return json.loads(connection.makefile("rb").readline())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Aggregator of the federated servers')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    aggregator_parser = subparsers.add_parser("aggregator", help="Run the aggregator")
+    aggregator_parser.add_argument("--host", default="0.0.0.0")
+    aggregator_parser.add_argument("--port", type=int, default=DEFAULT_FEDERATION_PORT)
+    aggregator_parser.add_argument("--output-dir", default="federation", help="Directory of the combined event index")
+    status_parser = subparsers.add_parser("status", help="Print the fleet view of a running aggregator")
+    status_parser.add_argument("address", help="host:port of the aggregator")
+    args = parser.parse_args()
+    if args.command == "status":
+        print(json.dumps(query_aggregator(aggregator_address=args.address), indent=2))
+        return
+    logging.basicConfig(level=logging.INFO)
+    aggregator = FederationAggregator(host=args.host, port=args.port, output_dir=args.output_dir,
+                                      logger_name="federation")
+    aggregator.start()
+    try:
+        while aggregator.is_alive():
+            aggregator.join(timeout=1)
+    except KeyboardInterrupt:
+        aggregator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Run a shell command on all (or some) DUTs of the fleet through telnet, with the login of the Machine threads.
+Used for the rack-wide maintenance: deploy the models and golden files, check the running benchmarks...
+The DUTs run the command at the same time, at most parallel DUTs in flight, and each DUT has its own timeout.
+
+Usage (from the repository root):
+    python -m server.fleet_command -c server_parameters.yaml --hosts "carolp*" -- "pgrep -af run_model.py"
+    python -m server.fleet_command -c server_parameters.yaml --json -- "md5sum /home/carol/golden/*.npy"
+"""
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import logging
+import re
+import time
+import typing
+
+from .config import MachineConfig, load_fleet_config
+from .telnet_session import SHELL_PROMPT, telnet_login
+
+# Number of DUTs running the command at the same time
+DEFAULT_PARALLEL_HOSTS = 16
+# Maximum time of the login and the command on each DUT
+DEFAULT_HOST_TIMEOUT = 30.0
+# The exit code of the command is printed after this marker. On the echo of the command line
+# the marker is followed by $? instead of a number, so the echo never matches
+_EXIT_CODE_MARKER = "__FLEET_COMMAND_EXIT_CODE_"
+_EXIT_CODE_PATTERN = re.compile(rb"__FLEET_COMMAND_EXIT_CODE_(\d+)__")
+_MAX_OUTPUT_SIZE = 64 * 1024
+
+
+class FleetCommandResult(typing.NamedTuple):
+    hostname: str
+    passed: bool
+    exit_code: typing.Optional[int]
+    output: str
+    duration: float
+    detail: str
+
+
+def select_machines(machine_configs: typing.List[MachineConfig],
+                    host_patterns: typing.List[str] = None) -> typing.List[MachineConfig]:
+    """ Machines whose hostname matches one of the patterns (fnmatch, ex: carolp*), all of them if there is none """
+    if not host_patterns:
+        return list(machine_configs)
+    return [config for config in machine_configs
+            if any(fnmatch.fnmatchcase(config.hostname, pattern) for pattern in host_patterns)]
+
+
+def _clean_output(raw_output: bytes, command_line: str) -> str:
+    lines = raw_output.decode("utf-8", errors="replace").replace("\r\n", "\n").split("\n")
+    # The DUT shell echoes the command line
+    if lines and lines[0].strip() == command_line.strip():
+        lines = lines[1:]
+    output = "\n".join(lines).strip("\n")
+    return output if len(output) <= _MAX_OUTPUT_SIZE else output[-_MAX_OUTPUT_SIZE:]
+
+
+def run_host_command(machine_config: MachineConfig, command: str,
+                     timeout: float = DEFAULT_HOST_TIMEOUT) -> FleetCommandResult:
+    """ Login on the DUT and run the command
+    :param machine_config: MachineConfig of the DUT
+    :param command: shell command line
+    :param timeout: maximum time in seconds of the login and the command
+    :return: FleetCommandResult, passed is True if the command exit code is 0
+    """
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    # On a subshell, so an exit on the command does not close the session before the exit code
+    command_line = f"({command}); echo {_EXIT_CODE_MARKER}$?__"
+
+    def _result(passed: bool, exit_code: typing.Optional[int], output: str, detail: str) -> FleetCommandResult:
+        return FleetCommandResult(hostname=machine_config.hostname, passed=passed, exit_code=exit_code,
+                                  output=output, duration=time.monotonic() - start_time, detail=detail)
+
+    try:
+        with telnet_login(ip=machine_config.ip, port=machine_config.telnet_port, username=machine_config.username,
+                          password=machine_config.password, timeout=timeout, deadline=deadline) as tn:
+            tn.write(command_line.encode("utf-8") + b"\r\n")
+            remaining_time = max(deadline - time.monotonic(), 0.0)
+            _, match, raw_output = tn.expect([_EXIT_CODE_PATTERN], timeout=remaining_time)
+            if match is None:
+                return _result(passed=False, exit_code=None, output=_clean_output(raw_output, command_line),
+                               detail=f"timeout after {timeout}s")
+            exit_code = int(match.group(1))
+            output = _clean_output(raw_output[:match.start()], command_line)
+            # Leave the shell prompt for a clean logout
+            tn.read_until(SHELL_PROMPT, timeout=min(remaining_time, 1.0))
+            return _result(passed=exit_code == 0, exit_code=exit_code, output=output,
+                           detail=f"exit code {exit_code}")
+    except (OSError, EOFError, RuntimeError) as error:
+        return _result(passed=False, exit_code=None, output="", detail=f"{type(error).__name__}: {error}")
+
+
+def run_fleet_command(machine_configs: typing.List[MachineConfig], command: str,
+                      parallel: int = DEFAULT_PARALLEL_HOSTS, timeout: float = DEFAULT_HOST_TIMEOUT,
+                      logger_name: str = "fleet_command") -> typing.List[FleetCommandResult]:
+    """ Run the command on the DUTs, parallel DUTs at a time
+    :param machine_configs: list of MachineConfig
+    :param command: shell command line
+    :param parallel: maximum number of DUTs in flight
+    :param timeout: maximum time in seconds on each DUT
+    :param logger_name: Main logger name to store the logging information
+    :return: list of FleetCommandResult in the same order as machine_configs
+    """
+    logger = logging.getLogger(f"{logger_name}.{__name__}")
+    if not machine_configs:
+        return list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(parallel, len(machine_configs)),
+                                               thread_name_prefix="FleetCommand") as executor:
+        results = list(executor.map(lambda config: run_host_command(machine_config=config, command=command,
+                                                                    timeout=timeout), machine_configs))
+    logger.info(f"Command {command!r} on {len(results)} DUTs: "
+                f"{sum(result.passed for result in results)} passed, "
+                f"failed on {[result.hostname for result in results if not result.passed]}")
+    return results
+
+
+def main() -> None:
+    import sys
+    import yaml
+
+    parser = argparse.ArgumentParser(description='Run a shell command on the DUTs of the fleet through telnet')
+    parser.add_argument('-c', '--config', metavar='PATH_YAML_FILE', default="server_parameters.yaml",
+                        help='Path to the server parameters YAML file. Default is ./server_parameters.yaml')
+    parser.add_argument('--hosts', nargs="+", help="Hostname patterns (ex: carolp*), default is all the enabled machines")
+    parser.add_argument('--parallel', type=int, default=DEFAULT_PARALLEL_HOSTS,
+                        help=f"Maximum number of DUTs in flight. Default is {DEFAULT_PARALLEL_HOSTS}")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_HOST_TIMEOUT,
+                        help=f"Maximum time in seconds on each DUT. Default is {DEFAULT_HOST_TIMEOUT}")
+    parser.add_argument('--json', action="store_true", help="Print one JSON line per DUT")
+    parser.add_argument('command', help="Shell command line, use -- before it if it starts with -")
+    args = parser.parse_args()
+    with open(args.config) as fp:
+        server_parameters = yaml.load(fp, Loader=yaml.SafeLoader)
+    logging.basicConfig(level=logging.WARNING)
+    machine_configs = load_fleet_config(cfg_files=[m["cfg_file"] for m in server_parameters["machines"] if m['enabled']])
+    machine_configs = select_machines(machine_configs=machine_configs, host_patterns=args.hosts)
+    results = run_fleet_command(machine_configs=machine_configs, command=args.command, parallel=args.parallel,
+                                timeout=args.timeout)
+    for result in results:
+        if args.json:
+            print(json.dumps(result._asdict()))
+        else:
+            print(f"[{'OK' if result.passed else 'FAIL':^4}] {result.hostname} {result.detail} "
+                  f"in {result.duration:.1f}s")
+            if result.output:
+                print("\n".join(f"    {line}" for line in result.output.split("\n")))
+    sys.exit(0 if all(result.passed for result in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
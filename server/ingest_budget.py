@@ -0,0 +1,96 @@
+"""
+Overload protection of the DUT messages ingest.
+A benchmark that floods #ERR lines (ex: one per corrupted tensor element) keeps the Machine thread busy
+writing the DUT log, so the budget sheds the low priority messages of each DUT:
+- #SDC, #ABORT, #END, #HEADER, #BEGIN and the other messages are always kept
+- #ERR lines past max_err_rate are dropped, their number is written on a #SERVER_SHED summary line
+- #IT lines past max_it_rate are sampled, at most max_it_rate lines per second are written
+The shed messages are still classified and counted, so the iteration/SDC counters, the reboot watchdog
+and the reboot counters see every message. Only the DUT log write, the live publishing and the debug logging are skipped.
+"""
+import time
+import typing
+
+# Classes that can be shed, the other messages are always kept
+SHED_CONNECTION_TYPES = ("#ERR", "#IT")
+# Minimum time in seconds between two #SERVER_SHED lines on the DUT log
+DEFAULT_SHED_SUMMARY_INTERVAL = 1.0
+SHED_SUMMARY_PREFIX = "#SERVER_SHED"
+
+
+class _TokenBucket:
+    """ rate tokens per second, up to one second of burst """
+
+    def __init__(self, rate: float):
+        self.__rate = rate
+        self.__capacity = max(rate, 1.0)
+        self.__tokens = self.__capacity
+        self.__last_time = None
+
+    def take(self, now: float) -> bool:
+        if self.__last_time is not None:
+            self.__tokens = min(self.__tokens + (now - self.__last_time) * self.__rate, self.__capacity)
+        self.__last_time = now
+        if self.__tokens >= 1.0:
+            self.__tokens -= 1.0
+            return True
+        return False
+
+
+class IngestBudget:
+    """ Per-DUT budget of #ERR and #IT lines written to the DUT log """
+
+    def __init__(self, max_err_rate: float = None, max_it_rate: float = None,
+                 summary_interval: float = DEFAULT_SHED_SUMMARY_INTERVAL):
+        """
+        :param max_err_rate: #ERR lines per second written to the log, the others are summarized. None is unlimited
+        :param max_it_rate: #IT lines per second written to the log, the others are dropped. None is unlimited
+        :param summary_interval: minimum time in seconds between two #SERVER_SHED lines
+        """
+        self.__buckets = dict()
+        if max_err_rate is not None:
+            self.__buckets["#ERR"] = _TokenBucket(rate=max_err_rate)
+        if max_it_rate is not None:
+            self.__buckets["#IT"] = _TokenBucket(rate=max_it_rate)
+        self.__summary_interval = summary_interval
+        # Shed messages not yet written on a summary line, and the totals since the start
+        self.__pending = {connection_type: 0 for connection_type in SHED_CONNECTION_TYPES}
+        self.__pending_since = None
+        self.__last_summary_time = float("-inf")
+        self.shed = {connection_type: 0 for connection_type in SHED_CONNECTION_TYPES}
+
+    def admit(self, connection_type: str, now: float) -> bool:
+        """ Decide if a message is written to the DUT log
+        :param connection_type: classification of the message (#IT, #ERR, #SDC...)
+        :param now: time.monotonic of the reception
+        :return: False if the message must be shed
+        """
+        bucket = self.__buckets.get(connection_type)
+        if bucket is None or bucket.take(now=now):
+            return True
+        if self.__pending_since is None:
+            self.__pending_since = now
+        self.__pending[connection_type] += 1
+        self.shed[connection_type] += 1
+        return False
+
+    def summary_line(self, now: float, force: bool = False) -> typing.Optional[str]:
+        """ #SERVER_SHED line with the messages shed since the previous one, at most one per summary_interval
+        :param now: time.monotonic
+        :param force: ignore the summary_interval, ex: before the DUT log is finished
+        :return: the line (without the new line), None if nothing was shed or it is too soon
+        """
+        if self.__pending_since is None or (force is False and
+                                            now - self.__last_summary_time < self.__summary_interval):
+            return None
+        counts = " ".join(f"{connection_type}:{count}" for connection_type, count in self.__pending.items())
+        line = f"{SHED_SUMMARY_PREFIX} {counts} SECONDS:{now - self.__pending_since:.3f} " \
+               f"TIME:{time.strftime('%Y-%m-%d-%H-%M-%S')}"
+        self.__pending = {connection_type: 0 for connection_type in SHED_CONNECTION_TYPES}
+        self.__pending_since = None
+        self.__last_summary_time = now
+        return line
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.__buckets)
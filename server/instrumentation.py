@@ -0,0 +1,267 @@
+"""
+Opt-in instrumentation of the server stages (receive, DUT log write, classification, telnet, switch, boot...).
+Each thread records its own stage durations on log2 histograms, so the Machine threads never share a counter.
+A signal (SIGUSR1 by default) dumps the histograms, a tracemalloc snapshot and a sampling profile
+of all the threads to the diagnostics directory, without restarting the server.
+"""
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+
+# Time that the sampling profiler runs after each signal
+DEFAULT_PROFILE_DURATION = 10.0
+# Interval between the samples of the thread stacks
+_PROFILE_SAMPLE_INTERVAL = 0.005
+# Number of lines of the tracemalloc statistics written on the dump
+_TRACEMALLOC_TOP_LINES = 50
+
+
+class StageHistogram:
+    """ Durations of a stage on power of two buckets of nanoseconds, O(1) per record """
+
+    def __init__(self):
+        # bucket i counts the durations in [2^(i-1), 2^i) ns
+        self.__buckets = [0] * 64
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, duration_ns: int) -> None:
+        self.__buckets[min(duration_ns.bit_length(), 63)] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def merge(self, other: "StageHistogram") -> None:
+        for i, bucket_count in enumerate(other.buckets):
+            self.__buckets[i] += bucket_count
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+
+    def percentile_ns(self, percentile: float) -> int:
+        """ Upper bound of the bucket that contains the percentile """
+        target = self.count * percentile / 100
+        accumulated = 0
+        for i, bucket_count in enumerate(self.__buckets):
+            accumulated += bucket_count
+            if accumulated >= target and bucket_count:
+                return min(1 << i, self.max_ns)
+        return self.max_ns
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count, "total_s": self.total_ns / 1e9,
+            "mean_us": self.total_ns / self.count / 1e3 if self.count else 0.0,
+            "p50_us": self.percentile_ns(50) / 1e3, "p99_us": self.percentile_ns(99) / 1e3,
+            "max_us": self.max_ns / 1e3,
+        }
+
+    @property
+    def buckets(self) -> list:
+        return list(self.__buckets)
+
+
+class StageTimers:
+    """ Histograms of the stages of one thread """
+
+    def __init__(self, thread_name: str):
+        self.thread_name = thread_name
+        self.__histograms = dict()
+
+    def record(self, stage: str, start_ns: int) -> int:
+        """ Record the time since start_ns
+        :param stage: name of the stage, ex: machine.dut_log_write
+        :param start_ns: time.perf_counter_ns when the stage started
+        :return: time.perf_counter_ns now, it is the start of the next stage
+        """
+        now_ns = time.perf_counter_ns()
+        histogram = self.__histograms.get(stage)
+        if histogram is None:
+            histogram = self.__histograms[stage] = StageHistogram()
+        histogram.record(duration_ns=now_ns - start_ns)
+        return now_ns
+
+    @property
+    def histograms(self) -> dict:
+        return dict(self.__histograms)
+
+
+_INSTRUMENTATION_ENABLED = False
+_THREAD_TIMERS = threading.local()
+_ALL_TIMERS_LOCK = threading.Lock()
+_ALL_TIMERS = list()
+
+
+def enable_instrumentation() -> None:
+    """ Enable the stage timers, the threads started after it record their stages """
+    global _INSTRUMENTATION_ENABLED
+    _INSTRUMENTATION_ENABLED = True
+
+
+def disable_instrumentation() -> None:
+    """ Disable the stage timers and forget the recorded stages """
+    global _INSTRUMENTATION_ENABLED
+    _INSTRUMENTATION_ENABLED = False
+    with _ALL_TIMERS_LOCK:
+        _ALL_TIMERS.clear()
+    if hasattr(_THREAD_TIMERS, "timers"):
+        del _THREAD_TIMERS.timers
+
+
+def get_stage_timers() -> typing.Optional[StageTimers]:
+    """ Stage timers of the calling thread
+    :return: StageTimers or None if the instrumentation is disabled
+    """
+    if _INSTRUMENTATION_ENABLED is False:
+        return None
+    timers = getattr(_THREAD_TIMERS, "timers", None)
+    if timers is None:
+        timers = _THREAD_TIMERS.timers = StageTimers(thread_name=threading.current_thread().name)
+        with _ALL_TIMERS_LOCK:
+            _ALL_TIMERS.append(timers)
+    return timers
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str) -> typing.Iterator[None]:
+    """ Time a block of code, it does nothing if the instrumentation is disabled.
+    For the stages that run a few times per message, use StageTimers.record directly
+    :param stage: name of the stage
+    """
+    timers = get_stage_timers()
+    if timers is None:
+        yield
+        return
+    start_ns = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        timers.record(stage=stage, start_ns=start_ns)
+
+
+def stage_summary() -> dict:
+    """ Histograms of all the threads merged by stage
+    :return: dict stage -> summary (count, total_s, mean_us, p50_us, p99_us, max_us)
+    """
+    merged = dict()
+    with _ALL_TIMERS_LOCK:
+        all_timers = list(_ALL_TIMERS)
+    for timers in all_timers:
+        for stage, histogram in timers.histograms.items():
+            merged.setdefault(stage, StageHistogram()).merge(histogram)
+    return {stage: merged[stage].summary() for stage in sorted(merged)}
+
+
+def sample_thread_stacks(duration: float, interval: float = _PROFILE_SAMPLE_INTERVAL) -> collections.Counter:
+    """ Sampling profiler: read the stack of all the other threads every interval
+    :param duration: time in seconds sampling
+    :param interval: time in seconds between the samples
+    :return: Counter of the stacks in the folded format (thread;outer_function;...;inner_function)
+    """
+    stacks = collections.Counter()
+    sampler_id = threading.get_ident()
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            functions = list()
+            while frame is not None:
+                code = frame.f_code
+                functions.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            functions.append(thread_names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(functions))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+class DiagnosticsDumper:
+    """ Write the stage histograms, a tracemalloc snapshot and a sampling profile to a directory.
+    tracemalloc slows down the memory allocations, so it only starts on the first dump,
+    the next dumps also write the difference to the previous snapshot
+    """
+
+    def __init__(self, output_dir: str, logger_name: str, profile_duration: float = DEFAULT_PROFILE_DURATION):
+        """
+        :param output_dir: directory of the dump files
+        :param logger_name: Main logger name to store the logging information
+        :param profile_duration: time in seconds that the sampling profiler runs, 0 disables it
+        """
+        self.__output_dir = output_dir
+        self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__profile_duration = profile_duration
+        self.__dump_lock = threading.Lock()
+        self.__last_snapshot = None
+        self.__dumps = 0
+
+    def __write_tracemalloc(self, prefix: str) -> typing.Optional[str]:
+        if tracemalloc.is_tracing() is False:
+            tracemalloc.start()
+            self.__logger.info("tracemalloc started, the next dump will contain the memory snapshot")
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        filename = f"{prefix}_tracemalloc.txt"
+        with open(filename, "w") as fp:
+            fp.write(f"# Top {_TRACEMALLOC_TOP_LINES} allocations by line\n")
+            for stat in snapshot.statistics("lineno")[:_TRACEMALLOC_TOP_LINES]:
+                fp.write(f"{stat}\n")
+            if self.__last_snapshot is not None:
+                fp.write(f"\n# Top {_TRACEMALLOC_TOP_LINES} differences to the previous dump\n")
+                for stat in snapshot.compare_to(self.__last_snapshot, "lineno")[:_TRACEMALLOC_TOP_LINES]:
+                    fp.write(f"{stat}\n")
+        self.__last_snapshot = snapshot
+        return filename
+
+    def dump(self) -> list:
+        """ Write the dump files, only one dump runs at a time
+        :return: list of files written
+        """
+        if self.__dump_lock.acquire(blocking=False) is False:
+            self.__logger.warning("A diagnostics dump is already running")
+            return list()
+        try:
+            self.__dumps += 1
+            date_fmt = datetime.datetime.today().strftime('%Y_%m_%d_%H_%M_%S')
+            prefix = os.path.join(self.__output_dir, f"diagnostics_{date_fmt}_{os.getpid()}_{self.__dumps}")
+            files = [f"{prefix}_stages.json"]
+            with open(files[0], "w") as fp:
+                json.dump(stage_summary(), fp, indent=2)
+            tracemalloc_file = self.__write_tracemalloc(prefix=prefix)
+            if tracemalloc_file:
+                files.append(tracemalloc_file)
+            if self.__profile_duration > 0:
+                stacks = sample_thread_stacks(duration=self.__profile_duration)
+                files.append(f"{prefix}_profile.folded")
+                with open(files[-1], "w") as fp:
+                    for stack, samples in stacks.most_common():
+                        fp.write(f"{stack} {samples}\n")
+            self.__logger.info(f"Diagnostics written: {' '.join(files)}")
+            return files
+        except OSError:
+            self.__logger.exception(f"Could not write the diagnostics on {self.__output_dir}")
+            return list()
+        finally:
+            self.__dump_lock.release()
+
+    def install_signal_handler(self, signal_number: int = signal.SIGUSR1) -> None:
+        """ Dump on a background thread when the process receives the signal (ex: kill -USR1 <pid>).
+        It must be called from the main thread
+        """
+
+        def _signal_handler(signum, frame):
+            threading.Thread(target=self.dump, name="DiagnosticsDump", daemon=True).start()
+
+        signal.signal(signal_number, _signal_handler)
@@ -0,0 +1,139 @@
+"""
+Live view of the fleet over HTTP, served by a thread of the server process.
+GET /fleet: current state of the machines (codename, reboot counters, last #IT age)
+GET /messages?hostname=&type=&limit=: last messages received from the DUTs
+GET /stream?hostname=&type=&kind=: Server-Sent Events with the DUT messages and the server events as they arrive
+"""
+import http.server
+import json
+import logging
+import threading
+import typing
+import urllib.parse
+
+from .event_log import EVENT_LOGGER_NAME
+from .live_broker import DEFAULT_HISTORY_SIZE, LiveBroker, LiveEventHandler, get_live_broker, set_live_broker
+
+
+class _LiveApiHttpServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address: tuple, broker: LiveBroker, fleet_state: typing.Callable[[], list],
+                 stop_event: threading.Event):
+        super(_LiveApiHttpServer, self).__init__(server_address, _LiveApiRequestHandler)
+        self.broker = broker
+        self.fleet_state = fleet_state
+        self.stop_event = stop_event
+
+
+class _LiveApiRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Comment line sent to the stream clients when nothing happens, so dead connections are detected
+    __KEEPALIVE_INTERVAL = 15.0
+    server: _LiveApiHttpServer
+
+    def log_message(self, format: str, *args) -> None:
+        # The requests are not written on the server log
+        pass
+
+    def __send_json(self, content: typing.Any, status: int = 200) -> None:
+        body = json.dumps(content, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __stream(self, query: dict) -> None:
+        subscriber = self.server.broker.subscribe(hostname=query.get("hostname"), message_type=query.get("type"),
+                                                  kind=query.get("kind"))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        reported_drops = 0
+        try:
+            while self.server.stop_event.is_set() is False:
+                items = subscriber.get_all(timeout=self.__KEEPALIVE_INTERVAL)
+                chunks = list()
+                if subscriber.dropped != reported_drops:
+                    chunks.append(f"event: dropped\ndata: {subscriber.dropped - reported_drops}\n\n")
+                    reported_drops = subscriber.dropped
+                chunks.extend(f"data: {json.dumps(item, default=str)}\n\n" for item in items)
+                self.wfile.write(("".join(chunks) or ": keepalive\n\n").encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.server.broker.unsubscribe(subscriber)
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        if url.path == "/fleet":
+            self.__send_json(self.server.fleet_state())
+        elif url.path == "/messages":
+            try:
+                limit = int(query.get("limit", DEFAULT_HISTORY_SIZE))
+            except ValueError:
+                self.__send_json({"error": "limit must be an integer"}, status=400)
+                return
+            self.__send_json(self.server.broker.last_messages(hostname=query.get("hostname"),
+                                                              message_type=query.get("type"), limit=limit))
+        elif url.path == "/stream":
+            self.__stream(query=query)
+        else:
+            self.__send_json({"error": f"unknown path {url.path}", "paths": ["/fleet", "/messages", "/stream"]},
+                             status=404)
+
+
+class LiveApiServer(threading.Thread):
+    """ HTTP server thread of the live API. It has the same stop/join interface as the Machine threads """
+
+    def __init__(self, host: str, port: int, fleet_state: typing.Callable[[], list], logger_name: str,
+                 broker: LiveBroker = None, *args, **kwargs):
+        """ Create the broker of the process and bind the HTTP server
+        :param host: address to listen, ex: 127.0.0.1
+        :param port: TCP port to listen, 0 for any free port
+        :param fleet_state: callable that returns the metrics of all the machines
+        :param logger_name: Main logger name to store the logging information
+        :param broker: LiveBroker, default is a new one
+        :param *args: args that will be passed to threading.Thread
+        :param *kwargs: kwargs that will be passed to threading.Thread
+        """
+        super(LiveApiServer, self).__init__(*args, **kwargs)
+        self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__broker = LiveBroker() if broker is None else broker
+        set_live_broker(broker=self.__broker)
+        self.__stop_event = threading.Event()
+        self.__http_server = _LiveApiHttpServer(server_address=(host, port), broker=self.__broker,
+                                                fleet_state=fleet_state, stop_event=self.__stop_event)
+        # The server events (also the ones forwarded by the worker processes) go to the stream clients
+        self.__event_handler = LiveEventHandler(broker=self.__broker)
+        event_logger = logging.getLogger(EVENT_LOGGER_NAME)
+        event_logger.setLevel(logging.INFO)
+        event_logger.addHandler(self.__event_handler)
+
+    def __str__(self) -> str:
+        host, port = self.address
+        return f"LiveApiServer http://{host}:{port}"
+
+    def run(self) -> None:
+        self.__logger.info(f"Starting {self}")
+        self.__http_server.serve_forever(poll_interval=0.5)
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+        logging.getLogger(EVENT_LOGGER_NAME).removeHandler(self.__event_handler)
+        if get_live_broker() is self.__broker:
+            set_live_broker(broker=None)
+        if self.is_alive():
+            self.__http_server.shutdown()
+        self.__http_server.server_close()
+
+    @property
+    def address(self) -> tuple:
+        return self.__http_server.server_address[:2]
+
+    @property
+    def broker(self) -> LiveBroker:
+        return self.__broker
@@ -0,0 +1,152 @@
+"""
+Publish/subscribe of the DUT messages and the server events for the live API (see server.live_api).
+Every subscriber has a bounded buffer, a slow client loses its oldest items instead of slowing the Machine threads.
+It does not import the HTTP modules, so the Machine threads can use it without slowing the server start.
+"""
+import collections
+import logging
+import threading
+import time
+import typing
+
+from .event_log import event_from_record
+
+# Items waiting to be sent to each stream client
+DEFAULT_SUBSCRIBER_BUFFER_SIZE = 1024
+# Last messages kept for each DUT
+DEFAULT_HISTORY_SIZE = 256
+
+
+class LiveSubscriber:
+    """ Bounded buffer of one stream client, the oldest items are dropped when it is full """
+
+    def __init__(self, buffer_size: int, hostname: str = None, message_type: str = None, kind: str = None):
+        """
+        :param buffer_size: maximum number of items waiting to be sent
+        :param hostname: only the items of this DUT, None for all
+        :param message_type: only the DUT messages of this type, ex: #SDC, None for all
+        :param kind: "message" or "event", None for both
+        """
+        self.__items = collections.deque(maxlen=buffer_size)
+        self.__new_items = threading.Event()
+        self.__hostname = hostname
+        self.__message_type = message_type
+        self.__kind = kind
+        self.dropped = 0
+
+    def matches(self, item: dict) -> bool:
+        return ((self.__kind is None or item["kind"] == self.__kind) and
+                (self.__hostname is None or item.get("hostname") == self.__hostname) and
+                (self.__message_type is None or item.get("type") == self.__message_type))
+
+    def put(self, item: dict) -> None:
+        """ Never blocks, it is called by the Machine threads """
+        if len(self.__items) == self.__items.maxlen:
+            self.dropped += 1
+        self.__items.append(item)
+        self.__new_items.set()
+
+    def get_all(self, timeout: float) -> list:
+        """ Wait for new items and return all of them
+        :param timeout: maximum time in seconds to wait
+        :return: list of items, empty if none arrived before the timeout
+        """
+        self.__new_items.wait(timeout)
+        self.__new_items.clear()
+        items = list()
+        while self.__items:
+            items.append(self.__items.popleft())
+        return items
+
+
+class LiveBroker:
+    """ Pass the DUT messages and the server events to the stream clients, and keep the last messages of each DUT """
+
+    def __init__(self, history_size: int = DEFAULT_HISTORY_SIZE,
+                 subscriber_buffer_size: int = DEFAULT_SUBSCRIBER_BUFFER_SIZE):
+        self.__history_size = history_size
+        self.__subscriber_buffer_size = subscriber_buffer_size
+        self.__lock = threading.Lock()
+        # Replaced on every subscribe/unsubscribe, so the publishers iterate over it without the lock
+        self.__subscribers = tuple()
+        self.__history = dict()
+
+    def __publish(self, item: dict) -> None:
+        for subscriber in self.__subscribers:
+            if subscriber.matches(item):
+                subscriber.put(item)
+
+    def publish_dut_message(self, hostname: str, message_type: str,
+                            message: typing.Union[bytes, memoryview]) -> None:
+        """ Called by the Machine threads for every message
+        :param hostname: DUT hostname
+        :param message_type: type returned by the message classification, ex: #IT
+        :param message: message as received, the first byte is the ECC status
+        """
+        item = {"kind": "message", "timestamp": time.time(), "hostname": hostname, "type": message_type,
+                "message": bytes(message[1:]).decode("ascii", errors="replace").rstrip("\n")}
+        history = self.__history.get(hostname)
+        if history is None:
+            with self.__lock:
+                history = self.__history.setdefault(hostname, collections.deque(maxlen=self.__history_size))
+        history.append(item)
+        self.__publish(item)
+
+    def publish_event(self, event: dict) -> None:
+        """ Pass a server event (see server.event_log) to the stream clients """
+        self.__publish(dict(event, kind="event"))
+
+    def subscribe(self, hostname: str = None, message_type: str = None, kind: str = None) -> LiveSubscriber:
+        subscriber = LiveSubscriber(buffer_size=self.__subscriber_buffer_size, hostname=hostname,
+                                    message_type=message_type, kind=kind)
+        with self.__lock:
+            self.__subscribers += (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, subscriber: LiveSubscriber) -> None:
+        with self.__lock:
+            self.__subscribers = tuple(s for s in self.__subscribers if s is not subscriber)
+
+    def last_messages(self, hostname: str = None, message_type: str = None, limit: int = None) -> list:
+        """ Last messages kept in memory, the oldest first """
+        with self.__lock:
+            if hostname is None:
+                histories = list(self.__history.values())
+            else:
+                histories = [self.__history.get(hostname, tuple())]
+            messages = [item for history in histories for item in list(history)
+                        if message_type is None or item["type"] == message_type]
+        messages.sort(key=lambda item: item["timestamp"])
+        return messages[-limit:] if limit else messages
+
+    @property
+    def subscribers(self) -> int:
+        return len(self.__subscribers)
+
+
+class LiveEventHandler(logging.Handler):
+    """ Logging handler of the event logger that passes the events to the broker """
+
+    def __init__(self, broker: LiveBroker):
+        super(LiveEventHandler, self).__init__(level=logging.INFO)
+        self.__broker = broker
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.__broker.publish_event(event_from_record(record))
+
+
+# The broker of the process, None if the live API is disabled
+_LIVE_BROKER: typing.Optional[LiveBroker] = None
+
+
+def get_live_broker() -> typing.Optional[LiveBroker]:
+    """ The Machine threads publish their messages on it, None if the live API is disabled """
+    return _LIVE_BROKER
+
+
+def set_live_broker(broker: typing.Optional[LiveBroker]) -> None:
+    """ Set the broker of the process, the Machine threads created after it publish their messages on it
+    :param broker: LiveBroker or None to disable it
+    """
+    global _LIVE_BROKER
+    _LIVE_BROKER = broker
@@ -1,9 +1,132 @@
+import atexit
+import copy
+import enum
 import logging
+import logging.handlers
+import queue
+import threading
+import time
+import typing
 
+from .instrumentation import get_stage_timers
 from .print_manager import ServerMultipleThreadConsoleHandler
 
+# Maximum number of records waiting for the listener thread
+_LOGGING_QUEUE_SIZE = 10000
 
-class ColoredFormatter(logging.Formatter):
+# One listener (and its queue handler) per logger configured by logging_setup
+_QUEUE_LISTENERS = dict()
+_QUEUE_LISTENERS_LOCK = threading.Lock()
+
+
+class DropPolicy(enum.Enum):
+    """ What to do with a record when the logging queue is full.
+    Records of level WARNING or higher are never dropped in favour of lower level ones:
+    they evict the oldest queued record below WARNING, and a record below WARNING never evicts them.
+    When only WARNING or higher records are queued, DROP_OLDEST evicts the oldest one
+    for a new WARNING or higher record, and DROP_NEWEST drops the new record.
+    """
+    # Discard the record that is being logged
+    DROP_NEWEST = enum.auto()
+    # Discard the oldest record in the queue to make room for the new one
+    DROP_OLDEST = enum.auto()
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler that never blocks the caller thread.
+    The records are only put in a bounded queue, the formatting and the I/O are
+    done by a QueueListener thread. When the queue is full the record
+    is dropped following the DropPolicy, and the drop is counted.
+    """
+
+    def __init__(self, log_queue: queue.Queue, drop_policy: DropPolicy = DropPolicy.DROP_NEWEST):
+        super(NonBlockingQueueHandler, self).__init__(log_queue)
+        self.__drop_policy = drop_policy
+        self.__dropped_lock = threading.Lock()
+        self.__dropped_records = dict()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """ The queue is consumed in the same process, so there is no need
+        to format (or to make pickable) the record on the caller thread
+        """
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self.__drop_policy == DropPolicy.DROP_NEWEST and record.levelno < logging.WARNING:
+            self.__count_dropped(record)
+            return
+
+        dropped_record = self.__replace_queued_record(record)
+        if dropped_record is not None:
+            self.__count_dropped(dropped_record)
+
+    def __replace_queued_record(self, record: logging.LogRecord) -> typing.Optional[logging.LogRecord]:
+        """ Evict a queued record to make room for the new one, following the DropPolicy
+        :param record: record that is being logged
+        :return: the dropped record, it is the new one if no queued record can be evicted
+        """
+        log_queue = self.queue
+        with log_queue.mutex:
+            queued_records = log_queue.queue
+            if len(queued_records) < log_queue.maxsize:
+                # The listener took some records meanwhile
+                queued_records.append(record)
+                log_queue.unfinished_tasks += 1
+                log_queue.not_empty.notify()
+                return None
+            evicted_index = next((i for i, queued_record in enumerate(queued_records)
+                                  if queued_record.levelno < logging.WARNING), None)
+            if evicted_index is None:
+                if record.levelno < logging.WARNING or self.__drop_policy == DropPolicy.DROP_NEWEST:
+                    return record
+                evicted_index = 0
+            evicted_record = queued_records[evicted_index]
+            del queued_records[evicted_index]
+            # One record out and one in, the unfinished tasks of the queue do not change
+            queued_records.append(record)
+            log_queue.not_empty.notify()
+            return evicted_record
+
+    def __count_dropped(self, record: logging.LogRecord) -> None:
+        with self.__dropped_lock:
+            self.__dropped_records[record.levelname] = self.__dropped_records.get(record.levelname, 0) + 1
+
+    @property
+    def dropped_records(self) -> dict:
+        """ Number of dropped records per level name """
+        with self.__dropped_lock:
+            return dict(self.__dropped_records)
+
+
+class CachedFormatter(logging.Formatter):
+    """ Formatter that caches its output on the record,
+    so a record that reaches several handlers with the same format is formatted only once
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachedFormatter, self).__init__(*args, **kwargs)
+        self._cache_key = (type(self), self._fmt, self.datefmt)
+
+    def format(self, record: logging.LogRecord) -> str:
+        cache = record.__dict__.setdefault("_formatted_cache", dict())
+        formatted = cache.get(self._cache_key)
+        if formatted is None:
+            timers = get_stage_timers()
+            start_ns = time.perf_counter_ns() if timers else 0
+            formatted = super(CachedFormatter, self).format(record)
+            cache[self._cache_key] = formatted
+            if timers:
+                timers.record(stage="logging.format", start_ns=start_ns)
+        return formatted
+
+
+class ColoredFormatter(CachedFormatter):
     BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
 
     # The background is set with 40 plus the number of the color, and the foreground with 30
@@ -22,15 +145,17 @@ class ColoredFormatter(logging.Formatter):
     }
 
     def __init__(self, msg, use_color=True):
-        logging.Formatter.__init__(self, msg, "%d-%m-%y %H:%M:%S")
+        CachedFormatter.__init__(self, msg, "%d-%m-%y %H:%M:%S")
         self.use_color = use_color
+        self._cache_key += (use_color,)
 
     def format(self, record):
         level_name = record.levelname
         if self.use_color and level_name in self.COLORS:
-            level_name_color = self.COLOR_SEQ % (30 + self.COLORS[level_name]) + level_name + self.RESET_SEQ
-            record.levelname = level_name_color
-        return logging.Formatter.format(self, record)
+            # Never change the original record, the other handlers (file) must not get the colors
+            record = copy.copy(record)
+            record.levelname = self.COLOR_SEQ % (30 + self.COLORS[level_name]) + level_name + self.RESET_SEQ
+        return CachedFormatter.format(self, record)
 
     @staticmethod
     def formatter_message(message, use_color=True):
@@ -52,8 +177,17 @@ class ColoredLogger(logging.Logger):
         self.addHandler(console_handler)
 
 
-def logging_setup(logger_name: str, log_file: str, enable_curses: bool) -> logging.Logger:
+def logging_setup(logger_name: str, log_file: str, enable_curses: bool = False,
+                  queue_size: int = _LOGGING_QUEUE_SIZE,
+                  drop_policy: DropPolicy = DropPolicy.DROP_NEWEST) -> logging.Logger:
     """Logging setup
+    All the handlers are attached to a single QueueListener thread,
+    the logger itself only has a non-blocking queue handler
+    :param logger_name: name of the main logger
+    :param log_file: path to the server log file
+    :param enable_curses: send the console output to the curses manager
+    :param queue_size: maximum number of records waiting to be written
+    :param drop_policy: what to do when the queue is full
     :return: logger object
     """
     # create logger
@@ -63,15 +197,83 @@ def logging_setup(logger_name: str, log_file: str, enable_curses: bool) -> loggi
     fh = logging.FileHandler(log_file, mode='a')
     fh.setLevel(logging.INFO)
     # create formatter and add it to the handlers
-    file_formatter = logging.Formatter(fmt='%(asctime)s %(name)s %(levelname)s %(message)s %(filename)s:%(lineno)d',
-                                       datefmt='%d-%m-%y %H:%M:%S')
-
-    # add the handlers to the logger
+    file_formatter = CachedFormatter(fmt='%(asctime)s %(name)s %(levelname)s %(message)s %(filename)s:%(lineno)d',
+                                     datefmt='%d-%m-%y %H:%M:%S')
     fh.setFormatter(file_formatter)
-    logger.addHandler(fh)
 
+    # the real handlers are only called by the listener thread
     console_handler = ServerMultipleThreadConsoleHandler() if enable_curses else logging.StreamHandler()
     console = ColoredLogger(name=logger_name, console_handler=console_handler)
-    # noinspection PyTypeChecker
-    logger.addHandler(console)
+
+    attach_queue_listener(logger_name=logger_name, handlers=[fh, console], queue_size=queue_size,
+                          drop_policy=drop_policy)
     return logger
+
+
+def attach_queue_listener(logger_name: str, handlers: list, queue_size: int = _LOGGING_QUEUE_SIZE,
+                          drop_policy: DropPolicy = DropPolicy.DROP_NEWEST) -> None:
+    """ Attach a non-blocking queue handler to the logger and start a listener
+    thread that will pass the records to the real handlers
+    :param logger_name: name of the logger
+    :param handlers: handlers that will be called by the listener thread
+    :param queue_size: maximum number of records waiting to be written
+    :param drop_policy: what to do when the queue is full
+    """
+    # If the logger was already configured, restart it
+    logging_shutdown(logger_name=logger_name)
+    queue_handler = NonBlockingQueueHandler(log_queue=queue.Queue(maxsize=queue_size), drop_policy=drop_policy)
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    logging.getLogger(logger_name).addHandler(queue_handler)
+    with _QUEUE_LISTENERS_LOCK:
+        _QUEUE_LISTENERS[logger_name] = (listener, queue_handler, handlers)
+
+
+def logging_forward_to_queue(log_queue, logger_names: list) -> None:
+    """ Used on worker processes. The records of the loggers are sent to log_queue
+    (a multiprocessing.Queue), and the parent process passes them to its own handlers
+    :param log_queue: queue shared with the parent process
+    :param logger_names: loggers configured on the parent process
+    """
+    with _QUEUE_LISTENERS_LOCK:
+        # The listener threads do not run on the worker process
+        _QUEUE_LISTENERS.clear()
+    for logger_name in logger_names:
+        logger = logging.getLogger(logger_name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        # The handlers of the parent process filter the records by their own level
+        logger.setLevel(logging.DEBUG)
+
+
+def logging_dropped_records(logger_name: str) -> dict:
+    """ Number of records dropped because the logging queue was full
+    :param logger_name: name of the logger configured by logging_setup
+    :return: dict with the number of dropped records per level name
+    """
+    with _QUEUE_LISTENERS_LOCK:
+        if logger_name not in _QUEUE_LISTENERS:
+            return dict()
+        _, queue_handler, _ = _QUEUE_LISTENERS[logger_name]
+    return queue_handler.dropped_records
+
+
+def logging_shutdown(logger_name: str = None) -> None:
+    """ Flush the queued records and stop the listener threads
+    :param logger_name: name of the logger configured by logging_setup, None stops all of them
+    """
+    with _QUEUE_LISTENERS_LOCK:
+        names = list(_QUEUE_LISTENERS) if logger_name is None else [logger_name]
+        to_stop = [(name, _QUEUE_LISTENERS.pop(name)) for name in names if name in _QUEUE_LISTENERS]
+
+    for name, (listener, queue_handler, handlers) in to_stop:
+        logging.getLogger(name).removeHandler(queue_handler)
+        listener.stop()
+        for handler in handlers:
+            if isinstance(handler, logging.Handler):
+                handler.close()
+
+
+# Make sure that the queued records reach the files when the interpreter exits
+atexit.register(logging_shutdown)
@@ -1,19 +1,28 @@
 import errno
 import logging
 import os
+import select
 import socket
-import subprocess
 import telnetlib
 import threading
 import time
-from typing import Optional
-
-import yaml
+from typing import Optional, Union
 
+from .circuit_breaker import BreakerState, CircuitBreaker
 from .command_factory import CommandFactory
-from .dut_logging import DUTLogging, EndStatus
+from .config import MachineConfig, load_machine_config
+from .deduplication import split_sequence_number
+from .dut_logging import DUTLogging, EndStatus, ECC_STATUS_VALUES, log_file_manager_stats
 from .error_codes import ErrorCodes
+from .error_rate_monitor import ErrorRateMonitor
+from .event_log import ServerEvent, log_server_event, elapsed_since
+from .instrumentation import get_stage_timers, timed_stage
+from .live_broker import get_live_broker
+from .message_pipeline import MessagePipeline, classify_message
 from .reboot_machine import reboot_machine, turn_machine_on
+from .reboot_policy import REBOOT_TIERS, create_reboot_policy
+from .telnet_session import telnet_login
+from .traffic_capture import create_capture_writer
 
 
 class Machine(threading.Thread):
@@ -25,38 +34,54 @@ class Machine(threading.Thread):
     describe the behavior of HARD reboot execution
     """
     # Wait time to see if the board returns, 1800 = half an hour
+    # It is the first quarantine time of a DUT in crash loop, it doubles if the DUT crashes again right after
     __LONG_REBOOT_WAIT_TIME_AFTER_PROBLEM = 1800
+    __MAX_QUARANTINE_TIME = 4 * 1800
+    # After the quarantine, the DUT must run this long without a hard reboot to leave the probation
+    __QUARANTINE_PROBATION_TIME = 300
     # Data receive size in bytes
     __DATA_SIZE = 4096
+    # Number of preallocated receive buffers, used in round-robin.
+    # A memoryview of a received message is valid until its buffer is reused
+    __RECEIVE_BUFFER_RING_SIZE = 4
     # Num of start app tries
     __MAX_TELNET_TRIES = 4
-    # Max attempts to reboot the device
-    __MAX_SEQUENTIALLY_HARD_REBOOTS = 6
+    # Max attempts to reboot the device (the crash loop of hard reboots is set on the machine yaml)
     __MAX_SEQUENTIALLY_SOFT_APP_REBOOTS = 3
     __MAX_SEQUENTIALLY_SOFT_OS_REBOOTS = 3
+    # A tier that returns one of these did not try to reboot the DUT, it is not recorded on the reboot policy
+    __REBOOT_NOT_ATTEMPTED = {ErrorCodes.THREAD_EVENT_IS_SET, ErrorCodes.DISABLED_SOFT_OS_REBOOT,
+                              ErrorCodes.MAXIMUM_APP_REBOOT_REACHED, ErrorCodes.MAXIMUM_OS_REBOOT_REACHED}
 
     # Time in seconds between the POWER switch OFF and ON
     # Smaller intervals are too dangerous ChipIR 12/2022
     __POWER_SWITCH_DEFAULT_TIME_REST = 4
     __READ_EAGER_TIMEOUT = 1
-    __BOOT_PING_TIMEOUT = 2
+    # The boot is probed with a TCP connection to the telnet port, on a tight schedule after the power ON
+    __BOOT_PROBE_TIMEOUT = 1
+    __BOOT_PROBE_INTERVAL = 0.25
+
+    # Interval between the checks of the stop event while the beam is paused
+    __BEAM_PAUSE_POLL_INTERVAL = 1
+
+    # Interval between the SDC/error rates summary on the server log
+    __RATE_REPORT_INTERVAL = 60
 
     # This time is just to make the OS start the rebooting process;
-    # otherwise the next ping will be successful, right after sudo reboot command
+    # otherwise the next boot probe will be successful, right after sudo reboot command
     __WAIT_AFTER_SOFT_OS_REBOOT_TIME = 5
 
-    # Possible connection string
-    __ALL_POSSIBLE_CONNECTION_TYPES = [  # Add more if necessary
-        '#IT', '#HEADER', '#BEGIN', '#END', '#INF', '#ERR', "#SDC", "#ABORT"
-    ]
+    # Messages received during the boot that show that the benchmark started by itself
+    __APP_RUNNING_CONNECTION_TYPES = {'#HEADER', '#BEGIN', '#IT', '#INF', '#ERR', "#SDC"}
 
     def __init__(self, configuration_file: str, server_ip: str, logger_name: str, server_log_path: str,
-                 *args, **kwargs):
+                 machine_config: MachineConfig = None, *args, **kwargs):
         """ Initialize a new thread that represents a setup machine
         :param configuration_file: YAML file that contains all information from that specific Device Under Test (DUT)
         :param server_ip: IP of the server
         :param logger_name: Main logger name to store the logging information
         :param server_log_path: directory to store the logs for the test
+        :param machine_config: configuration already loaded with server.config, configuration_file is not read again
         :param *args: args that will be passed to threading.Thread
         :param *kwargs: kwargs that will be passed to threading.Thread
         """
@@ -64,44 +89,111 @@ class Machine(threading.Thread):
         self.__logger = logging.getLogger(self.__logger_name)
         self.__logger.info(f"Creating a new Machine thread for IP {server_ip}")
         self.__stop_event = threading.Event()
-
-        # load yaml file
-        with open(configuration_file, 'r') as fp:
-            machine_parameters = yaml.load(fp, Loader=yaml.SafeLoader)
-        self.__dut_ip = machine_parameters["ip"]
-        self.__dut_hostname = machine_parameters["hostname"]
-        self.__dut_username = machine_parameters["username"]
-        self.__dut_password = machine_parameters["password"]
-        self.__switch_ip = machine_parameters["power_switch_ip"]
-        self.__switch_port = machine_parameters["power_switch_port"]
-        self.__switch_model = machine_parameters["power_switch_model"]
-        self.__boot_waiting_time = machine_parameters["boot_waiting_time"]
-        self.__max_timeout_time = machine_parameters["max_timeout_time"]
-        self.__receiving_port = machine_parameters["receive_port"]
-        self.__disable_os_soft_reboot = False
-        if "disable_os_soft_reboot" in machine_parameters:
-            self.__disable_os_soft_reboot = machine_parameters["disable_os_soft_reboot"] is True
-
-        # Factory to manage the command execution
-        self.__command_factory = CommandFactory(json_files_list=machine_parameters["json_files"],
-                                                logger_name=logger_name)
+        # Beam pause requested by pause(), resume() clears it
+        self.__pause_requested = threading.Event()
+        self.__resume_event = threading.Event()
+        self.__paused = False
+
+        # The configuration is validated before any socket or switch is used
+        if machine_config is None:
+            machine_config = load_machine_config(cfg_file=configuration_file)
+        self.__dut_ip = machine_config.ip
+        self.__dut_hostname = machine_config.hostname
+        self.__dut_username = machine_config.username
+        self.__dut_password = machine_config.password
+        self.__switch_ip = machine_config.power_switch_ip
+        self.__switch_port = machine_config.power_switch_port
+        self.__switch_model = machine_config.power_switch_model
+        self.__boot_waiting_time = machine_config.boot_waiting_time
+        self.__max_timeout_time = machine_config.max_timeout_time
+        self.__receiving_port = machine_config.receive_port
+        self.__telnet_port = machine_config.telnet_port
+        # Watch the receive port during the boot, for the DUT images that send messages before telnet is ready
+        self.__boot_heartbeat = machine_config.boot_heartbeat
+        self.__disable_os_soft_reboot = machine_config.disable_os_soft_reboot
+        # Receive time of each message on a sidecar of the DUT log
+        self.__receive_timestamps = machine_config.receive_timestamps
 
         self.__dut_log_path = f"{server_log_path}/{self.__dut_hostname}"
         # make sure that the path exists
         if os.path.isdir(self.__dut_log_path) is False:
             os.mkdir(self.__dut_log_path)
 
-        self.__dut_logging_obj = None
+        # Factory to manage the command execution, the exposure of each benchmark is kept on the DUT log directory
+        self.__command_factory = CommandFactory(json_files_list=machine_config.json_files, logger_name=logger_name,
+                                                hostname=self.__dut_hostname, benchmarks=machine_config.benchmarks,
+                                                window_clock=machine_config.command_window_clock,
+                                                exposure_file=os.path.join(self.__dut_log_path, "exposure.json"))
+
+        # Order of the reboot tiers after a timeout, the recoveries of the DUT are kept on its log directory
+        reboot_tiers = tuple(tier for tier in REBOOT_TIERS
+                             if tier != EndStatus.SOFT_OS_REBOOT or self.__disable_os_soft_reboot is False)
+        self.__reboot_policy = create_reboot_policy(
+            name=machine_config.reboot_policy, hostname=self.__dut_hostname, logger_name=logger_name,
+            history_file=os.path.join(self.__dut_log_path, "reboot_history.json"), tiers=reboot_tiers
+        )
+        # The last power cycle was a quarantine, its recovery time is not recorded
+        self.__quarantined = False
+
+        # The messages are also passed to the live API clients, if the API is enabled
+        self.__live_broker = get_live_broker()
+        # Stage timers of the Machine thread, None if the instrumentation is disabled (set at the run start)
+        self.__stage_timers = None
+        # Telnet session opened by the boot probe, it is reused to start the app
+        self.__boot_telnet_session = None
+        # Messages of an app that started by itself during the boot, they go to the next log
+        self.__auto_started_app_messages = list()
+        self.__boot_detected_by = None
         # Configure the socket
         self.__messages_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.__messages_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.__messages_socket.bind((server_ip, self.__receiving_port))
         self.__messages_socket.settimeout(self.__max_timeout_time)
+        # Preallocated buffers, so no bytes object is created per received message
+        self.__receive_buffers = [bytearray(self.__DATA_SIZE) for _ in range(self.__RECEIVE_BUFFER_RING_SIZE)]
+        self.__receive_views = [memoryview(buffer) for buffer in self.__receive_buffers]
+        self.__receive_buffer_index = 0
+
+        # Counters exposed by the metrics property
+        self.__received_messages = 0
+        self.__received_bytes = 0
+        self.__last_message_time = None
+        self.__last_iteration_time = None
+        self.__successful_reboots = {tier.name: 0 for tier in (EndStatus.SOFT_APP_REBOOT, EndStatus.SOFT_OS_REBOOT,
+                                                               EndStatus.HARD_REBOOT)}
+        # Rolling window of iterations, SDCs, errors and crashes per benchmark
+        self.__error_rate_monitor = ErrorRateMonitor(hostname=self.__dut_hostname, window=machine_config.rate_window,
+                                                     beam_flux=machine_config.beam_flux)
+        self.__last_rate_report_time = time.monotonic()
+        # Deduplication, reordering, ingest budget and DUT log of the received messages (shared with the replay)
+        self.__message_pipeline = MessagePipeline(dedup_window=machine_config.dedup_window,
+                                                  reorder_window=machine_config.reorder_window,
+                                                  max_err_rate=machine_config.max_err_rate,
+                                                  max_it_rate=machine_config.max_it_rate,
+                                                  on_message=self.__count_message)
+        # Raw datagrams recorded for replay (benchmarks/replay_capture.py), opt-in
+        self.__traffic_capture = None
+        if machine_config.capture_dir:
+            self.__traffic_capture = create_capture_writer(capture_dir=machine_config.capture_dir,
+                                                           hostname=self.__dut_hostname)
+        self.__last_reported_shed = 0
 
         # Variables to control rebooting (soft app and soft OS) process
         self.__soft_app_reboot_count = 0
         self.__soft_os_reboot_count = 0
         self.__hard_reboot_count = 0
+        # The hard reboot counter is reset by any #IT, the breaker detects the DUTs that crash again right after.
+        # A power cycle is only a breaker failure if the DUT did not run crash_loop_uptime since the previous one,
+        # so the independent hangs of a healthy board do not quarantine it
+        self.__crash_loop_uptime = machine_config.crash_loop_uptime
+        self.__first_iteration_since_hard_reboot = None
+        self.__dut_breaker = CircuitBreaker(name=self.__dut_hostname, logger_name=logger_name,
+                                            failure_threshold=machine_config.crash_loop_reboots,
+                                            window=machine_config.crash_loop_window,
+                                            open_time=self.__LONG_REBOOT_WAIT_TIME_AFTER_PROBLEM,
+                                            max_open_time=self.__MAX_QUARANTINE_TIME,
+                                            probation_time=self.__QUARANTINE_PROBATION_TIME,
+                                            hostname=self.__dut_hostname)
 
         super(Machine, self).__init__(*args, **kwargs)
 
@@ -119,83 +211,250 @@ class Machine(threading.Thread):
         if turn_on_status != ErrorCodes.SUCCESS:
             self.__logger.error(f"Failed to turn ON the {self}")
 
-        # Wait and start the app for the first time
+        self.__stage_timers = stage_timers = get_stage_timers()
+        self.__message_pipeline.stage_timers = stage_timers
+        # Wait and start the app for the first time, if the beam is paused the app starts on the resume
         self.__wait_for_booting()
-        self.__soft_app_reboot()
+        if self.__pause_requested.is_set() is False:
+            self.__soft_app_reboot()
         while self.__stop_event.is_set() is False:
             try:
-                data, address = self.__messages_socket.recvfrom(self.__DATA_SIZE)
-                self.__dut_logging_obj(message=data)
-                data_decoded = data.decode("ascii")[1:]
-                
-                connection_type_str = "UnknownConn:" + data_decoded[:10]
-
-                for substring in self.__ALL_POSSIBLE_CONNECTION_TYPES:
-                    # It must start from the 1, as the 0 is the ECC defining byte
-                    if data_decoded.startswith(substring):
-                        connection_type_str = substring
-                        break
-
-                # TO AVOID making sequential reboot when receiving good data,
-                # This is necessary to fix the behavior when a device keeps crashing for multiple times
-                # in a short period, but eventually comes to life again
-                if connection_type_str == "#IT":
-                    self.__soft_app_reboot_count = 0
-                    self.__hard_reboot_count = 0
-
-                self.__logger.debug(f"{connection_type_str} - Connection from {self}")
+                if self.__pause_requested.is_set():
+                    self.__beam_pause()
+                    continue
+                buffer_index = self.__receive_buffer_index
+                self.__receive_buffer_index = (buffer_index + 1) % self.__RECEIVE_BUFFER_RING_SIZE
+                start_ns = time.perf_counter_ns() if stage_timers else 0
+                data_size, address = self.__messages_socket.recvfrom_into(self.__receive_views[buffer_index])
+                if stage_timers:
+                    stage_timers.record(stage="machine.receive_wait", start_ns=start_ns)
+                self.__received_messages += 1
+                self.__received_bytes += data_size
+                # Same clock as time.monotonic, the nanoseconds go to the receive timestamps of the DUT log
+                receive_ns = time.monotonic_ns()
+                self.__last_message_time = receive_ns / 1e9
+                message = self.__receive_views[buffer_index][:data_size]
+                if self.__traffic_capture:
+                    self.__traffic_capture.write(data=message)
+                self.__message_pipeline.receive(buffer=self.__receive_buffers[buffer_index], message=message,
+                                                now=self.__last_message_time, receive_ns=receive_ns)
 
                 if self.__command_factory.is_command_window_timed_out:
-                    self.__logger.info(
-                        f"Benchmark exceeded the command execution window, executing another one now on {self}.")
+                    stop_condition = self.__command_factory.stop_condition_reached
+                    if stop_condition:
+                        self.__logger.info(f"Benchmark {stop_condition}, executing another one now on {self}.")
+                    else:
+                        self.__logger.info(
+                            f"Benchmark exceeded the command execution window, executing another one now on {self}.")
                     self.__soft_app_reboot(previous_log_end_status=EndStatus.NORMAL_END)
             except (TimeoutError, socket.timeout):
-                # Soft app reboot
-                soft_app_reboot_status = self.__soft_app_reboot(previous_log_end_status=EndStatus.SOFT_APP_REBOOT)
-                if soft_app_reboot_status == ErrorCodes.SUCCESS:
+                # Everything received before the failure goes to the disk before the recovery starts
+                self.__message_pipeline.flush()
+                if self.__traffic_capture:
+                    self.__traffic_capture.flush()
+                if self.__pause_requested.is_set():
+                    # The beam is off, the DUT is not rebooted, the app is restarted on the resume
                     continue
-                # Soft OS reboot
-                soft_os_reboot = self.__soft_os_reboot()
-                if soft_os_reboot == ErrorCodes.SUCCESS:
+                crashed_codename = self.__command_factory.current_codename
+                # Counted before the reboot, so a benchmark that reached max_crashes is rotated right away
+                self.__command_factory.record_crash()
+                # The previous recovery did not reach an #IT
+                self.__reboot_policy.end_recovery(success=False)
+                self.__recover(crashed_codename=crashed_codename)
+            finally:
+                self.__report_rates()
+
+        # The DUT log is buffered, make sure that everything received is on the disk
+        self.__message_pipeline.flush()
+        if self.__traffic_capture:
+            self.__traffic_capture.close()
+        self.__command_factory.end_exposure()
+        if self.__boot_telnet_session:
+            self.__boot_telnet_session.close()
+
+    def __beam_pause(self) -> None:
+        """ Kill the app and finish the DUT log, then wait for the resume without any reboot or timeout.
+        On the resume the current benchmark starts again with the rest of its command window
+        """
+        start_time = time.monotonic()
+        self.__paused = True
+        self.__command_factory.pause()
+        # The pending recovery cannot be judged, the app is killed on purpose
+        self.__reboot_policy.cancel_recovery()
+        self.__logger.info(f"BEAM PAUSE, killing {self.__command_factory.current_codename} on {self}")
+        try:
+            with self.__open_telnet_session() as tn:
+                tn.write(self.__command_factory.current_command_cmd_kill)
+                tn.read_very_eager()
+        except (OSError, EOFError, RuntimeError) as e:
+            # A DUT that is down is not rebooted while the beam is off, the resume handles it
+            self.__logger.error(f"Could not kill the app for the beam pause {self} - {e}")
+        self.__finish_dut_log(end_status=EndStatus.BEAM_PAUSE)
+        log_server_event(ServerEvent.BEAM_PAUSE, hostname=self.__dut_hostname, paused=True,
+                         codename=self.__command_factory.current_codename)
+        while self.__pause_requested.is_set() and self.__stop_event.is_set() is False:
+            self.__resume_event.wait(timeout=self.__BEAM_PAUSE_POLL_INTERVAL)
+        self.__paused = False
+        if self.__stop_event.is_set():
+            return
+
+        # The messages sent before the kill belong to the finished log
+        self.__drain_messages_socket()
+        self.__command_factory.resume()
+        self.__soft_app_reboot_count = 0
+        self.__logger.info(f"BEAM RESUME after {time.monotonic() - start_time:.0f}s, "
+                           f"starting {self.__command_factory.current_codename} on {self}")
+        log_server_event(ServerEvent.BEAM_PAUSE, hostname=self.__dut_hostname, paused=False,
+                         codename=self.__command_factory.current_codename, duration=elapsed_since(start_time))
+        self.__soft_app_reboot()
+
+    def __recover(self, crashed_codename: str) -> None:
+        """ Try the reboot tiers in the order given by the reboot policy, until one of them succeeds.
+        The power cycle is always the last tier
+        :param crashed_codename: benchmark running when the DUT stopped sending messages
+        """
+        escalation_order = self.__reboot_policy.escalation_order(codename=crashed_codename)
+        # The log ends with the first tier, before the telnet login, the power cycle or the boot that may take long
+        self.__finish_dut_log(end_status=escalation_order[0])
+        for tier in escalation_order:
+            start_time = time.monotonic()
+            if tier == EndStatus.SOFT_APP_REBOOT:
+                status = self.__soft_app_reboot(previous_log_end_status=EndStatus.SOFT_APP_REBOOT)
+            elif tier == EndStatus.SOFT_OS_REBOOT:
+                status = self.__soft_os_reboot()
+                if status == ErrorCodes.SUCCESS:
                     self.__soft_app_reboot(previous_log_end_status=EndStatus.SOFT_OS_REBOOT)
-                    continue
+            else:
                 # Finally, the Power cycle Hard reboot
+                self.__error_rate_monitor.record_crash(end_status=EndStatus.HARD_REBOOT, codename=crashed_codename)
                 self.__hard_reboot()
                 self.__soft_app_reboot(previous_log_end_status=EndStatus.HARD_REBOOT)
+                if self.__quarantined:
+                    self.__reboot_policy.cancel_recovery()
+                else:
+                    self.__reboot_policy.begin_recovery(tier=tier, codename=crashed_codename, start_time=start_time)
+                return
+            if status == ErrorCodes.SUCCESS:
+                self.__error_rate_monitor.record_crash(end_status=tier, codename=crashed_codename)
+                # The recovery is decided by the next #IT or timeout
+                self.__reboot_policy.begin_recovery(tier=tier, codename=crashed_codename, start_time=start_time)
+                return
+            if status not in self.__REBOOT_NOT_ATTEMPTED:
+                self.__reboot_policy.record_attempt(tier=tier, codename=crashed_codename, success=False,
+                                                    duration=time.monotonic() - start_time)
+
+    def __count_message(self, connection_type_str: str, message: Union[bytes, memoryview], keep: bool) -> None:
+        """ Count a message already written on the DUT log by the message pipeline
+        :param connection_type_str: classification of the message
+        :param message: the message, including the ECC byte
+        :param keep: False if the message was shed by the ingest budget, it is only counted
+        """
+        stage_timers = self.__stage_timers
+        start_ns = time.perf_counter_ns() if stage_timers else 0
+        exposure = self.__command_factory.record_message(connection_type=connection_type_str,
+                                                         now=self.__last_message_time)
+        self.__error_rate_monitor.record_message(connection_type=connection_type_str,
+                                                 codename=self.__command_factory.current_codename,
+                                                 now=self.__last_message_time, exposure=exposure)
+        if stage_timers:
+            start_ns = stage_timers.record(stage="machine.classify_and_count", start_ns=start_ns)
+        if self.__live_broker and keep:
+            self.__live_broker.publish_dut_message(hostname=self.__dut_hostname, message_type=connection_type_str,
+                                                   message=message)
+            if stage_timers:
+                start_ns = stage_timers.record(stage="machine.live_publish", start_ns=start_ns)
+
+        # TO AVOID making sequential reboot when receiving good data,
+        # This is necessary to fix the behavior when a device keeps crashing for multiple times
+        # in a short period, but eventually comes to life again
+        if connection_type_str == "#IT":
+            self.__soft_app_reboot_count = 0
+            self.__hard_reboot_count = 0
+            self.__dut_breaker.record_success(now=self.__last_message_time)
+            if self.__first_iteration_since_hard_reboot is None:
+                self.__first_iteration_since_hard_reboot = self.__last_message_time
+            self.__last_iteration_time = self.__last_message_time
+            self.__reboot_policy.end_recovery(success=True, now=self.__last_message_time)
+
+        # The message is only formatted by the logging listener thread
+        if keep:
+            self.__logger.debug("%s - Connection from %s", connection_type_str, self)
+        if stage_timers:
+            stage_timers.record(stage="machine.logging_enqueue", start_ns=start_ns)
+
+    def __report_rates(self) -> None:
+        """ Write the rolling SDC/error rates on the server log every __RATE_REPORT_INTERVAL """
+        now = time.monotonic()
+        if now - self.__last_rate_report_time > self.__RATE_REPORT_INTERVAL:
+            self.__last_rate_report_time = now
+            self.__logger.info(f"RATES {self.__dut_hostname} - {self.__error_rate_monitor.summary(now=now)}")
+            shed_messages = self.__message_pipeline.shed
+            if shed_messages:
+                shed = sum(shed_messages.values())
+                if shed > self.__last_reported_shed:
+                    self.__logger.warning(f"INGEST OVERLOAD on {self}, {shed - self.__last_reported_shed} messages "
+                                          f"shed since the last report, totals:{shed_messages}")
+                self.__last_reported_shed = shed
 
     def __telnet_login(self) -> telnetlib.Telnet:
         """ Return a telnet session
         :return:
         """
-        tn = telnetlib.Telnet(self.__dut_ip, timeout=self.__max_timeout_time)
-
-        if not tn.read_until(b'ogin: ', timeout=self.__max_timeout_time):
-            raise RuntimeError("Telnet error: Failed to login into Telnet. Could not input username.")
-        tn.write(self.__dut_username.encode('ascii') + b'\n')
-        tn.read_very_eager()
-
-        if not tn.read_until(b'assword: ', timeout=self.__max_timeout_time):
-            raise RuntimeError("Telnet error: Could not login into Telnet. Could not input password.")
-        tn.write(self.__dut_password.encode('ascii') + b'\n')
-
-        if not tn.read_until(b'$ ', timeout=self.__max_timeout_time):
-            raise RuntimeError("Telnet error: Could not login into Telnet. Failed after trying to enter inputs.")
-
+        tn = telnet_login(ip=self.__dut_ip, port=self.__telnet_port, username=self.__dut_username,
+                          password=self.__dut_password, timeout=self.__max_timeout_time)
         self.__logger.debug("Successfully logged into Telnet.")
         return tn
 
+    def __open_telnet_session(self) -> telnetlib.Telnet:
+        """ Reuse the session opened by the boot probe, otherwise login again
+        :return:
+        """
+        tn, self.__boot_telnet_session = self.__boot_telnet_session, None
+        if tn is not None:
+            return tn
+        with timed_stage(stage="machine.telnet_login"):
+            return self.__telnet_login()
+
+    def __finish_dut_log(self, end_status: EndStatus) -> None:
+        """ Finish the DUT log as soon as the recovery tier is decided,
+        so the log end time is not delayed by the app start, the power cycle or the boot
+        """
+        self.__message_pipeline.finish_log(end_status=end_status, now=time.monotonic())
+        # The app is killed or restarted after the log end
+        self.__command_factory.end_exposure()
+
+    def __log_reboot_event(self, tier: EndStatus, status: ErrorCodes, counter: int, start_time: float,
+                           **fields) -> None:
+        """ Write the outcome of a reboot tier on the structured event log """
+        if status in (ErrorCodes.THREAD_EVENT_IS_SET, ErrorCodes.DISABLED_SOFT_OS_REBOOT):
+            return
+        if status == ErrorCodes.SUCCESS:
+            self.__successful_reboots[tier.name] += 1
+        log_server_event(ServerEvent.REBOOT, failed=status != ErrorCodes.SUCCESS, hostname=self.__dut_hostname,
+                         tier=tier.name, counter=counter, status=str(status), duration=elapsed_since(start_time),
+                         codename=self.__command_factory.current_codename, **fields)
+
     def __soft_app_reboot(self, previous_log_end_status: EndStatus = None) -> ErrorCodes:
         """ kill and start an app on the device
         :previous_log_end_status: if it is not the first time that the device will run an app,
         then pass the end_status, otherwise leave it None
         :return: If the start was successful or not
         """
+        start_time = time.monotonic()
+        with timed_stage(stage="machine.soft_app_reboot"):
+            status = self.__execute_soft_app_reboot(previous_log_end_status=previous_log_end_status)
+        self.__log_reboot_event(tier=EndStatus.SOFT_APP_REBOOT, status=status, counter=self.__soft_app_reboot_count,
+                                start_time=start_time, previous_log_end_status=str(previous_log_end_status))
+        return status
+
+    def __execute_soft_app_reboot(self, previous_log_end_status: EndStatus) -> ErrorCodes:
+        """ Execute the soft app reboot, see __soft_app_reboot """
         if self.__stop_event.is_set():
             return ErrorCodes.THREAD_EVENT_IS_SET
 
-        if previous_log_end_status is None and self.__dut_logging_obj is not None:
+        if previous_log_end_status is None and self.__message_pipeline.dut_logging is not None:
             self.__logger.exception(
-                f"INCORRECT CONFIGURATION: previous_ending_status is None and __dut_logging_obj is Not None - {self}")
+                f"INCORRECT CONFIGURATION: previous_ending_status is None and the DUT log is Not None - {self}")
             raise
 
         if self.__soft_app_reboot_count >= self.__MAX_SEQUENTIALLY_SOFT_APP_REBOOTS:
@@ -208,13 +467,35 @@ class Machine(threading.Thread):
         # self.__command_factory produces the commands that will be executed
         # The commands are already encoded
         cmd_line_run, cmd_kill, test_name, header = self.__command_factory.get_commands_and_test_info()
+        if self.__auto_started_app_messages and not self.__is_selected_benchmark(
+                message=self.__auto_started_app_messages[0][0], header=header):
+            # The image started another benchmark (or its #HEADER was lost), it is killed and the selected one started
+            self.__logger.info(f"The app started during the boot is not {test_name}, restarting it on {self}")
+            self.__auto_started_app_messages.clear()
+        if self.__auto_started_app_messages:
+            # The app started by itself during the boot, restarting it would only lose messages
+            if previous_log_end_status is not None:
+                self.__finish_dut_log(end_status=previous_log_end_status)
+            dut_logging = DUTLogging(log_dir=self.__dut_log_path, test_name=test_name, test_header=header,
+                                     hostname=self.__dut_hostname, logger_name=self.__logger_name,
+                                     receive_timestamps=self.__receive_timestamps)
+            self.__message_pipeline.start_log(dut_logging=dut_logging)
+            for message, receive_ns in self.__auto_started_app_messages:
+                dut_logging(message=message, receive_ns=receive_ns)
+            self.__auto_started_app_messages.clear()
+            self.__logger.info(f"SKIPPING THE SOFT APP REBOOT, the app is already running on {self}")
+            self.__soft_app_reboot_count += 1
+            return ErrorCodes.SUCCESS
         # try __MAX_START_APP_TRIES times to start the app on the DUT
         for try_i in range(self.__MAX_TELNET_TRIES):
             # All loops must stop after the event is set
             if self.__stop_event.is_set():
                 break
             try:
-                with self.__telnet_login() as tn:
+                with self.__open_telnet_session() as tn:
+                    # Only a NORMAL_END rotation has a log here, a recovery finished it when its first tier was chosen
+                    if previous_log_end_status is not None:
+                        self.__finish_dut_log(end_status=previous_log_end_status)
                     # Kill first
                     tn.write(cmd_kill)
                     tn.read_very_eager()
@@ -229,14 +510,11 @@ class Machine(threading.Thread):
                     self.__logger.info(f"SUCCESSFULLY SEND THE SOFT REBOOT CMDS:{cmd_kill} "
                                        f"COUNTER:{self.__soft_app_reboot_count} "
                                        f"TRY:{try_i} on {self} CMDEXEC={cmd_line_run[:10]}...")
-                    # Close the DUTLogging only if there is a log file open
-                    if self.__dut_logging_obj:
-                        self.__dut_logging_obj.finish_this_dut_log(end_status=previous_log_end_status)
-                    # Delete the current dut logging obj
-                    del self.__dut_logging_obj
-                    self.__dut_logging_obj = DUTLogging(log_dir=self.__dut_log_path, test_name=test_name,
-                                                        test_header=header, hostname=self.__dut_hostname,
-                                                        logger_name=self.__logger_name)
+                    self.__message_pipeline.start_log(dut_logging=DUTLogging(
+                        log_dir=self.__dut_log_path, test_name=test_name, test_header=header,
+                        hostname=self.__dut_hostname, logger_name=self.__logger_name,
+                        receive_timestamps=self.__receive_timestamps
+                    ))
                 self.__soft_app_reboot_count += 1
                 return ErrorCodes.SUCCESS
             except OSError as e:
@@ -250,37 +528,118 @@ class Machine(threading.Thread):
                 self.__logger.info(f"Command execution not successful TRY:{try_i} on {self}")
         return ErrorCodes.TELNET_CONNECTION_ERROR
 
-    def __wait_for_booting(self):
-        current_timestamp = time.time()
-        start_timestamp = current_timestamp
-        while (current_timestamp - start_timestamp) <= self.__boot_waiting_time:
+    def __wait_for_booting(self) -> ErrorCodes:
+        start_time = time.monotonic()
+        self.__boot_detected_by = None
+        self.__auto_started_app_messages.clear()
+        with timed_stage(stage="machine.wait_for_booting"):
+            status = self.__execute_wait_for_booting()
+        if status != ErrorCodes.THREAD_EVENT_IS_SET:
+            log_server_event(ServerEvent.BOOT_WAIT, failed=status != ErrorCodes.SUCCESS,
+                             hostname=self.__dut_hostname, status=str(status), duration=elapsed_since(start_time),
+                             detected_by=self.__boot_detected_by)
+        return status
+
+    def __execute_wait_for_booting(self) -> ErrorCodes:
+        """ Wait the DUT to boot, it returns SUCCESS when it is possible to login with telnet,
+        or when the app already started by itself (boot_heartbeat enabled).
+        The telnet session is kept open for the next app start
+        """
+        start_timestamp = time.monotonic()
+        if self.__boot_heartbeat:
+            # Whatever was received before the boot cannot be a proof of life
+            self.__drain_messages_socket()
+        while (time.monotonic() - start_timestamp) <= self.__boot_waiting_time:
             # All loops must stop after the event is set
             if self.__stop_event.is_set():
-                break
-            # Pinging the board
+                return ErrorCodes.THREAD_EVENT_IS_SET
+            probe_timestamp = time.monotonic()
             try:
-                subprocess.check_output(["ping", "-c", "1", self.__dut_ip], timeout=self.__BOOT_PING_TIMEOUT)
-                # Try to see if the telnet login is indeed possible
-                tn = self.__telnet_login()
-                tn.close()
-                self.__logger.info(f"Boot ping successful {self}")
+                # Cheap probe first, the telnet login is only tried when the telnet port accepts connections
+                socket.create_connection((self.__dut_ip, self.__telnet_port), timeout=self.__BOOT_PROBE_TIMEOUT).close()
+                if self.__boot_telnet_session:
+                    self.__boot_telnet_session.close()
+                self.__boot_telnet_session = self.__telnet_login()
+                self.__boot_detected_by = self.__boot_detected_by or "telnet"
+                self.__logger.info(f"Boot probe successful after {time.monotonic() - start_timestamp:.2f}s {self}")
                 return ErrorCodes.SUCCESS
-                # return ErrorCodes.SUCCESS
-            except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
-                self.__logger.error(f"Boot ping failed {self} error:{e}")
             except (OSError, EOFError, RuntimeError) as e:
-                self.__logger.error(f"Telnet conn failed {self} error:{e}")
-                if isinstance(e, OSError) and e.errno == errno.ECONNREFUSED:
-                    # When connection is refused, it crashes instantaneously
-                    self.__stop_event.wait(self.__BOOT_PING_TIMEOUT)
-            current_timestamp = time.time()
-
+                # Connection refused and timeouts are expected while the DUT boots
+                self.__logger.debug(f"Boot probe failed {self} error:{e}")
+            probe_interval = max(self.__BOOT_PROBE_INTERVAL - (time.monotonic() - probe_timestamp), 0)
+            if self.__boot_heartbeat:
+                if self.__wait_for_boot_heartbeat(timeout=probe_interval, start_timestamp=start_timestamp):
+                    return ErrorCodes.SUCCESS
+            else:
+                # Never sleep with time, but with event
+                self.__stop_event.wait(probe_interval)
+
+        self.__logger.error(f"The DUT did not boot in {self.__boot_waiting_time}s {self}")
         return ErrorCodes.HOST_UNREACHABLE
 
-    def __soft_os_reboot(self):
+    def __drain_messages_socket(self) -> None:
+        """ Discard the messages waiting on the receive socket """
+        while select.select([self.__messages_socket], [], [], 0)[0]:
+            self.__messages_socket.recv_into(self.__receive_buffers[0])
+
+    def __wait_for_boot_heartbeat(self, timeout: float, start_timestamp: float) -> bool:
+        """ Watch the receive socket during the boot, any message starting with a valid ECC byte is a proof of life
+        :param timeout: maximum time waiting for a message
+        :param start_timestamp: time.monotonic of the boot wait start
+        :return: True if the app is already running, so it is not necessary to start it with telnet
+        """
+        deadline = time.monotonic() + timeout
+        selected_header = None
+        while select.select([self.__messages_socket], [], [], max(deadline - time.monotonic(), 0))[0]:
+            buffer = self.__receive_buffers[0]
+            data_size = self.__messages_socket.recv_into(buffer)
+            if data_size == 0 or buffer[0] not in ECC_STATUS_VALUES:
+                continue
+            if self.__boot_detected_by is None:
+                self.__boot_detected_by = "heartbeat"
+                self.__logger.info(f"Boot heartbeat received after {time.monotonic() - start_timestamp:.2f}s {self}")
+            connection_type_str = classify_message(buffer=buffer, data_size=data_size)
+            if connection_type_str in self.__APP_RUNNING_CONNECTION_TYPES:
+                message = bytes(buffer[:data_size])
+                if selected_header is None:
+                    # Same call as the next app start, so the benchmark is rotated now if its window is over
+                    selected_header = self.__command_factory.get_commands_and_test_info()[3]
+                if not self.__is_selected_benchmark(message=message, header=selected_header):
+                    # Another benchmark, or its #HEADER was lost: it is restarted as soon as telnet is ready
+                    if self.__boot_detected_by != "other app":
+                        self.__boot_detected_by = "other app"
+                        self.__logger.info(f"The app started during the boot is not "
+                                           f"{self.__command_factory.current_codename} ({connection_type_str}) {self}")
+                    continue
+                self.__boot_detected_by = "app"
+                self.__auto_started_app_messages.append((message, time.monotonic_ns()))
+                self.__logger.info(f"The app started by itself during the boot ({connection_type_str}) {self}")
+                return True
+        return False
+
+    @staticmethod
+    def __is_selected_benchmark(message: bytes, header: str) -> bool:
+        """ An app started by itself during the boot is the selected benchmark only if its first message
+        is the #HEADER of that benchmark
+        :param message: first message of the app, including the ECC byte
+        :param header: header of the selected benchmark
+        """
+        _, message = split_sequence_number(message=message)
+        return message[1:].rstrip(b"\x00\r\n ") == f"#HEADER {header}".encode("ascii", errors="replace")
+
+    def __soft_os_reboot(self) -> ErrorCodes:
         """ SOFT OS REBOOT: Reboot the operating system, or try to reboot using telnet
             THE KILL APP WILL MAKE THE LOGGING ENDING BASED ON THE EndStatus
         """
+        start_time = time.monotonic()
+        with timed_stage(stage="machine.soft_os_reboot"):
+            status = self.__execute_soft_os_reboot()
+        self.__log_reboot_event(tier=EndStatus.SOFT_OS_REBOOT, status=status, counter=self.__soft_os_reboot_count,
+                                start_time=start_time)
+        return status
+
+    def __execute_soft_os_reboot(self) -> ErrorCodes:
+        """ Execute the soft OS reboot, see __soft_os_reboot """
         if self.__stop_event.is_set():
             return ErrorCodes.THREAD_EVENT_IS_SET
 
@@ -295,7 +654,7 @@ class Machine(threading.Thread):
         default_os_reboot_cmd = b"sudo /sbin/reboot\r\n"
         # for try_i in range(self.__MAX_TELNET_TRIES):
         try:
-            with self.__telnet_login() as tn:
+            with self.__open_telnet_session() as tn:
                 # OS reboot
                 tn.write(default_os_reboot_cmd)
                 tn.read_very_eager()
@@ -304,7 +663,7 @@ class Machine(threading.Thread):
             self.__logger.info(f"SUCCESSFUL OS REBOOT:{default_os_reboot_cmd} "
                                f"COUNTER:{self.__soft_os_reboot_count} on {self}")
             # This time is just to make the OS start the rebooting process;
-            # otherwise the next ping will be successful, right after sudo reboot command
+            # otherwise the next boot probe will be successful, right after sudo reboot command
             self.__stop_event.wait(self.__WAIT_AFTER_SOFT_OS_REBOOT_TIME)
             # Wait the machine to boot
             self.__wait_for_booting()
@@ -320,6 +679,12 @@ class Machine(threading.Thread):
                 return ErrorCodes.HOST_UNREACHABLE
             return ErrorCodes.TELNET_CONNECTION_ERROR
 
+    def __crashed_right_after_hard_reboot(self) -> bool:
+        """ The DUT did not send #IT for crash_loop_uptime seconds since the previous hard reboot """
+        if self.__first_iteration_since_hard_reboot is None:
+            return True
+        return self.__last_iteration_time - self.__first_iteration_since_hard_reboot < self.__crash_loop_uptime
+
     def __hard_reboot(self):
         """ reboot the device based on reboot_machine module
         :return reboot_status
@@ -327,13 +692,21 @@ class Machine(threading.Thread):
         if self.__stop_event.is_set():
             return ErrorCodes.THREAD_EVENT_IS_SET
 
+        start_time = time.monotonic()
+        if self.__boot_telnet_session:
+            self.__boot_telnet_session.close()
+            self.__boot_telnet_session = None
         reboot_sleep_time = self.__POWER_SWITCH_DEFAULT_TIME_REST
-        if self.__hard_reboot_count > self.__MAX_SEQUENTIALLY_HARD_REBOOTS:
-            # We turn off the device for __LONG_REBOOT_WAIT_TIME_AFTER_PROBLEM seconds
-            reboot_sleep_time = self.__LONG_REBOOT_WAIT_TIME_AFTER_PROBLEM
+        self.__hard_reboot_count += 1
+        self.__quarantined = False
+        if self.__crashed_right_after_hard_reboot():
+            self.__quarantined = self.__dut_breaker.record_failure(now=start_time) == BreakerState.OPEN
+        self.__first_iteration_since_hard_reboot = None
+        if self.__quarantined:
+            # Crash loop, the device stays off until the breaker becomes half-open
+            reboot_sleep_time = max(self.__dut_breaker.remaining_open_time(now=start_time), reboot_sleep_time)
             self.__hard_reboot_count = 0
-        else:
-            self.__hard_reboot_count += 1
+            self.__logger.error(f"QUARANTINE {self} is in a crash loop, it will be OFF for {reboot_sleep_time:.0f}s")
 
         self.__logger.info(
             f"Trying to perform a hard reboot on device (power cycle). Sleep interval is {reboot_sleep_time} on {self}")
@@ -351,11 +724,19 @@ class Machine(threading.Thread):
             self.__logger.error(reboot_msg)
         else:
             self.__logger.info(reboot_msg + " finished.")
+        # After the quarantine the DUT gets a trial (half-open)
+        self.__dut_breaker.allow()
         # Wait the machine to boot
-        self.__wait_for_booting()
+        boot_status = self.__wait_for_booting()
         # Reset the soft app and the soft os reboot as the system will be hard rebooted
         self.__soft_app_reboot_count = 0
         self.__soft_os_reboot_count = 0
+        hard_reboot_status = off_status if off_status != ErrorCodes.SUCCESS else on_status
+        self.__log_reboot_event(tier=EndStatus.HARD_REBOOT, status=hard_reboot_status,
+                                counter=self.__hard_reboot_count, start_time=start_time,
+                                off_status=str(off_status), on_status=str(on_status), boot_status=str(boot_status),
+                                rest_time=reboot_sleep_time)
+        return hard_reboot_status
 
     def join(self, timeout: Optional[float] = None) -> None:
         self.__logger.info(f"Joining Machine {self}.")
@@ -379,3 +760,53 @@ class Machine(threading.Thread):
     def stop(self) -> None:
         """ Stop the main function before join the thread """
         self.__stop_event.set()
+        self.__resume_event.set()
+
+    def pause(self) -> None:
+        """ Beam interrupted: the Machine kills the app, finishes the DUT log (#SERVER_DUE:beam pause)
+        and waits for resume(), the command window and the timeouts do not run meanwhile.
+        The app is killed after the next message or timeout
+        """
+        self.__resume_event.clear()
+        self.__pause_requested.set()
+
+    def resume(self) -> None:
+        """ Beam back: the current benchmark starts again on the DUT, without any reboot """
+        self.__pause_requested.clear()
+        self.__resume_event.set()
+
+    @property
+    def metrics(self) -> dict:
+        """ Counters of this machine, it is safe to read them from other threads
+        :return: dict with the counters
+        """
+        now = time.monotonic()
+        last_message_age, last_iteration_age = None, None
+        if self.__last_message_time is not None:
+            last_message_age = now - self.__last_message_time
+        if self.__last_iteration_time is not None:
+            last_iteration_age = now - self.__last_iteration_time
+        return {
+            "hostname": self.__dut_hostname,
+            "codename": self.__command_factory.current_codename,
+            "paused": self.__paused,
+            "received_messages": self.__received_messages,
+            "received_bytes": self.__received_bytes,
+            "last_message_age": last_message_age,
+            "last_iteration_age": last_iteration_age,
+            "duplicates_removed": self.__message_pipeline.duplicates,
+            "reordered_messages": self.__message_pipeline.reordered,
+            "lost_messages": self.__message_pipeline.lost,
+            "shed_messages": self.__message_pipeline.shed,
+            "reboot_counters": {"soft_app": self.__soft_app_reboot_count, "soft_os": self.__soft_os_reboot_count,
+                                "hard": self.__hard_reboot_count},
+            "successful_reboots": dict(self.__successful_reboots),
+            "reboot_policy": {"name": self.__reboot_policy.name, "tiers": self.__reboot_policy.summary()},
+            "rates": self.__error_rate_monitor.snapshot(),
+            "effective_time": self.__command_factory.effective_time,
+            "exposure": self.__command_factory.exposure_totals,
+            "circuit_breakers": {"dut": self.__dut_breaker.state.name,
+                                 "benchmarks": self.__command_factory.benchmark_breakers},
+            # Shared by all the machines of the process
+            "log_files": log_file_manager_stats(),
+        }
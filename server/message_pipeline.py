@@ -0,0 +1,155 @@
+"""
+Path of a DUT message from the receive buffer to the DUT log: deduplication, reordering (#SEQ:<n>),
+classification, ingest budget and the DUT log of the running app (rotated on each app start).
+It is shared by the Machine and by the capture replay (benchmarks/replay_capture.py),
+so a replay writes the DUT logs with the same code as the server.
+"""
+import time
+import typing
+
+from .deduplication import DUPLICATE_LINE_PREFIX, MessageDeduplicator, ReorderBuffer
+from .dut_logging import DUTLogging, EndStatus
+from .ingest_budget import IngestBudget
+
+# Possible connection string
+CONNECTION_TYPES = [  # Add more if necessary
+    '#IT', '#HEADER', '#BEGIN', '#END', '#INF', '#ERR', "#SDC", "#ABORT"
+]
+# The messages are classified without decoding them
+_CONNECTION_TYPES_BYTES = [(conn.encode("ascii"), conn) for conn in CONNECTION_TYPES]
+
+
+def classify_message(buffer: typing.Union[bytes, bytearray], data_size: int) -> str:
+    """ Find the connection type of a message directly on the receive buffer
+    It must start from the 1, as the 0 is the ECC defining byte
+    :param buffer: receive buffer
+    :param data_size: number of bytes received
+    :return: connection type string
+    """
+    for substring_bytes, substring in _CONNECTION_TYPES_BYTES:
+        if buffer.startswith(substring_bytes, 1, data_size):
+            return substring
+    return "UnknownConn:" + buffer[1:min(data_size, 11)].decode("ascii", errors="replace")
+
+
+class MessagePipeline:
+    """ Deduplicate, reorder, classify and log the messages of one DUT """
+
+    def __init__(self, dedup_window: float = 0.0, reorder_window: float = None, max_err_rate: float = None,
+                 max_it_rate: float = None, on_message: typing.Callable = None):
+        """
+        :param dedup_window: same as the machine yaml dedup_window, 0 disables the deduplication
+        :param reorder_window: same as the machine yaml reorder_window, None disables the reordering
+        :param max_err_rate: same as the machine yaml max_err_rate, None is unlimited
+        :param max_it_rate: same as the machine yaml max_it_rate, None is unlimited
+        :param on_message: called with (connection_type, message, keep) for each message, in order, after
+               the DUT log write. keep is False for the messages shed by the ingest budget
+        """
+        # Retransmitted/duplicated datagrams are dropped before they reach the log and the counters
+        self.__deduplicator = MessageDeduplicator(window=dedup_window) if dedup_window else None
+        # Only for the benchmarks that send the #SEQ:<n> prefix
+        self.__reorder_buffer = ReorderBuffer(window=reorder_window) if reorder_window else None
+        # The #ERR and #IT floods are shed before the DUT log
+        self.__ingest_budget = None
+        if max_err_rate is not None or max_it_rate is not None:
+            self.__ingest_budget = IngestBudget(max_err_rate=max_err_rate, max_it_rate=max_it_rate)
+        self.__on_message = on_message
+        self.__dut_logging = None
+        # Stage timers of the thread that receives the messages, None if the instrumentation is disabled
+        self.stage_timers = None
+
+    def receive(self, buffer: typing.Union[bytes, bytearray], message: typing.Union[bytes, memoryview], now: float,
+                receive_ns: int = None) -> None:
+        """ Pass a received message through the pipeline
+        :param buffer: buffer that starts with the message, it is used for the classification without copying
+        :param message: the message, including the ECC byte
+        :param now: time.monotonic of the reception (the capture time on a replay)
+        :param receive_ns: receive time in nanoseconds for the receive timestamps of the DUT log
+        """
+        stage_timers = self.stage_timers
+        start_ns = time.perf_counter_ns() if stage_timers else 0
+        if self.__deduplicator and self.__deduplicator.is_duplicate(message=message, now=now):
+            # It may be a real repeat, the dropped message stays on the DUT log as a server line
+            if self.__dut_logging:
+                content = bytes(message[1:]).rstrip(b"\x00\r\n").decode("ascii", errors="backslashreplace")
+                self.__dut_logging.write_server_line(line=f"{DUPLICATE_LINE_PREFIX} {content}")
+            return
+        if stage_timers:
+            stage_timers.record(stage="machine.dedup", start_ns=start_ns)
+        if self.__reorder_buffer is None:
+            self.__process(buffer=buffer, message=message, now=now, receive_ns=receive_ns)
+        else:
+            # The waiting messages are copied, the receive buffer is reused
+            for ordered_message in self.__reorder_buffer.push(message=bytes(message), now=now):
+                self.__process(buffer=ordered_message, message=ordered_message, now=now)
+
+    def __process(self, buffer: typing.Union[bytes, bytearray], message: typing.Union[bytes, memoryview],
+                  now: float, receive_ns: int = None) -> None:
+        stage_timers = self.stage_timers
+        start_ns = time.perf_counter_ns() if stage_timers else 0
+        connection_type_str = classify_message(buffer=buffer, data_size=len(message))
+        # Under overload the low priority messages are only counted, see IngestBudget
+        keep = self.__ingest_budget is None or self.__ingest_budget.admit(connection_type=connection_type_str,
+                                                                          now=now)
+        # There is no log open if the app start failed after the previous log was finished
+        if self.__dut_logging and keep:
+            if self.__ingest_budget and self.__dut_logging.log_filename:
+                shed_summary = self.__ingest_budget.summary_line(now=now)
+                if shed_summary:
+                    self.__dut_logging.write_server_line(line=shed_summary)
+            self.__dut_logging(message=message, receive_ns=receive_ns)
+        if stage_timers:
+            stage_timers.record(stage="machine.dut_log_write", start_ns=start_ns)
+        if self.__on_message:
+            self.__on_message(connection_type_str, message, keep)
+
+    def start_log(self, dut_logging: DUTLogging) -> None:
+        """ The messages go to the log of the app that was just started """
+        self.__dut_logging = dut_logging
+
+    def finish_log(self, end_status: EndStatus, now: float) -> None:
+        """ Write the messages that are still waiting and finish the DUT log
+        :param end_status: end status written on the log
+        :param now: time.monotonic (the capture time on a replay)
+        """
+        if self.__reorder_buffer:
+            # The messages waiting for a lost one belong to this log, the next app starts the sequence again
+            for ordered_message in self.__reorder_buffer.flush(now=now):
+                self.__process(buffer=ordered_message, message=ordered_message, now=now)
+            self.__reorder_buffer.reset()
+        if self.__dut_logging:
+            if self.__ingest_budget:
+                shed_summary = self.__ingest_budget.summary_line(now=now, force=True)
+                if shed_summary:
+                    self.__dut_logging.write_server_line(line=shed_summary)
+            self.__dut_logging.finish_this_dut_log(end_status=end_status)
+        self.__dut_logging = None
+
+    def flush(self) -> None:
+        """ Write the buffered messages of the DUT log to the disk """
+        if self.__dut_logging:
+            self.__dut_logging.flush()
+
+    @property
+    def dut_logging(self) -> typing.Optional[DUTLogging]:
+        """ Log of the running app, None between the end of a log and the next app start """
+        return self.__dut_logging
+
+    @property
+    def duplicates(self) -> int:
+        """ Messages dropped by the deduplication and by the reorder buffer """
+        return ((self.__deduplicator.duplicates if self.__deduplicator else 0) +
+                (self.__reorder_buffer.duplicates if self.__reorder_buffer else 0))
+
+    @property
+    def reordered(self) -> int:
+        return self.__reorder_buffer.reordered if self.__reorder_buffer else 0
+
+    @property
+    def lost(self) -> int:
+        return self.__reorder_buffer.lost if self.__reorder_buffer else 0
+
+    @property
+    def shed(self) -> typing.Optional[dict]:
+        """ Messages shed by the ingest budget per type, None if the budget is disabled """
+        return dict(self.__ingest_budget.shed) if self.__ingest_budget else None
@@ -0,0 +1,74 @@
+"""
+Preflight checks of the server configuration (python server.py --check).
+Verifies the machine configurations, curl and the power switches reachability.
+The checks are independent, so they run in parallel and the switch timeouts do not add up.
+"""
+import concurrent.futures
+import socket
+import typing
+
+from .config import check_fleet_duplicates, load_machine_config
+from .reboot_machine import check_curl_available
+
+_SWITCH_CONNECT_TIMEOUT = 3
+# The switches are controlled through HTTP, switch_ip can also be ip:port
+_SWITCH_HTTP_PORT = 80
+_MAX_WORKERS = 16
+
+
+class PreflightResult(typing.NamedTuple):
+    name: str
+    passed: bool
+    detail: str
+
+
+def _check_curl() -> str:
+    check_curl_available()
+    return "curl found"
+
+
+def _check_switch(switch_ip: str) -> str:
+    host, _, port = switch_ip.partition(":")
+    socket.create_connection((host, int(port or _SWITCH_HTTP_PORT)), timeout=_SWITCH_CONNECT_TIMEOUT).close()
+    return f"{switch_ip} is reachable"
+
+
+def _run_checks(checks: dict) -> typing.Tuple[typing.List[PreflightResult], dict]:
+    """ Run the checks in parallel
+    :param checks: dict name -> (function, kwargs)
+    :return: list of PreflightResult in the same order as checks, and dict name -> value returned by the check
+    """
+    results, values = list(), dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        futures = {name: executor.submit(function, **kwargs) for name, (function, kwargs) in checks.items()}
+        for name, future in futures.items():
+            try:
+                values[name] = future.result()
+                detail = values[name] if isinstance(values[name], str) else "OK"
+                results.append(PreflightResult(name=name, passed=True, detail=detail))
+            except Exception as error:
+                results.append(PreflightResult(name=name, passed=False, detail=f"{type(error).__name__}: {error}"))
+    return results, values
+
+
+def run_preflight_checks(server_parameters: dict) -> typing.List[PreflightResult]:
+    """ Check the enabled machines of the server configuration
+    :param server_parameters: content of the server_parameters.yaml file
+    :return: list of PreflightResult
+    """
+    cfg_files = [m["cfg_file"] for m in server_parameters["machines"] if m['enabled']]
+    results, machine_configs = _run_checks(
+        {f"config {cfg_file}": (load_machine_config, dict(cfg_file=cfg_file)) for cfg_file in cfg_files}
+    )
+    duplicates = check_fleet_duplicates(machine_configs=list(machine_configs.values()))
+    results.append(PreflightResult(name="duplicates", passed=not duplicates, detail="; ".join(duplicates) or "none"))
+    # The switches are only known after the configurations are loaded
+    checks = dict()
+    switch_models = {(config.power_switch_ip, config.power_switch_model) for config in machine_configs.values()}
+    if any(switch_model == "default" for _, switch_model in switch_models):
+        checks["curl"] = (_check_curl, dict())
+    for switch_ip, switch_model in sorted(switch_models):
+        checks[f"switch {switch_ip} ({switch_model})"] = (_check_switch, dict(switch_ip=switch_ip))
+    switch_results, _ = _run_checks(checks)
+    results.extend(switch_results)
+    return results
@@ -1,4 +1,3 @@
-import curses
 import logging
 import queue
 import textwrap
@@ -27,12 +26,15 @@ class ConsoleCursesManager(threading.Thread):
     __REFRESH_INTERVAL = 0.01
 
     def __init__(self, daemon: bool, *args, **kwargs):
+        # curses is only imported when the curses display is enabled, the console handler does not need it
+        import curses
         self.__stop_event = threading.Event()
         super(ConsoleCursesManager, self).__init__(daemon=daemon, *args, **kwargs)
         self.__current_print_dict = dict()
         self.__std_scr = curses.initscr()
 
     def run(self):
+        import curses
         curses.cbreak()
         curses.noecho()
         curses.start_color()  # Enable color support
@@ -0,0 +1,262 @@
+"""
+Split the machines across worker processes, so the receive loops of
+different DUTs do not share the same GIL. Each worker process runs the Machine threads of its shard.
+The supervisor thread (on the main server process) writes the worker log records,
+collects the machine metrics and restarts the workers that die.
+The workers are started by a forkserver, the server process already runs threads (logging listener, live API...)
+whose locks would be copied locked on a fork. So nothing is inherited, the settings of the process are passed.
+"""
+import logging
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import time
+import traceback
+import typing
+
+from .config import load_machine_config
+from .dut_logging import set_max_open_log_files
+from .event_log import EVENT_LOGGER_NAME
+from .instrumentation import DiagnosticsDumper, enable_instrumentation
+from .live_broker import set_live_broker
+from .logger_formatter import logging_forward_to_queue
+from .machine import Machine
+from .reboot_machine import set_switch_locks
+
+# Exit code of a worker that stopped because a Machine thread raised an exception
+_WORKER_THREAD_ERROR_EXIT_CODE = 1
+# Interval between the checks of the stop and beam pause events on the workers
+_WORKER_POLL_INTERVAL = 0.5
+
+
+def partition_machines(machine_cfg_files: list, processes: int) -> list:
+    """ Split the machine configuration files in at most processes shards (round-robin)
+    :param machine_cfg_files: list of machine YAML files
+    :param processes: number of worker processes
+    :return: list of shards, each shard is a list of machine YAML files
+    """
+    shards = [machine_cfg_files[shard_id::processes] for shard_id in range(processes)]
+    return [shard for shard in shards if shard]
+
+
+def _worker_main(shard_id: int, machine_cfg_files: list, server_ip: str, logger_name: str, server_log_path: str,
+                 log_queue, metrics_queue, switch_locks: dict, stop_event, pause_event, metrics_interval: float,
+                 join_timeout: float, max_open_log_files: typing.Optional[int],
+                 diagnostics: typing.Optional[dict]) -> None:
+    """ Worker process: runs the Machine threads of one shard until stop_event is set,
+    the machines are paused while pause_event is set
+    """
+    # CTRL-C is handled by the main server process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging_forward_to_queue(log_queue=log_queue, logger_names=[logger_name, EVENT_LOGGER_NAME])
+    set_switch_locks(switch_locks=switch_locks)
+    # The live API runs on the main server process, the DUT messages are not published from the workers
+    set_live_broker(broker=None)
+    if max_open_log_files is not None:
+        set_max_open_log_files(max_open_files=max_open_log_files)
+    logger = logging.getLogger(f"{logger_name}.{__name__}")
+    if diagnostics is not None:
+        enable_instrumentation()
+        DiagnosticsDumper(logger_name=logger_name, **diagnostics).install_signal_handler()
+    thread_failed = threading.Event()
+
+    def _worker_thread_exception_handler(args: threading.ExceptHookArgs):
+        exception_str = "".join(
+            traceback.format_exception(args.exc_type, value=args.exc_value, tb=args.exc_traceback)
+        )
+        logger.error(f"Error {exception_str} at Machine thread:{args.thread} on worker {shard_id}")
+        thread_failed.set()
+
+    threading.excepthook = _worker_thread_exception_handler
+
+    machines = list()
+    # A worker restarted during a beam pause does not start the apps
+    paused = pause_event.is_set()
+    for machine_cfg_file in machine_cfg_files:
+        machine = Machine(configuration_file=machine_cfg_file, server_ip=server_ip, logger_name=logger_name,
+                          server_log_path=server_log_path, daemon=True)
+        if paused:
+            machine.pause()
+        logger.info(f"Starting a new thread to listen at {machine} on worker {shard_id}")
+        machine.start()
+        machines.append(machine)
+
+    last_metrics_time = time.monotonic()
+    while stop_event.wait(_WORKER_POLL_INTERVAL) is False and thread_failed.is_set() is False:
+        if pause_event.is_set() != paused:
+            paused = pause_event.is_set()
+            for machine in machines:
+                if paused:
+                    machine.pause()
+                else:
+                    machine.resume()
+        if time.monotonic() - last_metrics_time >= metrics_interval:
+            last_metrics_time = time.monotonic()
+            metrics_queue.put((shard_id, [machine.metrics for machine in machines]))
+
+    for machine in machines:
+        machine.stop()
+    for machine in machines:
+        machine.join(timeout=join_timeout)
+    metrics_queue.put((shard_id, [machine.metrics for machine in machines]))
+    if thread_failed.is_set():
+        sys.exit(_WORKER_THREAD_ERROR_EXIT_CODE)
+
+
+class MachineProcessSupervisor(threading.Thread):
+    """ Run the machines on worker processes.
+    It has the same stop/join interface as the Machine threads
+    """
+    # Interval between the checks of the workers
+    __MONITOR_INTERVAL = 1
+    # Interval between the metrics sent by the workers
+    __METRICS_INTERVAL = 10
+    # Interval between the metrics summary on the server log
+    __METRICS_LOG_INTERVAL = 300
+    # A worker that keeps dying is restarted with an exponential backoff, up to this time
+    __MAX_RESTART_DELAY = 60
+    # Time given to the Machine threads to stop
+    __MACHINE_JOIN_TIMEOUT = 10
+
+    def __init__(self, machine_cfg_files: list, processes: int, server_ip: str, logger_name: str,
+                 server_log_path: str, max_open_log_files: int = None, diagnostics: dict = None, *args, **kwargs):
+        """ Supervisor of the worker processes
+        :param machine_cfg_files: YAML files of the enabled machines
+        :param processes: number of worker processes
+        :param server_ip: IP of the server
+        :param logger_name: Main logger name to store the logging information
+        :param server_log_path: directory to store the logs for the test
+        :param max_open_log_files: budget of open DUT log files of each worker, None keeps the default
+        :param diagnostics: DiagnosticsDumper parameters (output_dir, profile_duration) to enable the
+               instrumentation on the workers, None disables it
+        :param *args: args that will be passed to threading.Thread
+        :param *kwargs: kwargs that will be passed to threading.Thread
+        """
+        super(MachineProcessSupervisor, self).__init__(*args, **kwargs)
+        self.__logger_name = logger_name
+        self.__logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__server_ip = server_ip
+        self.__server_log_path = server_log_path
+        self.__max_open_log_files = max_open_log_files
+        self.__diagnostics = diagnostics
+        self.__shards = partition_machines(machine_cfg_files=machine_cfg_files, processes=processes)
+        self.__mp_context = multiprocessing.get_context("forkserver")
+        self.__log_queue = self.__mp_context.Queue()
+        self.__metrics_queue = self.__mp_context.Queue()
+        self.__stop_event = self.__mp_context.Event()
+        self.__pause_event = self.__mp_context.Event()
+        # Outlets of the same switch must never be toggled at the same time by two processes
+        self.__switch_locks = {switch_ip: self.__mp_context.Lock()
+                               for switch_ip in self.__read_switch_ips(machine_cfg_files)}
+        self.__workers = [None] * len(self.__shards)
+        self.__restarts = [0] * len(self.__shards)
+        self.__next_restart_time = [0.0] * len(self.__shards)
+        self.__metrics_lock = threading.Lock()
+        self.__metrics = dict()
+
+    @staticmethod
+    def __read_switch_ips(machine_cfg_files: list) -> set:
+        switch_ips = set()
+        for machine_cfg_file in machine_cfg_files:
+            switch_ips.add(load_machine_config(cfg_file=machine_cfg_file).power_switch_ip)
+        return switch_ips
+
+    def __str__(self) -> str:
+        return f"MachineProcessSupervisor WORKERS:{len(self.__shards)}"
+
+    def __start_worker(self, shard_id: int) -> None:
+        worker = self.__mp_context.Process(
+            target=_worker_main, name=f"MachineWorker-{shard_id}",
+            kwargs=dict(shard_id=shard_id, machine_cfg_files=self.__shards[shard_id], server_ip=self.__server_ip,
+                        logger_name=self.__logger_name, server_log_path=self.__server_log_path,
+                        log_queue=self.__log_queue, metrics_queue=self.__metrics_queue,
+                        switch_locks=self.__switch_locks, stop_event=self.__stop_event,
+                        pause_event=self.__pause_event,
+                        metrics_interval=self.__METRICS_INTERVAL, join_timeout=self.__MACHINE_JOIN_TIMEOUT,
+                        max_open_log_files=self.__max_open_log_files, diagnostics=self.__diagnostics)
+        )
+        worker.start()
+        self.__workers[shard_id] = worker
+        self.__logger.info(f"Worker {shard_id} PID:{worker.pid} started with machines:{self.__shards[shard_id]}")
+
+    def __forward_worker_logs(self) -> None:
+        """ Pass the records of the workers to the handlers of this process """
+        while True:
+            record = self.__log_queue.get()
+            if record is None:
+                break
+            logging.getLogger(record.name).handle(record)
+
+    def __collect_metrics(self) -> None:
+        while True:
+            try:
+                shard_id, machines_metrics = self.__metrics_queue.get_nowait()
+            except queue.Empty:
+                break
+            with self.__metrics_lock:
+                self.__metrics[shard_id] = machines_metrics
+
+    def __check_workers(self) -> None:
+        now = time.monotonic()
+        for shard_id, worker in enumerate(self.__workers):
+            if worker.is_alive() or self.__stop_event.is_set():
+                continue
+            if self.__next_restart_time[shard_id] == 0.0:
+                restart_delay = min(2 ** self.__restarts[shard_id], self.__MAX_RESTART_DELAY)
+                self.__next_restart_time[shard_id] = now + restart_delay
+                self.__logger.error(f"Worker {shard_id} PID:{worker.pid} died with exit code {worker.exitcode}, "
+                                    f"restarting it in {restart_delay}s")
+            elif now >= self.__next_restart_time[shard_id]:
+                self.__restarts[shard_id] += 1
+                self.__next_restart_time[shard_id] = 0.0
+                self.__start_worker(shard_id=shard_id)
+
+    def run(self) -> None:
+        log_forwarder = threading.Thread(target=self.__forward_worker_logs, daemon=True)
+        log_forwarder.start()
+        for shard_id in range(len(self.__shards)):
+            self.__start_worker(shard_id=shard_id)
+
+        last_metrics_log_time = time.monotonic()
+        while self.__stop_event.wait(self.__MONITOR_INTERVAL) is False:
+            self.__collect_metrics()
+            self.__check_workers()
+            if time.monotonic() - last_metrics_log_time > self.__METRICS_LOG_INTERVAL:
+                last_metrics_log_time = time.monotonic()
+                self.__logger.info(f"Workers restarts:{self.__restarts} metrics:{self.metrics}")
+
+        for worker in self.__workers:
+            worker.join(timeout=self.__MACHINE_JOIN_TIMEOUT + self.__MONITOR_INTERVAL)
+            if worker.is_alive():
+                self.__logger.error(f"Worker PID:{worker.pid} did not stop, terminating it")
+                worker.terminate()
+                worker.join()
+        self.__collect_metrics()
+        self.__log_queue.put(None)
+        log_forwarder.join()
+
+    @property
+    def metrics(self) -> list:
+        """ Last metrics received from all the machines """
+        with self.__metrics_lock:
+            return [machine_metrics for shard_id in sorted(self.__metrics)
+                    for machine_metrics in self.__metrics[shard_id]]
+
+    @property
+    def worker_restarts(self) -> list:
+        """ Number of restarts of each worker """
+        return list(self.__restarts)
+
+    def stop(self) -> None:
+        """ Stop the workers before join the thread """
+        self.__stop_event.set()
+
+    def pause(self) -> None:
+        """ Beam pause on all the machines of the workers, see Machine.pause """
+        self.__pause_event.set()
+
+    def resume(self) -> None:
+        """ Beam resume on all the machines of the workers, see Machine.resume """
+        self.__pause_event.clear()
@@ -1,21 +1,23 @@
 """
 Reboot machine functions. This is conceptually different from
 the radiation_benchmarks setup. Here we use only private functions, and the only
-public functions are reboot_machine turn_machine_on.
+public functions are reboot_machine turn_machine_on turn_machine_off set_switch_locks and check_curl_available.
 """
 
+import contextlib
+import functools
 import json
 import logging
 import os
 import re
-import subprocess
+import shutil
 import threading
 import time
 import typing
 
-import requests
-
 from .error_codes import ErrorCodes
+from .event_log import ServerEvent, log_server_event, elapsed_since
+from .instrumentation import timed_stage
 
 # Switches status, only used in this module
 __ON = "ON"
@@ -23,12 +25,19 @@ __OFF = "OFF"
 
 # Make sure that everything here is thread safe
 __GLOBAL_LOCK = threading.Lock()
+# Locks shared between processes, one per switch IP, see set_switch_locks
+__SWITCH_LOCKS = dict()
+
 
-# Check if curl is available
-try:
-    subprocess.call(["curl", "--help"], stdout=subprocess.PIPE)
-except OSError:
-    raise OSError("CURL is not available, please install curl before using this module")
+@functools.lru_cache(maxsize=None)
+def check_curl_available() -> None:
+    """ The default switch is controlled with curl. The server checks it at the startup when a machine uses
+    the default switch (and the preflight checks), the switch commands check it again without raising.
+    Only the successful check is cached
+    :raise OSError: if curl is not on the PATH
+    """
+    if shutil.which("curl") is None:
+        raise OSError("CURL is not available, please install curl before using this module")
 
 
 def _lindy_switch(status: str, switch_port: int, switch_ip: str, logger: logging.Logger) -> ErrorCodes:
@@ -65,6 +74,8 @@ def _lindy_switch(status: str, switch_port: int, switch_ip: str, logger: logging
 
     # print(url)
     # print(headers)
+    # requests takes longer to import than the rest of the server, only the lindy switches need it
+    import requests
     default_string = "Could not change Lindy IP switch status, portNumber:"
     try:
         requests_status = requests.post(url, data=json.dumps(payload), headers=headers)
@@ -88,13 +99,21 @@ def _lindy_switch(status: str, switch_port: int, switch_ip: str, logger: logging
     return reboot_status
 
 
-def _common_switch_command(status: str, switch_ip: str, switch_port: int) -> ErrorCodes:
+def _common_switch_command(status: str, switch_ip: str, switch_port: int, logger: logging.Logger) -> ErrorCodes:
     """Common switch reboot rules
     :param status: ON or OFF
     :param switch_ip: ip address for the switch
     :param switch_port: port to reboot
+    :param logger: logging.Logger obj
     :return: ErrorCodes enum
     """
+    try:
+        check_curl_available()
+    except OSError as error:
+        # Raising here would stop the Machine thread, and the whole fleet with it
+        logger.error(f"Could not change the switch status, portNumber:{switch_port} switchIP:{switch_ip} "
+                     f"error:{error}")
+        return ErrorCodes.GENERAL_ERROR
     port_default_cmd = ''
     for i in range(1, switch_port+1):
         if i == switch_port:
@@ -116,7 +135,8 @@ def _common_switch_command(status: str, switch_ip: str, switch_port: int) -> Err
     cmd += 'Apply=Apply\" '
     cmd += f'http://{switch_ip}/tgi/iocontrol.tgi -o /dev/null '
     # Execute the command
-    tmp_file = "/tmp/server_error_execute_command"
+    # One file per process, several server processes can execute switch commands
+    tmp_file = f"/tmp/server_error_execute_command_{os.getpid()}"
     #print(cmd)
     result = os.system(f"{cmd} 2>{tmp_file}")
     with open(tmp_file) as err:
@@ -140,15 +160,45 @@ def _select_command_on_switch(status: str, switch_model: str, switch_port: int,
     :param logger: logging.Logger obj
     :return: ErrorCodes enum, if the switch is not defined it will trow a ValueError exception
     """
-    with __GLOBAL_LOCK:
+    with __GLOBAL_LOCK, __SWITCH_LOCKS.get(switch_ip, contextlib.nullcontext()):
         if switch_model == "default":
-            return _common_switch_command(status, switch_ip, switch_port)
+            return _common_switch_command(status, switch_ip, switch_port, logger)
         elif switch_model == "lindy":
             return _lindy_switch(status, switch_port, switch_ip, logger)
         else:
             raise ValueError("Incorrect switch set to switch_model")
 
 
+def set_switch_locks(switch_locks: dict) -> None:
+    """Set the locks that are shared between processes. When the machines are split across processes,
+    the outlets of the same switch must never be toggled at the same time by two processes
+    :param switch_locks: dict switch_ip -> multiprocessing.Lock
+    """
+    __SWITCH_LOCKS.clear()
+    __SWITCH_LOCKS.update(switch_locks)
+
+
+def _timed_command_on_switch(status: str, address: str, switch_model: str, switch_port: int, switch_ip: str,
+                            logger: logging.Logger) -> ErrorCodes:
+    """Execute the command on the switch and write it on the structured event log
+    :param status: ON or OFF
+    :param address: Address of the machine attached to the switch port
+    :param switch_model: model of the switch. Supported now default and lindy
+    :param switch_port: port to reboot
+    :param switch_ip: ip address for the switch
+    :param logger: logging.Logger obj
+    :return: ErrorCodes enum
+    """
+    start_time = time.monotonic()
+    with timed_stage(stage=f"reboot_machine.switch_{switch_model}"):
+        switch_status = _select_command_on_switch(status=status, switch_model=switch_model, switch_port=switch_port,
+                                                  switch_ip=switch_ip, logger=logger)
+    log_server_event(ServerEvent.POWER_SWITCH, failed=switch_status != ErrorCodes.SUCCESS, address=address,
+                     command=status, switch_model=switch_model, switch_ip=switch_ip, switch_port=switch_port,
+                     status=str(switch_status), duration=elapsed_since(start_time))
+    return switch_status
+
+
 def reboot_machine(address: str, switch_model: str, switch_port: int, switch_ip: str, rebooting_sleep: float,
                    logger_name: str, thread_event: threading.Event = None) -> typing.Tuple[ErrorCodes, ErrorCodes]:
     """Public function to reboot a machine
@@ -163,15 +213,15 @@ def reboot_machine(address: str, switch_model: str, switch_port: int, switch_ip:
     """
     logger = logging.getLogger(f"{logger_name}.{__name__}")
     logger.info(f"Rebooting machine, IP:{address} switch_IP:{switch_ip} switch_port:{switch_port}")
-    off_status = _select_command_on_switch(status=__OFF, switch_model=switch_model, switch_port=switch_port,
-                                           switch_ip=switch_ip, logger=logger)
+    off_status = _timed_command_on_switch(status=__OFF, address=address, switch_model=switch_model,
+                                          switch_port=switch_port, switch_ip=switch_ip, logger=logger)
     if thread_event:
         thread_event.wait(rebooting_sleep)
     else:
         time.sleep(rebooting_sleep)
 
-    on_status = _select_command_on_switch(status=__ON, switch_model=switch_model, switch_port=switch_port,
-                                          switch_ip=switch_ip, logger=logger)
+    on_status = _timed_command_on_switch(status=__ON, address=address, switch_model=switch_model,
+                                         switch_port=switch_port, switch_ip=switch_ip, logger=logger)
     return off_status, on_status
 
 
@@ -186,8 +236,8 @@ def turn_machine_on(address: str, switch_model: str, switch_port: int, switch_ip
     """
     logger = logging.getLogger(f"{logger_name}.{__name__}")
     logger.info(f"Turning ON machine:{address} switch_IP:{switch_ip} switch_port:{switch_port}")
-    return _select_command_on_switch(status=__ON, switch_model=switch_model, switch_port=switch_port,
-                                     switch_ip=switch_ip, logger=logger)
+    return _timed_command_on_switch(status=__ON, address=address, switch_model=switch_model,
+                                    switch_port=switch_port, switch_ip=switch_ip, logger=logger)
 
 
 def turn_machine_off(address: str, switch_model: str, switch_port: int, switch_ip: str, logger_name: str) -> ErrorCodes:
@@ -201,5 +251,5 @@ def turn_machine_off(address: str, switch_model: str, switch_port: int, switch_i
     """
     logger = logging.getLogger(f"{logger_name}.{__name__}")
     logger.info(f"Turning OFF machine:{address} switch_IP:{switch_ip} switch_port:{switch_port}")
-    return _select_command_on_switch(status=__OFF, switch_model=switch_model, switch_port=switch_port,
-                                     switch_ip=switch_ip, logger=logger)
+    return _timed_command_on_switch(status=__OFF, address=address, switch_model=switch_model,
+                                    switch_port=switch_port, switch_ip=switch_ip, logger=logger)
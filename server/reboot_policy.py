@@ -0,0 +1,228 @@
+"""
+Reboot escalation policies. When a DUT stops sending messages the Machine tries the reboot tiers
+(soft app reboot, soft OS reboot, power cycle) in the order given by its policy.
+Each recovery is recorded per tier and per benchmark codename, a recovery succeeds when the DUT sends an #IT
+before the next timeout, so a soft app reboot that starts an app that crashes again counts as a failure.
+FixedRebootPolicy always starts with the soft app reboot.
+HistoryRebootPolicy starts with the tier that minimizes the expected time to recovery of the board and benchmark.
+"""
+import abc
+import json
+import logging
+import os
+import time
+import typing
+
+from .dut_logging import EndStatus
+
+# The tiers in escalation order, the power cycle always recovers the DUT (or quarantines it)
+REBOOT_TIERS = (EndStatus.SOFT_APP_REBOOT, EndStatus.SOFT_OS_REBOOT, EndStatus.HARD_REBOOT)
+# A tier is only skipped after this number of recoveries, on the codename or on the whole board
+DEFAULT_MIN_ATTEMPTS = 5
+# One recovery out of explore_interval uses all the tiers, so a tier that started to work again is noticed
+DEFAULT_EXPLORE_INTERVAL = 10
+
+
+class TierStats:
+    """ Recoveries of a reboot tier """
+
+    def __init__(self, attempts: int = 0, successes: int = 0, total_duration: float = 0.0):
+        self.attempts = attempts
+        self.successes = successes
+        self.total_duration = total_duration
+
+    def record(self, success: bool, duration: float) -> None:
+        self.attempts += 1
+        self.successes += int(success)
+        self.total_duration += duration
+
+    def merge(self, other: "TierStats") -> None:
+        self.attempts += other.attempts
+        self.successes += other.successes
+        self.total_duration += other.total_duration
+
+    @property
+    def success_rate(self) -> float:
+        # Laplace smoothing, a tier is never considered certain after a few recoveries
+        return (self.successes + 1) / (self.attempts + 2)
+
+    @property
+    def mean_duration(self) -> float:
+        return self.total_duration / self.attempts if self.attempts else 0.0
+
+    def as_list(self) -> list:
+        return [self.attempts, self.successes, self.total_duration]
+
+
+class RebootPolicy(abc.ABC):
+    """ Records the recoveries of a DUT, the subclasses decide the escalation order """
+    name = "base"
+
+    def __init__(self, hostname: str, logger_name: str, history_file: str = None, tiers: tuple = REBOOT_TIERS):
+        """
+        :param hostname: DUT hostname
+        :param logger_name: Main logger name to store the logging information
+        :param history_file: JSON file that keeps the recoveries across server restarts, optional
+        :param tiers: tiers available on the DUT, in escalation order (ex: without the soft OS reboot)
+        """
+        self._hostname = hostname
+        self._tiers = tuple(tiers)
+        self._logger = logging.getLogger(f"{logger_name}.{__name__}")
+        self.__history_file = history_file
+        # tier name -> codename -> TierStats
+        self._stats = {tier.name: dict() for tier in REBOOT_TIERS}
+        # Tier that sent the commands, waiting for the first #IT or for the next timeout
+        self.__pending_recovery = None
+        if history_file and os.path.isfile(history_file):
+            try:
+                with open(history_file) as fp:
+                    history = json.load(fp)
+                for tier_name, codenames in history.items():
+                    for codename, values in codenames.items():
+                        self._stats[tier_name][codename] = TierStats(*values)
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                self._logger.error(f"Ignoring the reboot history {history_file} of {hostname}: {error}")
+
+    def __str__(self) -> str:
+        return f"{self.name} reboot policy of {self._hostname}"
+
+    @abc.abstractmethod
+    def escalation_order(self, codename: str) -> typing.List[EndStatus]:
+        """ Reboot tiers to try, in order, after a timeout of the benchmark codename """
+
+    def record_attempt(self, tier: EndStatus, codename: str, success: bool, duration: float) -> None:
+        """ Record a finished recovery
+        :param tier: reboot tier
+        :param codename: benchmark running when the DUT stopped
+        :param success: True if the DUT sent an #IT before the next timeout
+        :param duration: time in seconds from the tier start to the #IT or to the failure
+        """
+        stats = self._stats[tier.name].get(codename)
+        if stats is None:
+            stats = self._stats[tier.name][codename] = TierStats()
+        stats.record(success=success, duration=duration)
+        self.__save_history()
+
+    def begin_recovery(self, tier: EndStatus, codename: str, start_time: float) -> None:
+        """ The tier sent its commands, the recovery is decided by the next #IT or timeout """
+        self.__pending_recovery = (tier, codename, start_time)
+
+    def end_recovery(self, success: bool, now: float = None) -> None:
+        """ Called at each #IT (success) and timeout (failure), it is cheap when no recovery is pending """
+        if self.__pending_recovery is None:
+            return
+        tier, codename, start_time = self.__pending_recovery
+        self.__pending_recovery = None
+        now = time.monotonic() if now is None else now
+        self.record_attempt(tier=tier, codename=codename, success=success, duration=now - start_time)
+
+    def cancel_recovery(self) -> None:
+        """ Forget the pending recovery, ex: the DUT was quarantined and the duration means nothing """
+        self.__pending_recovery = None
+
+    def tier_stats(self, tier: EndStatus, codename: str = None) -> TierStats:
+        """ Recoveries of a tier on a codename, or on all the codenames of the board """
+        if codename is not None:
+            return self._stats[tier.name].get(codename, TierStats())
+        board_stats = TierStats()
+        for stats in self._stats[tier.name].values():
+            board_stats.merge(stats)
+        return board_stats
+
+    def summary(self) -> dict:
+        """ Success rate and mean duration of each tier on the whole board """
+        summary = dict()
+        for tier in self._tiers:
+            stats = self.tier_stats(tier=tier)
+            summary[tier.name] = {"attempts": stats.attempts, "successes": stats.successes,
+                                  "mean_duration": round(stats.mean_duration, 2)}
+        return summary
+
+    def __save_history(self) -> None:
+        if not self.__history_file:
+            return
+        history = {tier_name: {codename: stats.as_list() for codename, stats in codenames.items()}
+                   for tier_name, codenames in self._stats.items()}
+        tmp_file = f"{self.__history_file}.tmp"
+        try:
+            with open(tmp_file, "w") as fp:
+                json.dump(history, fp)
+            os.replace(tmp_file, self.__history_file)
+        except OSError as error:
+            self._logger.error(f"Could not write the reboot history {self.__history_file}: {error}")
+
+
+class FixedRebootPolicy(RebootPolicy):
+    """ Always soft app reboot, then soft OS reboot, then power cycle """
+    name = "fixed"
+
+    def escalation_order(self, codename: str) -> typing.List[EndStatus]:
+        return list(self._tiers)
+
+
+class HistoryRebootPolicy(RebootPolicy):
+    """ Start with the tier that minimizes the expected time to recovery.
+    The expected time of starting on tier i is E(i) = mean_duration(i) + (1 - success_rate(i)) * E(i + 1),
+    and the power cycle is the last resort. The codename stats are used when they have enough recoveries,
+    then the board stats. A tier without enough history costs nothing on the estimate, so it is never skipped
+    """
+    name = "history"
+
+    def __init__(self, hostname: str, logger_name: str, history_file: str = None, tiers: tuple = REBOOT_TIERS,
+                 min_attempts: int = DEFAULT_MIN_ATTEMPTS, explore_interval: int = DEFAULT_EXPLORE_INTERVAL):
+        """
+        :param min_attempts: recoveries of a tier needed before it can be skipped
+        :param explore_interval: one recovery out of explore_interval tries all the tiers, 0 never does
+        """
+        super(HistoryRebootPolicy, self).__init__(hostname=hostname, logger_name=logger_name,
+                                                  history_file=history_file, tiers=tiers)
+        self.__min_attempts = min_attempts
+        self.__explore_interval = explore_interval
+        self.__recoveries = 0
+
+    def __estimate(self, tier: EndStatus, codename: str) -> typing.Optional[TierStats]:
+        stats = self.tier_stats(tier=tier, codename=codename)
+        if stats.attempts >= self.__min_attempts:
+            return stats
+        stats = self.tier_stats(tier=tier)
+        return stats if stats.attempts >= self.__min_attempts else None
+
+    def expected_recovery_times(self, codename: str) -> typing.Dict[str, float]:
+        """ Expected time to recovery in seconds starting on each tier """
+        expected_times = dict()
+        next_expected_time = 0.0
+        for tier in reversed(self._tiers):
+            stats = self.__estimate(tier=tier, codename=codename)
+            if stats is not None:
+                # The last tier is always followed by another power cycle
+                failure_rate = 1 - stats.success_rate if tier != self._tiers[-1] else 0.0
+                next_expected_time = stats.mean_duration + failure_rate * next_expected_time
+            expected_times[tier.name] = next_expected_time
+        return expected_times
+
+    def escalation_order(self, codename: str) -> typing.List[EndStatus]:
+        self.__recoveries += 1
+        if self.__explore_interval and self.__recoveries % self.__explore_interval == 0:
+            return list(self._tiers)
+        expected_times = self.expected_recovery_times(codename=codename)
+        # On a tie the cheaper tier is kept
+        start_index = min(range(len(self._tiers)), key=lambda i: (expected_times[self._tiers[i].name], i))
+        if start_index:
+            self._logger.info(f"{self._hostname} skipping {[tier.name for tier in self._tiers[:start_index]]} "
+                              f"for {codename}, expected recovery times:{expected_times}")
+        return list(self._tiers[start_index:])
+
+
+REBOOT_POLICIES = {policy.name: policy for policy in (FixedRebootPolicy, HistoryRebootPolicy)}
+
+
+def create_reboot_policy(name: str, hostname: str, logger_name: str, history_file: str = None,
+                         tiers: tuple = REBOOT_TIERS) -> RebootPolicy:
+    """ Create the reboot policy of a machine
+    :param name: one of REBOOT_POLICIES
+    :param hostname: DUT hostname
+    :param logger_name: Main logger name to store the logging information
+    :param history_file: JSON file that keeps the recoveries across server restarts, optional
+    :param tiers: tiers available on the DUT, in escalation order
+    """
+    return REBOOT_POLICIES[name](hostname=hostname, logger_name=logger_name, history_file=history_file, tiers=tiers)
@@ -0,0 +1,45 @@
+"""
+Telnet login on the DUTs, shared by the Machine threads and the fleet command CLI
+"""
+import telnetlib
+import time
+import typing
+
+# Prompt of the DUT shell after the login
+SHELL_PROMPT = b'$ '
+# A zero timeout would make the socket non-blocking
+_MIN_STEP_TIMEOUT = 0.001
+
+
+def telnet_login(ip: str, port: int, username: str, password: str, timeout: float,
+                 deadline: typing.Optional[float] = None) -> telnetlib.Telnet:
+    """ Return a telnet session logged in the DUT
+    :param ip: DUT IP
+    :param port: telnet port
+    :param username: DUT username
+    :param password: DUT password
+    :param timeout: timeout in seconds of the connection and of each login step
+    :param deadline: time.monotonic limit of the whole login, optional
+    :raise RuntimeError: if a login step fails
+    :raise OSError: if the DUT is not reachable
+    """
+    def _step_timeout() -> float:
+        return timeout if deadline is None else max(min(timeout, deadline - time.monotonic()), _MIN_STEP_TIMEOUT)
+
+    tn = telnetlib.Telnet(ip, port=port, timeout=_step_timeout())
+    try:
+        if not tn.read_until(b'ogin: ', timeout=_step_timeout()):
+            raise RuntimeError("Telnet error: Failed to login into Telnet. Could not input username.")
+        tn.write(username.encode('ascii') + b'\n')
+        tn.read_very_eager()
+
+        if not tn.read_until(b'assword: ', timeout=_step_timeout()):
+            raise RuntimeError("Telnet error: Could not login into Telnet. Could not input password.")
+        tn.write(password.encode('ascii') + b'\n')
+
+        if not tn.read_until(SHELL_PROMPT, timeout=_step_timeout()):
+            raise RuntimeError("Telnet error: Could not login into Telnet. Failed after trying to enter inputs.")
+    except BaseException:
+        tn.close()
+        raise
+    return tn
@@ -0,0 +1,97 @@
+"""
+Capture of the raw datagrams received by a Machine, to replay real campaign traffic later
+(see benchmarks/replay_capture.py).
+File format: the 8 bytes magic, then one record per datagram:
+<uint64 receive time in ns since the epoch><uint16 datagram size><datagram>, little-endian
+"""
+import datetime
+import hashlib
+import os
+import struct
+import time
+import typing
+
+CAPTURE_MAGIC = b"RADCAP1\n"
+_RECORD_HEADER = struct.Struct("<QH")
+# The records are written in blocks, a capture never slows down the receive loop with small writes
+_CAPTURE_BUFFER_SIZE = 1 << 16
+
+
+class TrafficCaptureWriter:
+    """ Append the received datagrams to a capture file """
+
+    def __init__(self, capture_file: str):
+        """
+        :param capture_file: path of the capture file, it is overwritten
+        """
+        self.__capture_file = capture_file
+        self.__file = open(capture_file, "wb", buffering=_CAPTURE_BUFFER_SIZE)
+        self.__file.write(CAPTURE_MAGIC)
+        self.records = 0
+
+    def write(self, data: typing.Union[bytes, memoryview], timestamp_ns: int = None) -> None:
+        """ Record a datagram
+        :param data: datagram as received
+        :param timestamp_ns: receive time (time.time_ns), default is now
+        """
+        timestamp_ns = time.time_ns() if timestamp_ns is None else timestamp_ns
+        self.__file.write(_RECORD_HEADER.pack(timestamp_ns, len(data)))
+        self.__file.write(data)
+        self.records += 1
+
+    def flush(self) -> None:
+        self.__file.flush()
+
+    def close(self) -> None:
+        self.__file.close()
+
+    @property
+    def capture_file(self) -> str:
+        return self.__capture_file
+
+
+def create_capture_writer(capture_dir: str, hostname: str) -> TrafficCaptureWriter:
+    """ Create a capture file named after the hostname and the current date
+    :param capture_dir: directory of the captures, it is created if it does not exist
+    :param hostname: DUT hostname
+    :return: TrafficCaptureWriter
+    """
+    os.makedirs(capture_dir, exist_ok=True)
+    date_fmt = datetime.datetime.today().strftime('%Y_%m_%d_%H_%M_%S')
+    return TrafficCaptureWriter(capture_file=os.path.join(capture_dir, f"{date_fmt}_{hostname}.cap"))
+
+
+def read_capture(capture_file: str) -> typing.Iterator[typing.Tuple[int, bytes]]:
+    """ Read the records of a capture file
+    :param capture_file: path of the capture file
+    :return: iterator of (receive time in ns since the epoch, datagram)
+    :raise ValueError: if the file is not a capture file
+    """
+    with open(capture_file, "rb") as fp:
+        if fp.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{capture_file} is not a traffic capture file")
+        while True:
+            record_header = fp.read(_RECORD_HEADER.size)
+            if len(record_header) < _RECORD_HEADER.size:
+                # A capture interrupted in the middle of a record ends at the last complete one
+                return
+            timestamp_ns, size = _RECORD_HEADER.unpack(record_header)
+            data = fp.read(size)
+            if len(data) < size:
+                return
+            yield timestamp_ns, data
+
+
+def dut_logs_digest(log_files: typing.List[str]) -> str:
+    """ SHA-256 of the DUT messages written on the logs, without the #SERVER_ lines (they contain dates),
+    so the logs generated by two server versions from the same capture can be compared
+    :param log_files: DUT log files, in the order they were written
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    for log_file in log_files:
+        with open(log_file, "rb") as fp:
+            for line in fp:
+                if not line.startswith(b"#SERVER_"):
+                    digest.update(line)
+    return digest.hexdigest()
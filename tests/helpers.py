@@ -0,0 +1,17 @@
+"""
+Helpers shared by the test modules
+"""
+import time
+
+
+def wait_for(condition, timeout: float = 10.0, poll_interval: float = 0.05) -> bool:
+    """ Poll a condition until it is true or the timeout expires
+    :param condition: callable without arguments
+    :param timeout: maximum time to wait in seconds
+    :param poll_interval: time between two checks in seconds
+    :return: the last result of the condition
+    """
+    deadline = time.monotonic() + timeout
+    while condition() is False and time.monotonic() < deadline:
+        time.sleep(poll_interval)
+    return condition()
@@ -0,0 +1,121 @@
+import json
+import os
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+from server.artifact_retrieval import ArtifactRetrievalScheduler, ArtifactRetriever
+from server.config import MachineConfig
+
+# rsync replacement: the remote paths are local paths, the arguments are recorded on a JSON lines file
+_FAKE_RSYNC = """#!{python}
+import json, os, shutil, sys
+with open({calls_file!r}, "a") as fp:
+    fp.write(json.dumps(sys.argv[1:]) + "\\n")
+source, destination = sys.argv[-2:]
+host, _, remote_path = source.partition(":")
+if host.endswith("@10.0.0.1"):
+    sys.stderr.write("ssh: connect to host 10.0.0.1 port 22: No route to host")
+    sys.exit(255)
+target = os.path.join(destination, remote_path.strip("/"))
+if os.path.isdir(remote_path):
+    shutil.copytree(remote_path, target, dirs_exist_ok=True)
+else:
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy2(remote_path, target)
+"""
+
+
+def _machine_config(hostname: str, ip: str, artifact_paths: tuple) -> MachineConfig:
+    return MachineConfig(cfg_file=f"{hostname}.yaml", ip=ip, hostname=hostname, username="carol", password="carol",
+                         power_switch_ip="127.0.0.1", power_switch_port=1, power_switch_model="lindy",
+                         boot_waiting_time=10, max_timeout_time=30, receive_port=1024, json_files=(), benchmarks=(),
+                         artifact_paths=artifact_paths)
+
+
+class ArtifactRetrievalTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.calls_file = os.path.join(self.tmp_dir.name, "rsync_calls.jsonl")
+        self.rsync = os.path.join(self.tmp_dir.name, "fake_rsync")
+        with open(self.rsync, "w") as fp:
+            fp.write(_FAKE_RSYNC.format(python=sys.executable, calls_file=self.calls_file))
+        os.chmod(self.rsync, os.stat(self.rsync).st_mode | stat.S_IEXEC)
+        self.store_dir = os.path.join(self.tmp_dir.name, "artifacts")
+        # The "remote" outputs of two DUTs, with a file that has the same content on both
+        self.remote_dirs = dict()
+        for hostname in ("carol1", "carol2"):
+            remote_dir = self.remote_dirs[hostname] = os.path.join(self.tmp_dir.name, "remote", hostname, "outputs")
+            os.makedirs(remote_dir)
+            with open(os.path.join(remote_dir, "golden.npy"), "wb") as fp:
+                fp.write(b"golden" * 100)
+            with open(os.path.join(remote_dir, f"sdc_{hostname}.npy"), "wb") as fp:
+                fp.write(hostname.encode() * 100)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_retrieve_and_skip_known_files(self):
+        machine_configs = [_machine_config(hostname=hostname, ip=f"127.0.0.{i + 1}", artifact_paths=(remote_dir,))
+                           for i, (hostname, remote_dir) in enumerate(self.remote_dirs.items())]
+        retriever = ArtifactRetriever(store_dir=self.store_dir, logger_name="TEST", parallel_transfers=2,
+                                      bwlimit_kbps=1000, rsync_command=self.rsync)
+        results = retriever.retrieve(machine_configs=machine_configs)
+        self.assertTrue(all(result.passed for result in results))
+        self.assertEqual([result.new_files for result in results], [2, 2])
+        with open(self.calls_file) as fp:
+            # The DUTs are transferred in parallel, the calls are in any order
+            calls = sorted((json.loads(line) for line in fp), key=lambda arguments: arguments[-2])
+        self.assertEqual(len(calls), 2)
+        self.assertIn("--bwlimit=500", calls[0])
+        self.assertIn("--partial", calls[0])
+        self.assertEqual(calls[0][-2], f"carol@127.0.0.1:{self.remote_dirs['carol1']}")
+
+        # The golden file is stored once for both DUTs
+        entries = retriever.store.entries()
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(len({entry["sha256"] for entry in entries}), 3)
+        for entry in entries:
+            self.assertTrue(os.path.isfile(retriever.store.object_path(sha256=entry["sha256"])))
+
+        # Nothing new to store, also after a restart of the server
+        results = retriever.retrieve(machine_configs=machine_configs)
+        self.assertEqual([result.new_files for result in results], [0, 0])
+        with open(os.path.join(self.remote_dirs["carol1"], "sdc_carol1.npy"), "ab") as fp:
+            fp.write(b"new SDC")
+        retriever = ArtifactRetriever(store_dir=self.store_dir, logger_name="TEST", rsync_command=self.rsync)
+        results = retriever.retrieve(machine_configs=machine_configs)
+        self.assertEqual([result.new_files for result in results], [1, 0])
+        self.assertEqual(len(retriever.store.entries(hostname="carol1")), 3)
+
+    def test_failed_transfer_and_idle_machines(self):
+        machine_configs = [_machine_config(hostname="carol1", ip="127.0.0.1",
+                                           artifact_paths=(self.remote_dirs["carol1"],)),
+                           _machine_config(hostname="carol2", ip="10.0.0.1",
+                                           artifact_paths=(self.remote_dirs["carol2"],)),
+                           _machine_config(hostname="carol3", ip="127.0.0.3", artifact_paths=())]
+        retriever = ArtifactRetriever(store_dir=self.store_dir, logger_name="TEST", rsync_command=self.rsync)
+        results = {result.hostname: result for result in retriever.retrieve(machine_configs=machine_configs)}
+        self.assertEqual(sorted(results), ["carol1", "carol2"])
+        self.assertTrue(results["carol1"].passed)
+        self.assertFalse(results["carol2"].passed)
+        self.assertIn("No route to host", results["carol2"].detail)
+
+        # Only the DUTs paused for the beam are retrieved, the running ones are being timed
+        fleet_state = [{"hostname": "carol1", "paused": True},
+                       {"hostname": "carol2", "paused": False},
+                       {"hostname": "carol3", "paused": True}]
+        scheduler = ArtifactRetrievalScheduler(retriever=retriever, machine_configs=machine_configs,
+                                               fleet_state=lambda: fleet_state, interval=60, logger_name="TEST")
+        self.assertEqual([config.hostname for config in scheduler.idle_machines()], ["carol1"])
+        self.assertEqual([result.hostname for result in scheduler.retrieve_idle_machines()], ["carol1"])
+        # Not again before the interval, even if the pause goes on
+        self.assertEqual(scheduler.idle_machines(), [])
+        self.assertEqual([config.hostname for config in scheduler.idle_machines(now=time.monotonic() + 61)],
+                         ["carol1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import glob
+import os
+import tempfile
+import time
+import unittest
+
+from benchmarks.run_benchmarks import _SimulatedFleet, _benchmark_logging
+from server.beam_control import BeamControlServer, send_beam_command
+from tests.helpers import wait_for
+
+
+class BeamControlTestCase(unittest.TestCase):
+    def test_pause_and_resume_the_fleet(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=2, iterations_per_second=50)
+            socket_path = os.path.join(work_dir, "beam.sock")
+            beam_control = BeamControlServer(socket_path=socket_path, machines=lambda: fleet.machines,
+                                             logger_name="BENCHMARK", daemon=True)
+            beam_control.start()
+            fleet.start()
+            # The Machines read the socket after the app start wait
+            self.assertTrue(wait_for(lambda: all(machine.metrics["received_messages"] > 10
+                                                  for machine in fleet.machines)))
+
+            self.assertEqual(send_beam_command(socket_path=socket_path, command="pause"),
+                             {"paused": True, "machines": 2})
+            paused = wait_for(lambda: all(machine.metrics["paused"] for machine in fleet.machines))
+            received_messages = [machine.metrics["received_messages"] for machine in fleet.machines]
+            # Longer than max_timeout_time, nothing is rebooted while the beam is off
+            time.sleep(2.5)
+            paused_metrics = [machine.metrics for machine in fleet.machines]
+            paused_log_files = sorted(glob.glob(os.path.join(fleet.log_dir, "*", "**", "*.log"), recursive=True))
+            paused_logs = list()
+            for log_file in paused_log_files:
+                with open(log_file) as fp:
+                    paused_logs.append(fp.read())
+
+            self.assertEqual(send_beam_command(socket_path=socket_path, command="resume")["paused"], False)
+            resumed = wait_for(lambda: all(len(dut.app_start_times) == 2 for dut in fleet.duts))
+            self.assertTrue(wait_for(lambda: all(machine.metrics["received_messages"] >
+                                                  paused_metrics[i]["received_messages"]
+                                                  for i, machine in enumerate(fleet.machines))))
+            status = send_beam_command(socket_path=socket_path, command="status")
+            unknown = send_beam_command(socket_path=socket_path, command="reboot")
+            fleet.stop()
+            beam_control.stop()
+            beam_control.join()
+            log_files = glob.glob(os.path.join(fleet.log_dir, "*", "**", "*.log"), recursive=True)
+            del fleet
+
+        self.assertTrue(paused)
+        self.assertTrue(resumed)
+        for i, metrics in enumerate(paused_metrics):
+            # The apps were killed, only the first start happened
+            self.assertTrue(metrics["paused"])
+            self.assertEqual(metrics["received_messages"], received_messages[i])
+            self.assertEqual(metrics["successful_reboots"],
+                             {"SOFT_APP_REBOOT": 1, "SOFT_OS_REBOOT": 0, "HARD_REBOOT": 0})
+        self.assertEqual(len(paused_logs), 2)
+        for log in paused_logs:
+            self.assertTrue(log.splitlines()[-1].startswith("#SERVER_DUE:beam pause"))
+        self.assertEqual(len(log_files), 4)
+        self.assertEqual(status, {"paused": False, "machines": 2})
+        self.assertIn("unknown command", unknown["error"])
+
+
+if __name__ == '__main__':
+    unittest.main()
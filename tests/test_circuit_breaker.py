@@ -0,0 +1,36 @@
+import unittest
+
+from server.circuit_breaker import BreakerState, CircuitBreaker
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(name="carol", logger_name="CIRCUIT_BREAKER", failure_threshold=3, window=100,
+                                 open_time=50, max_open_time=150, probation_time=10, hostname="carol")
+        # The failures out of the window are forgotten
+        breaker.record_failure(now=0)
+        breaker.record_failure(now=10)
+        self.assertEqual(breaker.record_failure(now=200), BreakerState.CLOSED)
+        breaker.record_failure(now=210)
+        # A success does not reset the window while the breaker is closed
+        breaker.record_success(now=215)
+        self.assertEqual(breaker.record_failure(now=220), BreakerState.OPEN)
+        self.assertFalse(breaker.allow(now=230))
+        self.assertAlmostEqual(breaker.remaining_open_time(now=230), 40)
+
+        # The trial fails, the open time doubles
+        self.assertTrue(breaker.allow(now=270))
+        self.assertEqual(breaker.state, BreakerState.HALF_OPEN)
+        self.assertEqual(breaker.record_failure(now=275), BreakerState.OPEN)
+        self.assertAlmostEqual(breaker.remaining_open_time(now=275), 100)
+
+        # The trial must run for the probation time before closing
+        self.assertTrue(breaker.allow(now=375))
+        self.assertEqual(breaker.record_success(now=380), BreakerState.HALF_OPEN)
+        self.assertEqual(breaker.record_success(now=385), BreakerState.CLOSED)
+        self.assertEqual(breaker.trips, 2)
+        self.assertEqual(breaker.record_failure(now=390), BreakerState.CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,6 @@
+import json
+import os
+import tempfile
 import time
 import unittest
 
@@ -12,7 +15,7 @@ class CommandFactoryTestCase(unittest.TestCase):
         logger.debug("CREATING THE MACHINE")
         command_factory = CommandFactory(json_files_list=["machines_cfgs/cuda_micro.json"],
                                          logger_name="COMMAND_FACTORY",
-                                         command_window=5)
+                                         command_window=5, window_clock="wall")
         logger.debug("Executing command factory")
         first = command_factory.get_commands_and_test_info()[0]
         sec = first
@@ -24,6 +27,155 @@ class CommandFactoryTestCase(unittest.TestCase):
         time.sleep(10)
         self.assertEqual(True, first != sec and command_factory.is_command_window_timed_out)  # add assertion here
 
+    def test_stop_conditions(self):
+        commands = [
+            {"killcmd": "killall -9 sdc", "exec": "/home/carol/sdc", "codename": "sdc", "header": "sdc",
+             "stop_conditions": {"target_sdcs": 3}},
+            {"killcmd": "killall -9 crash", "exec": "/home/carol/crash", "codename": "crash", "header": "crash",
+             "stop_conditions": {"max_crashes": 2, "max_ci_width": 0.5}},
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, "stop_conditions.json")
+            with open(json_file, "w") as fp:
+                json.dump(commands, fp)
+            command_factory = CommandFactory(json_files_list=[json_file], logger_name="COMMAND_FACTORY")
+
+        # The queue is consumed from the end
+        self.assertEqual(command_factory.get_commands_and_test_info()[2], "crash")
+        command_factory.record_crash()
+        self.assertFalse(command_factory.is_command_window_timed_out)
+        command_factory.record_crash()
+        self.assertEqual(command_factory.stop_condition_reached, "reached 2 crashes")
+        self.assertTrue(command_factory.is_command_window_timed_out)
+
+        self.assertEqual(command_factory.get_commands_and_test_info()[2], "sdc")
+        self.assertIsNone(command_factory.stop_condition_reached)
+        for _ in range(100):
+            command_factory.record_message(connection_type="#IT")
+        command_factory.record_message(connection_type="#SDC")
+        command_factory.record_message(connection_type="#SDC")
+        self.assertFalse(command_factory.is_command_window_timed_out)
+        command_factory.record_message(connection_type="#SDC")
+        self.assertTrue(command_factory.is_command_window_timed_out)
+
+        # The confidence interval gets narrow enough after some tens of SDCs
+        self.assertEqual(command_factory.get_commands_and_test_info()[2], "crash")
+        sdcs = 0
+        while command_factory.stop_condition_reached is None:
+            command_factory.record_message(connection_type="#SDC")
+            sdcs += 1
+        self.assertGreater(sdcs, 10)
+        self.assertIn("confidence interval", command_factory.stop_condition_reached)
+
+    def test_beam_pause_freezes_the_command_window(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, "benchmarks.json")
+            with open(json_file, "w") as fp:
+                json.dump([{"killcmd": "killall -9 lava", "exec": "/home/carol/lava", "codename": "lava",
+                            "header": "lava"}], fp)
+            command_factory = CommandFactory(json_files_list=[json_file], logger_name="COMMAND_FACTORY",
+                                             command_window=0.5, window_clock="wall")
+        command_factory.pause()
+        time.sleep(0.6)
+        command_factory.resume()
+        self.assertFalse(command_factory.is_command_window_timed_out)
+        time.sleep(0.6)
+        self.assertTrue(command_factory.is_command_window_timed_out)
+
+    def test_benchmark_crash_loop(self):
+        commands = [{"killcmd": f"killall -9 {codename}", "exec": f"/home/carol/{codename}", "codename": codename,
+                     "header": codename} for codename in ("good", "crashing")]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, "crash_loop.json")
+            with open(json_file, "w") as fp:
+                json.dump(commands, fp)
+            # Zero window: the benchmark is rotated on every call
+            command_factory = CommandFactory(json_files_list=[json_file], logger_name="COMMAND_FACTORY",
+                                             command_window=0, hostname="carol", window_clock="wall")
+
+        self.assertEqual(command_factory.current_codename, "crashing")
+        while command_factory.stop_condition_reached is None:
+            command_factory.record_crash()
+        self.assertEqual(command_factory.stop_condition_reached, "keeps crashing the DUT")
+        self.assertEqual(command_factory.benchmark_breakers, {"good": "CLOSED", "crashing": "OPEN"})
+        # The crashing benchmark is skipped while its breaker is open
+        codenames = [command_factory.get_commands_and_test_info()[2] for _ in range(4)]
+        self.assertEqual(codenames, ["good"] * 4)
+
+    def test_effective_command_window(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, "benchmarks.json")
+            with open(json_file, "w") as fp:
+                json.dump([{"killcmd": f"killall -9 {codename}", "exec": f"/home/carol/{codename}",
+                            "codename": codename, "header": codename} for codename in ("lava", "crashing")], fp)
+            exposure_file = os.path.join(tmp_dir, "exposure.json")
+            command_factory = CommandFactory(json_files_list=[json_file], logger_name="COMMAND_FACTORY",
+                                             command_window=100, window_clock="effective",
+                                             exposure_file=exposure_file)
+            self.assertEqual(command_factory.current_codename, "crashing")
+            # The header does not start the exposure, the boot and the app start are not counted
+            command_factory.record_message(connection_type="#HEADER", now=1000.0)
+            command_factory.record_message(connection_type="#BEGIN", now=1010.0)
+            for now in range(1011, 1071):
+                command_factory.record_message(connection_type="#IT", now=float(now))
+            command_factory.record_message(connection_type="#SDC", now=1070.0)
+            self.assertEqual(command_factory.effective_time, 60.0)
+            self.assertFalse(command_factory.is_command_window_timed_out)
+            # The timeout and the reboots (1070 to 2000) are not counted
+            command_factory.record_crash()
+            command_factory.record_message(connection_type="#IT", now=2000.0)
+            command_factory.record_message(connection_type="#IT", now=2030.0)
+            self.assertEqual(command_factory.effective_time, 90.0)
+            self.assertFalse(command_factory.is_command_window_timed_out)
+            # The beam pause ends the exposure, it starts again with the next #IT
+            command_factory.pause()
+            command_factory.resume()
+            command_factory.record_message(connection_type="#INF", now=5000.0)
+            command_factory.record_message(connection_type="#IT", now=5001.0)
+            command_factory.record_message(connection_type="#IT", now=5012.0)
+            self.assertTrue(command_factory.is_command_window_timed_out)
+            command_factory.record_message(connection_type="#IT", now=5013.0)
+            # The rotation ends the exposure of the previous benchmark
+            self.assertEqual(command_factory.get_commands_and_test_info()[2], "lava")
+            self.assertEqual(command_factory.effective_time, 0.0)
+            expected_totals = {"crashing": {"exposure": 102.0, "iterations": 65, "sdcs": 1, "runs": 3},
+                               "lava": {"exposure": 0.0, "iterations": 0, "sdcs": 0, "runs": 0}}
+            self.assertEqual(command_factory.exposure_totals, expected_totals)
+
+            # The totals are kept across server restarts
+            with open(exposure_file) as fp:
+                self.assertEqual(json.load(fp), expected_totals)
+            command_factory = CommandFactory(json_files_list=[json_file], logger_name="COMMAND_FACTORY",
+                                             window_clock="effective", exposure_file=exposure_file)
+            self.assertEqual(command_factory.exposure_totals, expected_totals)
+
+    def test_effective_command_window_wall_time_cap(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, "benchmarks.json")
+            with open(json_file, "w") as fp:
+                json.dump([{"killcmd": f"killall -9 {codename}", "exec": f"/home/carol/{codename}",
+                            "codename": codename, "header": codename} for codename in ("lava", "crashing")], fp)
+            command_factory = CommandFactory(json_files_list=[json_file], logger_name="COMMAND_FACTORY",
+                                             command_window=0.2)
+        # The benchmark crashes before its first #IT or #BEGIN, it never accumulates exposure
+        self.assertEqual(command_factory.current_codename, "crashing")
+        command_factory.record_message(connection_type="#HEADER")
+        command_factory.record_crash()
+        self.assertFalse(command_factory.is_command_window_timed_out)
+        time.sleep(0.7)
+        self.assertEqual(command_factory.effective_time, 0.0)
+        self.assertTrue(command_factory.is_command_window_timed_out)
+        self.assertEqual(command_factory.get_commands_and_test_info()[2], "lava")
+
+    def test_unknown_stop_condition(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, "unknown.json")
+            with open(json_file, "w") as fp:
+                json.dump([{"killcmd": "k", "exec": "e", "codename": "c", "header": "h",
+                            "stop_conditions": {"target_beam_time": 1}}], fp)
+            with self.assertRaises(ValueError):
+                CommandFactory(json_files_list=[json_file], logger_name="COMMAND_FACTORY")
+
 
 if __name__ == '__main__':
     unittest.main()
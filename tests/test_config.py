@@ -0,0 +1,109 @@
+import json
+import os
+import stat
+import tempfile
+import time
+import unittest
+
+import yaml
+
+from server.config import ConfigError, MachineConfig, load_fleet_config, load_machine_config
+
+
+class ConfigTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.json_file = os.path.join(self.tmp_dir.name, "benchmark.json")
+        with open(self.json_file, "w") as fp:
+            fp.write('[{"killcmd": "killall -9 lava", "exec": "/home/carol/lava", "codename": "lava", '
+                     '"header": "lava", "stop_conditions": {"target_sdcs": 10}}]')
+        self.machine = {"ip": "127.0.0.1", "hostname": "carol", "username": "carol", "password": "carol",
+                        "power_switch_ip": "127.0.0.1", "power_switch_port": 1, "power_switch_model": "lindy",
+                        "boot_waiting_time": 10, "max_timeout_time": 10, "receive_port": 1024,
+                        "json_files": [self.json_file]}
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def write_machine(self, cfg_file: str, parameters: dict) -> str:
+        cfg_path = os.path.join(self.tmp_dir.name, cfg_file)
+        with open(cfg_path, "w") as fp:
+            yaml.safe_dump(parameters, fp)
+        return cfg_path
+
+    def test_load_machine_config(self):
+        config = load_machine_config(cfg_file=self.write_machine("good.yaml", self.machine))
+        self.assertIsInstance(config, MachineConfig)
+        self.assertEqual(config.telnet_port, 23)
+        self.assertEqual(config.json_files, (self.json_file,))
+        self.assertEqual(config.benchmarks[0].codename, "lava")
+        self.assertEqual(config.benchmarks[0].stop_conditions, {"target_sdcs": 10})
+
+    def test_all_problems_are_reported(self):
+        parameters = dict(self.machine, receive_port="1024", unknown_key=1, power_switch_port=True)
+        del parameters["hostname"]
+        with self.assertRaises(ConfigError) as context:
+            load_machine_config(cfg_file=self.write_machine("bad.yaml", parameters))
+        message = str(context.exception)
+        for problem in ("'receive_port' must be int", "unknown key 'unknown_key'", "missing key 'hostname'",
+                        "'power_switch_port' must be int"):
+            self.assertIn(problem, message)
+
+        with open(self.json_file, "w") as fp:
+            fp.write('[{"killcmd": "k", "exec": "e", "codename": "c", "header": "h", "stop_conditions": {"sdcs": 1}}]')
+        with self.assertRaises(ConfigError) as context:
+            load_machine_config(cfg_file=self.write_machine("good.yaml", self.machine))
+        self.assertIn("unknown stop conditions", str(context.exception))
+
+    def test_fleet_duplicates(self):
+        cfg_files = [self.write_machine("dut1.yaml", self.machine),
+                     self.write_machine("dut2.yaml", dict(self.machine, ip="127.0.0.2", hostname="carol2"))]
+        with self.assertRaises(ConfigError) as context:
+            load_fleet_config(cfg_files=cfg_files)
+        message = str(context.exception)
+        self.assertIn("duplicate receive_port 1024", message)
+        self.assertIn("duplicate power switch outlet 127.0.0.1:1", message)
+        self.assertNotIn("duplicate hostname", message)
+
+    def test_config_cache(self):
+        cache_file = os.path.join(self.tmp_dir.name, "config.cache")
+        cfg_file = self.write_machine("good.yaml", self.machine)
+        first_load = load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file)
+        self.assertTrue(os.path.isfile(cache_file))
+        self.assertEqual(load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file), first_load)
+
+        # Touching the file (new mtime, same content) keeps the cache valid
+        os.utime(cfg_file, ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+        self.assertEqual(load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file), first_load)
+
+        # A content change on a benchmark file invalidates it
+        with open(self.json_file, "w") as fp:
+            fp.write('[{"killcmd": "killall -9 hotspot", "exec": "/home/carol/hotspot", "codename": "hotspot", '
+                     '"header": "hotspot"}]')
+        reloaded = load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file)
+        self.assertEqual(reloaded[0].benchmarks[0].codename, "hotspot")
+
+    def test_bad_config_cache_is_a_miss(self):
+        cache_file = os.path.join(self.tmp_dir.name, "config.cache")
+        cfg_file = self.write_machine("good.yaml", self.machine)
+        first_load = load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file)
+        for content in ("[1, 2]", "{not json", '{"version": 10, "cfg_files": 1}'):
+            with open(cache_file, "w") as fp:
+                fp.write(content)
+            self.assertEqual(load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file), first_load)
+
+        # The cache is used while only its owner can write it, otherwise the files are parsed again
+        load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file)
+        with open(cache_file) as fp:
+            cache = json.load(fp)
+        cache["machine_configs"][0]["hostname"] = "planted"
+        with open(cache_file, "w") as fp:
+            json.dump(cache, fp)
+        self.assertEqual(load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file)[0].hostname, "planted")
+        os.chmod(cache_file, 0o666)
+        self.assertEqual(load_fleet_config(cfg_files=[cfg_file], cache_file=cache_file)[0].hostname, "carol")
+        self.assertEqual(stat.S_IMODE(os.stat(cache_file).st_mode), 0o600)
+
+
+if __name__ == '__main__':
+    unittest.main()
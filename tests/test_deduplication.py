@@ -0,0 +1,48 @@
+import unittest
+
+from server.deduplication import MessageDeduplicator, ReorderBuffer, split_sequence_number
+
+
+class DeduplicationTestCase(unittest.TestCase):
+    def test_deduplicator(self):
+        deduplicator = MessageDeduplicator(window=2.0, max_entries=3)
+        self.assertFalse(deduplicator.is_duplicate(message=b"\x0e#SDC Ite:1", now=0.0))
+        self.assertTrue(deduplicator.is_duplicate(message=memoryview(b"\x0e#SDC Ite:1"), now=1.0))
+        # A different ECC byte is a different message
+        self.assertFalse(deduplicator.is_duplicate(message=b"\x0d#SDC Ite:1", now=1.0))
+        # Outside the window the same content is accepted again
+        self.assertFalse(deduplicator.is_duplicate(message=b"\x0e#SDC Ite:1", now=3.5))
+        # Only max_entries digests are remembered
+        for iteration in range(2, 6):
+            self.assertFalse(deduplicator.is_duplicate(message=b"\x0e#IT Ite:%d" % iteration, now=3.6))
+        self.assertFalse(deduplicator.is_duplicate(message=b"\x0e#IT Ite:2", now=3.7))
+        self.assertEqual(deduplicator.duplicates, 1)
+
+    def test_split_sequence_number(self):
+        self.assertEqual(split_sequence_number(b"\x0e#SEQ:12 #IT Ite:1"), (12, b"\x0e#IT Ite:1"))
+        self.assertEqual(split_sequence_number(b"\x0e#IT Ite:1"), (None, b"\x0e#IT Ite:1"))
+        self.assertEqual(split_sequence_number(b"\x0e#SEQ:x #IT"), (None, b"\x0e#SEQ:x #IT"))
+
+    def test_reorder_buffer(self):
+        reorder_buffer = ReorderBuffer(window=1.0)
+        released = list()
+        for now, sequence in enumerate([0, 2, 1, 1, 3, 5, 6]):
+            released += reorder_buffer.push(message=b"\x0e#SEQ:%d #IT Ite:%d" % (sequence, sequence), now=now * 0.1)
+        self.assertEqual(released, [b"\x0e#IT Ite:%d" % i for i in range(4)])
+        self.assertEqual(reorder_buffer.held, 2)
+        self.assertEqual(reorder_buffer.duplicates, 1)
+        # Sequence 4 is lost, after the window the next messages are released
+        released = reorder_buffer.push(message=b"\x0e#SEQ:7 #IT Ite:7", now=2.0)
+        self.assertEqual(released, [b"\x0e#IT Ite:%d" % i for i in (5, 6, 7)])
+        self.assertEqual(reorder_buffer.lost, 1)
+        self.assertEqual(reorder_buffer.reordered, 4)
+
+        reorder_buffer.push(message=b"\x0e#SEQ:9 #IT Ite:9", now=2.1)
+        self.assertEqual(reorder_buffer.flush(now=2.2), [b"\x0e#IT Ite:9"])
+        reorder_buffer.reset()
+        # After an app restart the sequence starts again
+        self.assertEqual(reorder_buffer.push(message=b"\x0e#SEQ:0 #HEADER", now=3.0), [b"\x0e#HEADER"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
 import os.path
 import struct
+import tempfile
+import time
 import unittest
 
-from server.dut_logging import DUTLogging
+from server.dut_logging import DUTLogging, EndStatus, LogFileManager, read_receive_timestamps
 from server.logger_formatter import logging_setup
 
 
@@ -28,6 +30,95 @@ class DUTLoggingTestCase(unittest.TestCase):
         self.assertEqual(True, os.path.isfile(
             dut_logging.log_filename) and "ECC_OFF" in dut_logging.log_filename)  # add assertion here
 
+    def test_dut_logging_from_receive_buffer(self):
+        dut_logging = DUTLogging(log_dir="/tmp", test_name="DebugTestBuffer", test_header="Testing DUT_LOGGING",
+                                 hostname="carol", logger_name="DUT_LOGGING")
+        buffer = bytearray(64)
+        for mss_content in [b"#IT Ite:1", b"#ERR with new line\n", b"#IT Ite:2"]:
+            data_size = len(mss_content) + 1
+            buffer[:data_size] = bytes([0xE]) + mss_content
+            dut_logging(message=memoryview(buffer)[:data_size])
+        log_filename = dut_logging.log_filename
+        dut_logging.finish_this_dut_log(EndStatus.NORMAL_END)
+        with open(log_filename) as log_file:
+            lines = log_file.readlines()
+        os.remove(log_filename)
+        self.assertIn("ECC_ON", log_filename)
+        self.assertEqual(lines[2:5], ["#IT Ite:1\n", "#ERR with new line\n", "#IT Ite:2\n"])
+        self.assertTrue(lines[5].startswith(str(EndStatus.NORMAL_END)))
+
+    def test_sharded_log_directory(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dut_logging = DUTLogging(log_dir=tmp_dir, test_name="DebugTestShard", test_header="Testing DUT_LOGGING",
+                                     hostname="carol", logger_name="DUT_LOGGING")
+            dut_logging(message=bytes([0xE]) + b"#IT Ite:1")
+            log_filename = dut_logging.log_filename
+            dut_logging.finish_this_dut_log(EndStatus.NORMAL_END)
+            date_dir, test_dir, _ = os.path.relpath(log_filename, tmp_dir).split(os.sep)
+            self.assertRegex(date_dir, r"^\d{4}_\d{2}_\d{2}$")
+            self.assertEqual(test_dir, "DebugTestShard")
+
+    def test_logs_created_in_the_same_second_are_not_merged(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_filenames = list()
+            for iteration in range(3):
+                dut_logging = DUTLogging(log_dir=tmp_dir, test_name="DebugTestSameSecond", test_header="same second",
+                                         hostname="carol", logger_name="DUT_LOGGING")
+                dut_logging(message=bytes([0xE]) + f"#IT Ite:{iteration}".encode("ascii"))
+                log_filenames.append(dut_logging.log_filename)
+                dut_logging.finish_this_dut_log(EndStatus.NORMAL_END)
+            self.assertEqual(len(set(log_filenames)), 3)
+            for iteration, log_filename in enumerate(log_filenames):
+                self.assertTrue(log_filename.endswith("_DebugTestSameSecond_ECC_ON_carol.log"))
+                with open(log_filename) as log_file:
+                    lines = log_file.readlines()
+                self.assertEqual(len(lines), 4)
+                self.assertTrue(lines[0].startswith("#SERVER_HEADER same second"))
+                self.assertEqual(lines[2], f"#IT Ite:{iteration}\n")
+
+    def test_receive_timestamps(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dut_logging = DUTLogging(log_dir=tmp_dir, test_name="DebugTestTimestamps",
+                                     test_header="Testing DUT_LOGGING", hostname="carol", logger_name="DUT_LOGGING",
+                                     receive_timestamps=True)
+            start_ns, start_wall_clock_ns = time.monotonic_ns(), time.time_ns()
+            messages = [b"#IT Ite:1", b"#SDC with new line\n", b"#IT Ite:2"]
+            for i, mss_content in enumerate(messages):
+                dut_logging(message=bytes([0xE]) + mss_content, receive_ns=start_ns + i * 1000)
+            log_filename = dut_logging.log_filename
+            dut_logging.finish_this_dut_log(EndStatus.NORMAL_END)
+            timestamps = read_receive_timestamps(log_filename=log_filename)
+            with open(log_filename, "rb") as log_file:
+                content = log_file.read()
+        self.assertEqual(len(timestamps), 3)
+        for (offset, wall_clock_ns), mss_content in zip(timestamps, messages):
+            self.assertEqual(content[offset:].split(b"\n")[0], mss_content.rstrip(b"\n"))
+        # Nanosecond resolution, and on the wall clock of the log creation
+        self.assertEqual([wall_clock_ns - timestamps[0][1] for _, wall_clock_ns in timestamps], [0, 1000, 2000])
+        self.assertLess(abs(timestamps[0][1] - start_wall_clock_ns), 100_000_000)
+
+    def test_log_file_budget(self):
+        file_manager = LogFileManager(max_open_files=2)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dut_loggings = [DUTLogging(log_dir=tmp_dir, test_name=f"DebugTestBudget{i}", test_header="budget",
+                                       hostname=f"carol{i}", logger_name="DUT_LOGGING", file_manager=file_manager)
+                            for i in range(5)]
+            # Interleaved writers, each write may evict the file of another DUT
+            for iteration in range(20):
+                for dut_logging in dut_loggings:
+                    dut_logging(message=bytes([0xD]) + f"#IT Ite:{iteration}".encode("ascii"))
+                self.assertLessEqual(file_manager.open_files, 2)
+            log_filenames = [dut_logging.log_filename for dut_logging in dut_loggings]
+            for dut_logging in dut_loggings:
+                dut_logging.finish_this_dut_log(EndStatus.NORMAL_END)
+            self.assertEqual(file_manager.open_files, 0)
+            self.assertGreater(file_manager.stats["evictions"], 0)
+            for log_filename in log_filenames:
+                with open(log_filename) as log_file:
+                    lines = log_file.readlines()
+                self.assertEqual(lines[2:22], [f"#IT Ite:{iteration}\n" for iteration in range(20)])
+                self.assertTrue(lines[22].startswith(str(EndStatus.NORMAL_END)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,238 @@
+import glob
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from benchmarks.run_benchmarks import _SimulatedFleet, _benchmark_logging
+from server.dut_logging import read_receive_timestamps
+from tests.helpers import wait_for
+
+# Messages read by the Machine before the app hangs, and from the app started by the recovery
+_WARMUP_MESSAGES = 50
+
+
+def _wait_for(condition, timeout: float = 20.0) -> bool:
+    # The Machine recovers within seconds, a short poll keeps the tests fast
+    return wait_for(condition=condition, timeout=timeout, poll_interval=0.01)
+
+
+def _dut_log_files(fleet: _SimulatedFleet) -> list:
+    return sorted(glob.glob(os.path.join(fleet.log_dir, "simulated0", "**", "*.log"), recursive=True))
+
+
+class DUTSimulatorTestCase(unittest.TestCase):
+    def __hang_and_recover(self, fleet: _SimulatedFleet) -> None:
+        """ Hang the app of the first DUT once the Machine reads its messages, and wait until the Machine
+        reads the messages of the app started by the recovery
+        """
+        machine, dut = fleet.machines[0], fleet.duts[0]
+        self.assertTrue(_wait_for(lambda: machine.metrics["received_messages"] > _WARMUP_MESSAGES))
+        self.assertEqual(len(dut.app_start_times), 1)
+        dut.hang_app()
+        self.assertTrue(_wait_for(lambda: len(dut.app_start_times) > 1))
+        received_messages = machine.metrics["received_messages"]
+        self.assertTrue(_wait_for(lambda: machine.metrics["received_messages"] > received_messages + _WARMUP_MESSAGES))
+
+    def test_machine_with_simulated_dut(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, iterations_per_second=50, sdc_interval=10,
+                                    errors_per_sdc=2, machine_parameters={"receive_timestamps": True})
+            fleet.start()
+            # The app stops sending, the Machine must perform a soft app reboot
+            self.__hang_and_recover(fleet=fleet)
+            fleet.stop()
+            log_files = _dut_log_files(fleet=fleet)
+            with open(log_files[0]) as fp:
+                first_log = fp.read()
+            receive_timestamps = read_receive_timestamps(log_filename=log_files[0])
+            del fleet
+
+        self.assertEqual(len(log_files), 2)
+        self.assertIn("#HEADER simulated benchmark", first_log)
+        self.assertIn("#SDC Ite:9", first_log)
+        self.assertIn("#IT Ite:10", first_log)
+        self.assertIn("#SERVER_DUE:soft APP reboot", first_log)
+        # One receive timestamp per DUT message, pointing to the start of its line
+        dut_lines = [line for line in first_log.splitlines() if not line.startswith("#SERVER_")]
+        self.assertEqual(len(receive_timestamps), len(dut_lines))
+        self.assertEqual([first_log[offset:].split("\n")[0] for offset, _ in receive_timestamps], dut_lines)
+        receive_times = [receive_time for _, receive_time in receive_timestamps]
+        self.assertEqual(receive_times, sorted(receive_times))
+
+    def test_boot_heartbeat_with_auto_started_app(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            # Telnet is only available 4s after the power ON, but the app starts by itself
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, boot_heartbeat=True, boot_time=4,
+                                    app_auto_start_time=0.2, iterations_per_second=50)
+            start_time = time.monotonic()
+            fleet.start()
+            dut = fleet.duts[0]
+            deadline = time.monotonic() + 10
+            log_files = list()
+            while not log_files and time.monotonic() < deadline:
+                log_files = glob.glob(os.path.join(fleet.log_dir, "simulated0", "**", "*.log"), recursive=True)
+                time.sleep(0.05)
+            log_created_after = time.monotonic() - start_time
+            # After telnet is ready the app must not be restarted
+            time.sleep(4.5)
+            fleet.stop()
+            app_starts = len(dut.app_start_times)
+            with open(log_files[0]) as fp:
+                log = fp.read()
+            del fleet, dut
+
+        self.assertLess(log_created_after, 4)
+        self.assertEqual(app_starts, 1)
+        self.assertIn("#HEADER simulated benchmark", log)
+        self.assertIn("#IT Ite:100", log)
+
+    def test_auto_started_app_of_another_benchmark_is_restarted(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            # The image starts a benchmark that is not the one selected by the server
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, boot_heartbeat=True, boot_time=1,
+                                    app_auto_start_time=0.2, iterations_per_second=50, header="another benchmark")
+            fleet.start()
+            dut = fleet.duts[0]
+            deadline = time.monotonic() + 10
+            while len(dut.app_start_times) < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            fleet.stop()
+            app_starts = len(dut.app_start_times)
+            del fleet, dut
+
+        # Started by the image, then killed and started again by the telnet command
+        self.assertEqual(app_starts, 2)
+
+    def test_duplicated_and_out_of_order_messages(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, iterations_per_second=100, duplicate_interval=5,
+                                    sequence_numbers=True, swap_interval=7, sdc_interval=10,
+                                    machine_parameters={"reorder_window": 0.5})
+            fleet.start()
+            time.sleep(1.5)
+            fleet.stop()
+            metrics = fleet.machines[0].metrics
+            log_files = glob.glob(os.path.join(fleet.log_dir, "simulated0", "**", "*.log"), recursive=True)
+            with open(log_files[0]) as fp:
+                iterations = [line for line in fp if line.startswith("#IT") or line.startswith("#SDC")]
+            del fleet
+
+        self.assertGreater(len(iterations), 50)
+        # No duplicates, in order and without the sequence prefix
+        self.assertEqual(len(iterations), len(set(iterations)))
+        iteration_numbers = [int(line.split()[1].split(":")[1]) for line in iterations]
+        self.assertEqual(iteration_numbers, sorted(iteration_numbers))
+        self.assertGreater(metrics["duplicates_removed"], 0)
+        self.assertGreater(metrics["reordered_messages"], 0)
+        self.assertEqual(metrics["lost_messages"], 0)
+
+    def test_history_reboot_policy_skips_the_soft_app_reboot(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            # On the previous campaigns the soft app reboot never recovered this board
+            history_dir = os.path.join(work_dir, "logs", "simulated0")
+            os.makedirs(history_dir)
+            with open(os.path.join(history_dir, "reboot_history.json"), "w") as fp:
+                json.dump({"SOFT_APP_REBOOT": {"simulated": [10, 0, 40.0]},
+                           "HARD_REBOOT": {"simulated": [10, 10, 30.0]}}, fp)
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, iterations_per_second=50,
+                                    machine_parameters={"reboot_policy": "history"})
+            fleet.start()
+            self.__hang_and_recover(fleet=fleet)
+            fleet.stop()
+            metrics = fleet.machines[0].metrics
+            with open(_dut_log_files(fleet=fleet)[0]) as fp:
+                first_log = fp.read()
+            del fleet
+
+        self.assertIn("#SERVER_DUE:power cycle", first_log)
+        self.assertEqual(metrics["successful_reboots"]["HARD_REBOOT"], 1)
+        self.assertEqual(metrics["reboot_policy"]["name"], "history")
+        # The power cycle recovery was recorded when the first #IT arrived
+        self.assertEqual(metrics["reboot_policy"]["tiers"]["HARD_REBOOT"]["attempts"], 11)
+        self.assertEqual(metrics["reboot_policy"]["tiers"]["SOFT_APP_REBOOT"]["attempts"], 10)
+
+    def test_the_log_ends_with_the_first_tier_before_the_power_cycle(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, iterations_per_second=50)
+            fleet.start()
+            machine, dut = fleet.machines[0], fleet.duts[0]
+            self.assertTrue(_wait_for(lambda: machine.metrics["received_messages"] > _WARMUP_MESSAGES))
+            # The telnet login of the soft app reboot fails, only the power cycle recovers the DUT
+            dut.hang_os()
+            self.assertTrue(_wait_for(lambda: len(dut.app_start_times) > 1, timeout=30))
+            fleet.stop()
+            metrics = machine.metrics
+            with open(_dut_log_files(fleet=fleet)[0]) as fp:
+                first_log = fp.read()
+            del fleet, machine, dut
+
+        self.assertEqual(metrics["successful_reboots"]["HARD_REBOOT"], 1)
+        self.assertNotIn("#SERVER_DUE:power cycle", first_log)
+        self.assertTrue(first_log.splitlines()[-1].startswith("#SERVER_DUE:soft APP reboot TIME:"))
+
+    def test_only_the_crashes_right_after_a_power_cycle_quarantine_the_dut(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, iterations_per_second=50,
+                                    machine_parameters={"crash_loop_reboots": 2, "crash_loop_uptime": 0.5})
+            fleet.start()
+            machine, dut = fleet.machines[0], fleet.duts[0]
+            dut_breaker = list()
+            for _ in range(3):
+                # The first hang comes after a healthy run, the next ones right after the app starts again
+                app_starts = len(dut.app_start_times)
+                if app_starts == 1:
+                    # The messages sent during the app start wait are read at once, the run is measured after them
+                    self.assertTrue(_wait_for(lambda: machine.metrics["received_messages"] > _WARMUP_MESSAGES))
+                    received_messages = machine.metrics["received_messages"]
+                    self.assertTrue(_wait_for(lambda: machine.metrics["received_messages"] >
+                                              received_messages + _WARMUP_MESSAGES))
+                dut.hang_os()
+                self.assertTrue(_wait_for(lambda: len(dut.app_start_times) > app_starts
+                                          or machine.metrics["circuit_breakers"]["dut"] == "OPEN", timeout=30))
+                dut_breaker.append(machine.metrics["circuit_breakers"]["dut"])
+            fleet.stop()
+            del fleet, machine, dut
+
+        self.assertEqual(dut_breaker, ["CLOSED", "CLOSED", "OPEN"])
+
+    def test_ingest_budget_under_error_flood(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            # 5000 #ERR lines per second, one line per corrupted element, sent by another process
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, traffic_process=True, iterations_per_second=100,
+                                    sdc_interval=10, errors_per_sdc=500,
+                                    machine_parameters={"max_err_rate": 50, "max_it_rate": 20})
+            fleet.start()
+            machine = fleet.machines[0]
+            # Several shed summaries on the first log before the hang
+            self.assertTrue(_wait_for(lambda: machine.metrics["shed_messages"]["#ERR"] > 3000))
+            self.__hang_and_recover(fleet=fleet)
+            fleet.stop()
+            metrics = machine.metrics
+            logs = list()
+            for log_file in _dut_log_files(fleet=fleet):
+                with open(log_file) as fp:
+                    logs.append(fp.read().splitlines())
+            del fleet, machine
+
+        first_log = logs[0]
+        self.assertGreater(metrics["shed_messages"]["#ERR"], 1000)
+        self.assertGreater(metrics["shed_messages"]["#IT"], 0)
+        shed_lines = [line for line in first_log if line.startswith("#SERVER_SHED")]
+        self.assertGreater(len(shed_lines), 1)
+        # The app restarted after the hang keeps flooding the second log
+        first_log_shed = sum(int(line.split()[1].split(":")[1]) for line in shed_lines)
+        self.assertGreater(first_log_shed, 1000)
+        self.assertLessEqual(first_log_shed, metrics["shed_messages"]["#ERR"])
+        # Every SDC is written, and the shed messages are still counted
+        rates = metrics["rates"]["simulated"]
+        self.assertEqual(sum(line.startswith("#SDC") for log in logs for line in log), rates["sdcs"])
+        self.assertLess(len([line for line in first_log if line.startswith("#ERR")]), 50 * 5)
+        self.assertGreater(rates["errors"], 1000)
+        # The first start and the recovery after the hang: the flood did not delay the watchdog into other timeouts
+        self.assertEqual(metrics["successful_reboots"]["SOFT_APP_REBOOT"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+from server.dut_logging import EndStatus
+from server.error_rate_monitor import ErrorRateMonitor, RollingCounter, poisson_confidence_interval
+
+
+class ErrorRateMonitorTestCase(unittest.TestCase):
+    def test_rolling_counter(self):
+        counter = RollingCounter(window=60, bucket=10)
+        for now in range(0, 60):
+            counter.add(now=now)
+        self.assertEqual(counter.total(now=59), 60)
+        # The first bucket [0, 10) leaves the window
+        self.assertEqual(counter.total(now=60), 50)
+        counter.add(now=65, value=5)
+        self.assertEqual(counter.total(now=65), 55)
+        self.assertEqual(counter.total(now=1000), 0)
+
+    def test_poisson_confidence_interval(self):
+        lower, upper = poisson_confidence_interval(count=0)
+        self.assertEqual(lower, 0.0)
+        self.assertAlmostEqual(upper, 3.69, places=1)
+        lower, upper = poisson_confidence_interval(count=100)
+        self.assertAlmostEqual(lower, 81.4, places=0)
+        self.assertAlmostEqual(upper, 121.6, places=0)
+
+    def test_error_rate_monitor(self):
+        monitor = ErrorRateMonitor(hostname="carol", window=100, bucket=10, beam_flux=1e6)
+        for now in range(100):
+            # One second of exposure between two iterations
+            monitor.record_message(connection_type="#IT", codename="lava", now=now, exposure=1.0 if now else 0.0)
+            if now % 10 == 0:
+                monitor.record_message(connection_type="#SDC", codename="lava", now=now)
+                monitor.record_message(connection_type="#ERR", codename="lava", now=now)
+        monitor.record_crash(end_status=EndStatus.HARD_REBOOT, codename="lava", now=99)
+        monitor.record_message(connection_type="#HEADER", codename="mxm", now=99)
+        snapshot = monitor.snapshot(now=99)
+
+        self.assertEqual(list(snapshot), ["lava"])
+        rates = snapshot["lava"]
+        self.assertEqual(rates["iterations"], 100)
+        self.assertEqual(rates["sdcs"], 10)
+        self.assertEqual(rates["errors"], 10)
+        self.assertEqual(rates["crashes"]["HARD_REBOOT"], 1)
+        self.assertEqual(rates["exposure"], 99.0)
+        self.assertAlmostEqual(rates["sdcs_per_s"], 0.1, places=2)
+        self.assertAlmostEqual(rates["sdcs_per_iteration"], 0.1)
+        self.assertAlmostEqual(rates["sdc_cross_section"] * 1e7, 1.0, places=1)
+        self.assertIn("lava: IT/s:1.01 SDC:10", monitor.summary(now=99))
+
+    def test_rates_are_divided_by_the_exposure(self):
+        monitor = ErrorRateMonitor(hostname="carol", window=600, bucket=10, beam_flux=1e6)
+        # The benchmark ran for 20 s, then the DUT was rebooting for 500 s
+        for now in range(20):
+            monitor.record_message(connection_type="#IT", codename="lava", now=now, exposure=1.0 if now else 0.0)
+        monitor.record_message(connection_type="#SDC", codename="lava", now=19)
+        monitor.record_crash(end_status=EndStatus.HARD_REBOOT, codename="lava", now=20)
+        # Back for 10 s
+        for now in range(520, 530):
+            monitor.record_message(connection_type="#IT", codename="lava", now=now, exposure=1.0 if now > 520 else 0.0)
+        rates = monitor.snapshot(now=530)["lava"]
+        self.assertEqual(rates["window"], 530)
+        self.assertEqual(rates["exposure"], 28.0)
+        self.assertAlmostEqual(rates["iterations_per_s"], 30 / 28)
+        self.assertAlmostEqual(rates["sdc_cross_section"], 1 / (1e6 * 28))
+
+
+if __name__ == '__main__':
+    unittest.main()
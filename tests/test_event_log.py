@@ -0,0 +1,38 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from server.event_log import event_logging_setup, log_server_event, ServerEvent, EVENT_LOGGER_NAME
+from server.logger_formatter import logging_shutdown
+
+
+class EventLogTestCase(unittest.TestCase):
+    def test_event_log(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            event_file = os.path.join(tmp_dir, "unit_test_events.jsonl")
+            event_logging_setup(event_log_file=event_file)
+            log_server_event(ServerEvent.REBOOT, hostname="carol", tier="HARD_REBOOT", counter=1, status="SUCCESS",
+                             duration=4.5)
+            # The event is on the file without waiting for other events or for the shutdown
+            deadline = time.monotonic() + 5
+            while os.path.getsize(event_file) == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertGreater(os.path.getsize(event_file), 0)
+            log_server_event(ServerEvent.POWER_SWITCH, failed=True, address="192.168.1.42", command="ON",
+                             status="HTTP_ERROR", duration=0.1)
+            logging_shutdown(logger_name=EVENT_LOGGER_NAME)
+            with open(event_file) as fp:
+                events = [json.loads(line) for line in fp]
+
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]["event"], "reboot")
+        self.assertEqual(events[0]["hostname"], "carol")
+        self.assertEqual(events[0]["counter"], 1)
+        self.assertEqual(events[1]["event"], "power_switch")
+        self.assertEqual(events[1]["status"], "HTTP_ERROR")
+
+
+if __name__ == '__main__':
+    unittest.main()
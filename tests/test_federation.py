@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import unittest
+
+from benchmarks.dut_simulator import free_port
+from server.event_log import ServerEvent, log_server_event
+from server.federation import FederationAggregator, FederationClient, query_aggregator
+from tests.helpers import wait_for
+
+
+def _machine_metrics(hostname: str, iterations: int, sdcs: int, hard_reboots: int) -> dict:
+    return {"hostname": hostname, "codename": "lava", "paused": False, "received_messages": iterations + sdcs,
+            "last_message_age": 0.5, "circuit_breakers": {"dut": "CLOSED"},
+            "successful_reboots": {"SOFT_APP_REBOOT": 1, "SOFT_OS_REBOOT": 0, "HARD_REBOOT": hard_reboots},
+            "rates": {"lava": {"iterations": iterations, "sdcs": sdcs}}}
+
+
+class FederationTestCase(unittest.TestCase):
+    def test_two_servers_and_an_aggregator_restart(self):
+        port = free_port()
+        with tempfile.TemporaryDirectory() as output_dir:
+            aggregator = FederationAggregator(host="127.0.0.1", port=port, output_dir=output_dir,
+                                              logger_name="TEST", daemon=True)
+            aggregator.start()
+            beamline_a = [_machine_metrics("carolp1", iterations=100, sdcs=2, hard_reboots=0),
+                          _machine_metrics("carolp2", iterations=50, sdcs=1, hard_reboots=1)]
+            beamline_b = [_machine_metrics("carolx1", iterations=10, sdcs=0, hard_reboots=2)]
+            # The first one forwards the events of the event logger, like the server does
+            client_a = FederationClient(aggregator_address=f"127.0.0.1:{port}", instance="beamline-a",
+                                        fleet_state=lambda: beamline_a, logger_name="TEST", metrics_interval=0.2,
+                                        daemon=True)
+            client_b = FederationClient(aggregator_address=f"127.0.0.1:{port}", instance="beamline-b",
+                                        fleet_state=lambda: beamline_b, logger_name="TEST", metrics_interval=0.2,
+                                        forward_server_events=False, daemon=True)
+            client_a.start()
+            client_b.start()
+            try:
+                self.assertTrue(wait_for(lambda: client_a.connected and client_b.connected))
+                log_server_event(ServerEvent.REBOOT, hostname="carolp2", tier="HARD_REBOOT", status="SUCCESS")
+                client_b.publish_event({"event": "reboot", "hostname": "carolx1", "tier": "HARD_REBOOT",
+                                        "status": "SUCCESS"})
+                self.assertTrue(wait_for(lambda: client_a.buffered_events == 0 and client_b.buffered_events == 0))
+                self.assertTrue(wait_for(lambda: len(query_aggregator(f"127.0.0.1:{port}")["hosts"]) == 3))
+                fleet_view = query_aggregator(f"127.0.0.1:{port}")
+                self.assertEqual(fleet_view["hosts"], {"carolp1": "beamline-a", "carolp2": "beamline-a",
+                                                       "carolx1": "beamline-b"})
+                self.assertEqual(fleet_view["totals"]["iterations"], 160)
+                self.assertEqual(fleet_view["totals"]["sdcs"], 3)
+                self.assertEqual(fleet_view["totals"]["successful_reboots"],
+                                 {"SOFT_APP_REBOOT": 3, "SOFT_OS_REBOOT": 0, "HARD_REBOOT": 3})
+                self.assertEqual(fleet_view["reboot_events"], {"HARD_REBOOT": 2})
+                self.assertTrue(fleet_view["instances"]["beamline-b"]["connected"])
+
+                # The aggregator goes down, the events are buffered by the servers
+                aggregator.stop()
+                self.assertTrue(wait_for(lambda: not client_b.connected))
+                for i in range(3):
+                    client_b.publish_event({"event": "boot_wait", "hostname": "carolx1", "counter": i})
+                self.assertEqual(client_b.buffered_events, 3)
+                # It restarts from its event index, only the missing events are replayed
+                aggregator = FederationAggregator(host="127.0.0.1", port=port, output_dir=output_dir,
+                                                  logger_name="TEST", daemon=True)
+                aggregator.start()
+                self.assertTrue(wait_for(lambda: client_b.buffered_events == 0, timeout=15))
+                fleet_view = query_aggregator(f"127.0.0.1:{port}")
+                self.assertEqual(fleet_view["events"], {"reboot": 2, "boot_wait": 3})
+            finally:
+                client_a.stop()
+                client_b.stop()
+                client_a.join()
+                client_b.join()
+                aggregator.stop()
+            with open(os.path.join(output_dir, "events.jsonl")) as fp:
+                entries = [json.loads(line) for line in fp]
+        # Each event once, the events of each server in order (the servers send them concurrently)
+        self.assertEqual([(entry["instance"], entry["seq"]) for entry in entries if entry["instance"] == "beamline-a"],
+                         [("beamline-a", 1)])
+        self.assertEqual([(entry["instance"], entry["seq"]) for entry in entries if entry["instance"] == "beamline-b"],
+                         [("beamline-b", 1), ("beamline-b", 2), ("beamline-b", 3), ("beamline-b", 4)])
+        self.assertEqual(len(entries), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import subprocess
+import threading
+import time
+import unittest
+
+from benchmarks.dut_simulator import FakeTelnetServer, free_port
+from server.config import MachineConfig
+from server.fleet_command import run_fleet_command, select_machines
+
+
+def _machine_config(hostname: str, telnet_port: int) -> MachineConfig:
+    return MachineConfig(cfg_file=f"{hostname}.yaml", ip="127.0.0.1", hostname=hostname, username="carol",
+                         password="carol", power_switch_ip="127.0.0.1", power_switch_port=1,
+                         power_switch_model="lindy", boot_waiting_time=10, max_timeout_time=30, receive_port=1024,
+                         json_files=(), benchmarks=(), telnet_port=telnet_port)
+
+
+class FleetCommandTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.telnet_servers = list()
+
+    def tearDown(self) -> None:
+        for telnet_server in self.telnet_servers:
+            telnet_server.stop()
+
+    def __shell(self, hostname: str):
+        """ The command runs on a local shell, with the HOSTNAME of the DUT """
+
+        def _run(command: bytes) -> bytes:
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                process = subprocess.run(command.decode(), shell=True, capture_output=True,
+                                         env={"HOSTNAME": hostname, "PATH": "/usr/bin:/bin"})
+                return process.stdout.replace(b"\n", b"\r\n")
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+        return _run
+
+    def __start_dut(self, hostname: str) -> MachineConfig:
+        telnet_port = free_port()
+        telnet_server = FakeTelnetServer(ip="127.0.0.1", port=telnet_port, on_command=self.__shell(hostname))
+        telnet_server.enable()
+        telnet_server.start()
+        self.telnet_servers.append(telnet_server)
+        return _machine_config(hostname=hostname, telnet_port=telnet_port)
+
+    def test_run_on_the_fleet(self):
+        machine_configs = [self.__start_dut(hostname=f"carolp{i}") for i in range(6)]
+        # No telnet server on this port, like a DUT that is down
+        machine_configs.append(_machine_config(hostname="carolx1", telnet_port=free_port()))
+        start_time = time.monotonic()
+        results = run_fleet_command(machine_configs=machine_configs, command='sleep 0.5; echo "run $HOSTNAME"',
+                                    parallel=3, timeout=5)
+        self.assertLess(time.monotonic() - start_time, 4)
+        self.assertEqual([result.hostname for result in results], [config.hostname for config in machine_configs])
+        for result in results[:-1]:
+            self.assertTrue(result.passed, result)
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(result.output, f"run {result.hostname}")
+        self.assertFalse(results[-1].passed)
+        self.assertIn("ConnectionRefusedError", results[-1].detail)
+        self.assertEqual(self.max_in_flight, 3)
+
+        # The exit code of the command and the timeout of each DUT
+        carolp = select_machines(machine_configs=machine_configs, host_patterns=["carolp[01]"])
+        self.assertEqual([config.hostname for config in carolp], ["carolp0", "carolp1"])
+        results = run_fleet_command(machine_configs=carolp, command='echo "no model"; exit 3')
+        self.assertEqual([(result.passed, result.exit_code, result.output) for result in results],
+                         [(False, 3, "no model")] * 2)
+        start_time = time.monotonic()
+        results = run_fleet_command(machine_configs=carolp[:1], command="sleep 3", timeout=1)
+        self.assertLess(time.monotonic() - start_time, 2.5)
+        self.assertFalse(results[0].passed)
+        self.assertIsNone(results[0].exit_code)
+        self.assertEqual(results[0].detail, "timeout after 1s")
+
+
+if __name__ == '__main__':
+    unittest.main()
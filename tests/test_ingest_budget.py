@@ -0,0 +1,43 @@
+import unittest
+
+from server.ingest_budget import IngestBudget
+
+
+class IngestBudgetTestCase(unittest.TestCase):
+    def test_shed_and_summary(self):
+        ingest_budget = IngestBudget(max_err_rate=10, max_it_rate=2, summary_interval=1.0)
+        self.assertTrue(ingest_budget.enabled)
+        kept = {"#ERR": 0, "#IT": 0, "#SDC": 0}
+        # One second of flood: 100 #ERR, 20 #IT and 5 #SDC lines
+        for i in range(100):
+            now = i * 0.01
+            kept["#ERR"] += ingest_budget.admit(connection_type="#ERR", now=now)
+            if i % 5 == 0:
+                kept["#IT"] += ingest_budget.admit(connection_type="#IT", now=now)
+            if i % 20 == 0:
+                kept["#SDC"] += ingest_budget.admit(connection_type="#SDC", now=now)
+        # The burst (one second of budget) and the refill of the second
+        self.assertEqual(kept["#SDC"], 5)
+        self.assertLessEqual(kept["#ERR"], 20)
+        self.assertGreaterEqual(kept["#ERR"], 10)
+        self.assertLessEqual(kept["#IT"], 4)
+        self.assertEqual(ingest_budget.shed, {"#ERR": 100 - kept["#ERR"], "#IT": 20 - kept["#IT"]})
+
+        line = ingest_budget.summary_line(now=1.0)
+        self.assertTrue(line.startswith(f"#SERVER_SHED #ERR:{100 - kept['#ERR']} #IT:{20 - kept['#IT']} SECONDS:"))
+        # At most one line per summary_interval, unless forced
+        ingest_budget.admit(connection_type="#ERR", now=1.0)
+        self.assertIsNone(ingest_budget.summary_line(now=1.5))
+        self.assertTrue(ingest_budget.summary_line(now=1.5, force=True).startswith("#SERVER_SHED #ERR:1 #IT:0"))
+        self.assertIsNone(ingest_budget.summary_line(now=10.0, force=True))
+        # The budget refills after the flood
+        self.assertTrue(ingest_budget.admit(connection_type="#ERR", now=10.0))
+
+    def test_unlimited_classes(self):
+        ingest_budget = IngestBudget(max_err_rate=1)
+        self.assertTrue(all(ingest_budget.admit(connection_type="#IT", now=0.0) for _ in range(1000)))
+        self.assertFalse(IngestBudget().enabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
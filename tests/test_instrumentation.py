@@ -0,0 +1,84 @@
+import glob
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+
+from server.instrumentation import (DiagnosticsDumper, StageHistogram, disable_instrumentation,
+                                    enable_instrumentation, get_stage_timers, stage_summary, timed_stage)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def tearDown(self) -> None:
+        disable_instrumentation()
+        tracemalloc.stop()
+
+    def test_stage_histogram(self):
+        histogram = StageHistogram()
+        for duration_ns in [1000] * 98 + [1_000_000, 2_000_000]:
+            histogram.record(duration_ns=duration_ns)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["max_us"], 2000)
+        # The percentiles are the upper bound of the power of two buckets
+        self.assertEqual(summary["p50_us"], 1.024)
+        self.assertEqual(summary["p99_us"], 1048.576)
+
+    def test_stage_timers(self):
+        self.assertIsNone(get_stage_timers())
+        with timed_stage(stage="disabled"):
+            pass
+        enable_instrumentation()
+
+        def _worker():
+            timers = get_stage_timers()
+            start_ns = timers.record(stage="test.first", start_ns=time.perf_counter_ns())
+            timers.record(stage="test.second", start_ns=start_ns)
+            with timed_stage(stage="test.block"):
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=_worker) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        summary = stage_summary()
+        self.assertEqual(sorted(summary), ["test.block", "test.first", "test.second"])
+        self.assertEqual(summary["test.first"]["count"], 3)
+        self.assertGreaterEqual(summary["test.block"]["max_us"], 10000)
+
+    def test_diagnostics_dump_on_signal(self):
+        enable_instrumentation()
+        with timed_stage(stage="test.stage"):
+            pass
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dumper = DiagnosticsDumper(output_dir=tmp_dir, logger_name="INSTRUMENTATION", profile_duration=0.05)
+            previous_handler = signal.getsignal(signal.SIGUSR1)
+            dumper.install_signal_handler()
+            try:
+                os.kill(os.getpid(), signal.SIGUSR1)
+                deadline = time.monotonic() + 5
+                profile_files = list()
+                while not profile_files and time.monotonic() < deadline:
+                    profile_files = glob.glob(os.path.join(tmp_dir, "*_profile.folded"))
+                    time.sleep(0.01)
+            finally:
+                signal.signal(signal.SIGUSR1, previous_handler)
+            # The main thread was sampled while it waited for the dump
+            with open(profile_files[0]) as fp:
+                profile = fp.read()
+            # The first dump starts tracemalloc, the second one writes the snapshot
+            files = dumper.dump()
+            with open(files[0]) as fp:
+                stages = json.load(fp)
+        self.assertIn("test.stage", stages)
+        self.assertTrue(any(filename.endswith("_tracemalloc.txt") for filename in files))
+        self.assertIn("MainThread", profile)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import json
+import time
+import unittest
+import urllib.request
+
+from server.event_log import ServerEvent, log_server_event
+from server.live_api import LiveApiServer
+from server.live_broker import LiveBroker, get_live_broker
+
+
+class LiveApiTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.live_api = LiveApiServer(host="127.0.0.1", port=0, logger_name="LIVE_API", daemon=True,
+                                      fleet_state=lambda: [{"hostname": "carol", "codename": "lava"}])
+        self.live_api.start()
+        host, port = self.live_api.address
+        self.url = f"http://{host}:{port}"
+
+    def tearDown(self) -> None:
+        self.live_api.stop()
+        self.live_api.join(timeout=5)
+
+    def get_json(self, path: str):
+        with urllib.request.urlopen(f"{self.url}{path}", timeout=5) as response:
+            return json.loads(response.read())
+
+    def test_fleet_and_messages(self):
+        broker = get_live_broker()
+        self.assertIs(broker, self.live_api.broker)
+        for message_type, message in [("#IT", b"\x0e#IT Ite:1\n"), ("#SDC", b"\x0e#SDC Ite:1"),
+                                      ("#IT", b"\x0e#IT Ite:2")]:
+            broker.publish_dut_message(hostname="carol", message_type=message_type, message=memoryview(message))
+        broker.publish_dut_message(hostname="carol2", message_type="#IT", message=b"\x0d#IT Ite:1")
+
+        self.assertEqual(self.get_json("/fleet"), [{"hostname": "carol", "codename": "lava"}])
+        messages = self.get_json("/messages?hostname=carol")
+        self.assertEqual([item["message"] for item in messages], ["#IT Ite:1", "#SDC Ite:1", "#IT Ite:2"])
+        self.assertEqual([item["message"] for item in self.get_json("/messages?type=%23SDC")], ["#SDC Ite:1"])
+        self.assertEqual(len(self.get_json("/messages?limit=2")), 2)
+        self.assertEqual(self.get_json("/messages?hostname=unknown"), [])
+
+    def test_stream(self):
+        broker = get_live_broker()
+        with urllib.request.urlopen(f"{self.url}/stream?hostname=carol", timeout=5) as response:
+            # Wait for the subscription before publishing
+            while broker.subscribers == 0:
+                time.sleep(0.01)
+            broker.publish_dut_message(hostname="carol2", message_type="#IT", message=b"\x0e#IT Ite:1")
+            broker.publish_dut_message(hostname="carol", message_type="#SDC", message=b"\x0e#SDC Ite:1")
+            log_server_event(ServerEvent.REBOOT, hostname="carol", tier="HARD_REBOOT")
+            items = list()
+            while len(items) < 2:
+                line = response.readline().decode("utf-8")
+                if line.startswith("data: "):
+                    items.append(json.loads(line[len("data: "):]))
+        self.assertEqual((items[0]["kind"], items[0]["message"]), ("message", "#SDC Ite:1"))
+        self.assertEqual((items[1]["kind"], items[1]["event"], items[1]["tier"]), ("event", "reboot", "HARD_REBOOT"))
+
+    def test_slow_subscriber_does_not_block(self):
+        broker = LiveBroker(subscriber_buffer_size=10)
+        subscriber = broker.subscribe(message_type="#IT")
+        start_time = time.monotonic()
+        for iteration in range(1000):
+            broker.publish_dut_message(hostname="carol", message_type="#IT", message=b"\x0e#IT Ite:%d" % iteration)
+        self.assertLess(time.monotonic() - start_time, 1.0)
+        items = subscriber.get_all(timeout=0)
+        self.assertEqual([item["message"] for item in items], [f"#IT Ite:{i}" for i in range(990, 1000)])
+        self.assertEqual(subscriber.dropped, 990)
+
+
+if __name__ == '__main__':
+    unittest.main()
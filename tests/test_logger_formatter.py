@@ -0,0 +1,60 @@
+import logging
+import os
+import queue
+import tempfile
+import unittest
+
+from server.logger_formatter import logging_setup, logging_shutdown, NonBlockingQueueHandler, DropPolicy, \
+    ColoredFormatter, CachedFormatter, ColoredLogger
+
+
+class LoggerFormatterTestCase(unittest.TestCase):
+    def test_file_log_has_no_colors(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, "unit_test_log_LoggerFormatter.log")
+            logger = logging_setup(logger_name="LOGGER_FORMATTER", log_file=log_file)
+            logger.info("Testing the colored console and the file")
+            logging_shutdown(logger_name="LOGGER_FORMATTER")
+            with open(log_file) as fp:
+                content = fp.read()
+        self.assertIn("LOGGER_FORMATTER INFO Testing the colored console and the file", content)
+        self.assertNotIn("\033[", content)
+
+    def test_drop_policy(self):
+        record_args = dict(name="DROP", pathname=__file__, lineno=1, args=None, exc_info=None)
+        for drop_policy, expected_msg in [(DropPolicy.DROP_NEWEST, "first"), (DropPolicy.DROP_OLDEST, "second")]:
+            handler = NonBlockingQueueHandler(log_queue=queue.Queue(maxsize=1), drop_policy=drop_policy)
+            handler.handle(logging.LogRecord(level=logging.DEBUG, msg="first", **record_args))
+            handler.handle(logging.LogRecord(level=logging.DEBUG, msg="second", **record_args))
+            self.assertEqual(handler.dropped_records, {"DEBUG": 1})
+            self.assertEqual(handler.queue.get_nowait().msg, expected_msg)
+
+        # Warnings are never dropped in favour of debug records
+        handler = NonBlockingQueueHandler(log_queue=queue.Queue(maxsize=1), drop_policy=DropPolicy.DROP_NEWEST)
+        handler.handle(logging.LogRecord(level=logging.DEBUG, msg="debug", **record_args))
+        handler.handle(logging.LogRecord(level=logging.WARNING, msg="warning", **record_args))
+        self.assertEqual(handler.dropped_records, {"DEBUG": 1})
+        self.assertEqual(handler.queue.get_nowait().msg, "warning")
+
+        # A debug record never evicts an error, the oldest record below WARNING is evicted first
+        handler = NonBlockingQueueHandler(log_queue=queue.Queue(maxsize=2), drop_policy=DropPolicy.DROP_OLDEST)
+        for level, msg in [(logging.ERROR, "error1"), (logging.DEBUG, "debug1"), (logging.WARNING, "warning"),
+                           (logging.DEBUG, "debug2"), (logging.ERROR, "error2")]:
+            handler.handle(logging.LogRecord(level=level, msg=msg, **record_args))
+        self.assertEqual(handler.dropped_records, {"DEBUG": 2, "ERROR": 1})
+        self.assertEqual([handler.queue.get_nowait().msg for _ in range(2)], ["warning", "error2"])
+        self.assertEqual(handler.queue.unfinished_tasks, 2)
+
+    def test_formatted_cache(self):
+        record = logging.LogRecord(name="CACHE", level=logging.INFO, pathname=__file__, lineno=1, msg="cached",
+                                   args=None, exc_info=None)
+        colored = ColoredFormatter(ColoredLogger.COLOR_FORMAT).format(record)
+        plain = CachedFormatter(fmt="%(levelname)s %(message)s").format(record)
+        self.assertEqual(record.levelname, "INFO")
+        self.assertIn(ColoredFormatter.RESET_SEQ, colored)
+        self.assertEqual(plain, "INFO cached")
+        self.assertIs(CachedFormatter(fmt="%(levelname)s %(message)s").format(record), plain)
+
+
+if __name__ == '__main__':
+    unittest.main()
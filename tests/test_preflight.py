@@ -0,0 +1,58 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import yaml
+
+from benchmarks.dut_simulator import FakePowerSwitch, free_port
+from server.preflight import run_preflight_checks
+
+
+class PreflightTestCase(unittest.TestCase):
+    def test_server_imports_are_lazy(self):
+        # curses, requests and pandas are only imported when they are used
+        code = ("import sys, server.machine, server.preflight, server.print_manager, server.process_supervisor, "
+                "parser_server_log; print(sorted({'curses', 'requests', 'pandas'} & set(sys.modules)))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.stdout.strip(), "[]")
+
+    def test_preflight_checks(self):
+        power_switch = FakePowerSwitch()
+        power_switch.start()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, "benchmark.json")
+            with open(json_file, "w") as fp:
+                fp.write('[{"killcmd": "killall -9 lava", "exec": "/home/carol/lava", "codename": "lava", '
+                         '"header": "lava"}]')
+            machine = {"ip": "127.0.0.1", "hostname": "carol", "username": "carol", "password": "carol",
+                       "power_switch_ip": power_switch.switch_ip, "power_switch_port": 1,
+                       "power_switch_model": "lindy", "boot_waiting_time": 10, "max_timeout_time": 10,
+                       "receive_port": 1024, "json_files": [json_file]}
+            unreachable_switch = f"127.0.0.1:{free_port(kind=socket.SOCK_STREAM)}"
+            configs = {
+                "good.yaml": machine,
+                "unreachable.yaml": dict(machine, power_switch_ip=unreachable_switch, power_switch_model="default"),
+                "missing_key.yaml": {key: value for key, value in machine.items() if key != "receive_port"},
+            }
+            for cfg_file, parameters in configs.items():
+                with open(os.path.join(tmp_dir, cfg_file), "w") as fp:
+                    yaml.safe_dump(parameters, fp)
+            server_parameters = {"machines": [{"cfg_file": os.path.join(tmp_dir, cfg_file), "enabled": True}
+                                              for cfg_file in configs]}
+            results = {result.name: result for result in run_preflight_checks(server_parameters=server_parameters)}
+        power_switch.stop()
+
+        self.assertTrue(results[f"config {tmp_dir}/good.yaml"].passed)
+        self.assertFalse(results[f"config {tmp_dir}/missing_key.yaml"].passed)
+        self.assertIn("receive_port", results[f"config {tmp_dir}/missing_key.yaml"].detail)
+        self.assertTrue(results[f"switch {power_switch.switch_ip} (lindy)"].passed)
+        self.assertFalse(results[f"switch {unreachable_switch} (default)"].passed)
+        self.assertTrue(results["curl"].passed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import time
+import unittest
+
+from benchmarks.run_benchmarks import _SimulatedFleet, _benchmark_logging, BENCHMARK_LOGGER_NAME
+from server.process_supervisor import MachineProcessSupervisor, partition_machines
+
+
+class ProcessSupervisorTestCase(unittest.TestCase):
+    def test_partition_machines(self):
+        shards = partition_machines(machine_cfg_files=["a.yaml", "b.yaml", "c.yaml"], processes=2)
+        self.assertEqual(shards, [["a.yaml", "c.yaml"], ["b.yaml"]])
+        self.assertEqual(partition_machines(machine_cfg_files=["a.yaml"], processes=4), [["a.yaml"]])
+
+    def test_supervisor_with_simulated_duts(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=2, create_machines=False, iterations_per_second=50)
+            fleet.start_simulators()
+            supervisor = MachineProcessSupervisor(machine_cfg_files=fleet.machine_cfg_files, processes=2,
+                                                  server_ip="127.0.0.1", logger_name=BENCHMARK_LOGGER_NAME,
+                                                  server_log_path=fleet.log_dir, max_open_log_files=3)
+            supervisor.start()
+            fleet.wait_for_apps()
+            time.sleep(2)
+            supervisor.stop()
+            supervisor.join()
+            fleet.stop()
+            metrics = supervisor.metrics
+            with open(os.path.join(work_dir, "server.log")) as fp:
+                server_log = fp.read()
+            logged_messages = fleet.logged_messages()
+            del fleet
+
+        self.assertEqual(sorted(m["hostname"] for m in metrics), ["simulated0", "simulated1"])
+        self.assertTrue(all(m["received_messages"] > 0 for m in metrics))
+        # The workers do not inherit the settings of the server process, they are passed
+        self.assertTrue(all(m["log_files"]["max_open_files"] == 3 for m in metrics))
+        self.assertIn("on worker 1", server_log)
+        self.assertGreater(logged_messages, 0)
+        self.assertEqual(supervisor.worker_restarts, [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
+import os
 import unittest
+from unittest import mock
 
 from server.logger_formatter import logging_setup
-from server.reboot_machine import reboot_machine, turn_machine_on, turn_machine_off
+from server.reboot_machine import check_curl_available, reboot_machine, turn_machine_on, turn_machine_off
 from server.error_codes import ErrorCodes
 
 
@@ -23,6 +25,16 @@ class RebootMachineTestCase(unittest.TestCase):
         self.assertEqual(reboot[1], ErrorCodes.SUCCESS)
         self.assertEqual(off_status, ErrorCodes.SUCCESS)
 
+    def test_default_switch_without_curl(self):
+        with mock.patch.dict(os.environ, {"PATH": ""}):
+            check_curl_available.cache_clear()
+            with self.assertRaises(OSError):
+                check_curl_available()
+            # The Machine thread gets an error code, the exception would stop the whole fleet
+            off_status = turn_machine_off(address="192.168.1.42", switch_model="default", switch_port=1,
+                                          switch_ip="192.168.1.120", logger_name="REBOOT_MACHINE_LOG")
+        self.assertEqual(off_status, ErrorCodes.GENERAL_ERROR)
+
 
 if __name__ == '__main__':
     unittest.main()
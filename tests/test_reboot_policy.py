@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from server.dut_logging import EndStatus
+from server.reboot_policy import FixedRebootPolicy, HistoryRebootPolicy, REBOOT_TIERS, create_reboot_policy
+
+
+class RebootPolicyTestCase(unittest.TestCase):
+    def test_fixed_policy(self):
+        policy = create_reboot_policy(name="fixed", hostname="carol", logger_name="REBOOT_POLICY")
+        self.assertIsInstance(policy, FixedRebootPolicy)
+        for _ in range(10):
+            policy.record_attempt(tier=EndStatus.SOFT_APP_REBOOT, codename="lava", success=False, duration=60)
+        self.assertEqual(policy.escalation_order(codename="lava"), list(REBOOT_TIERS))
+        self.assertEqual(policy.summary()["SOFT_APP_REBOOT"], {"attempts": 10, "successes": 0, "mean_duration": 60})
+
+    def test_history_policy(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            history_file = os.path.join(tmp_dir, "reboot_history.json")
+            policy = HistoryRebootPolicy(hostname="carol", logger_name="REBOOT_POLICY", history_file=history_file,
+                                         min_attempts=3, explore_interval=0)
+            # Without history the fixed order is kept
+            self.assertEqual(policy.escalation_order(codename="lava"), list(REBOOT_TIERS))
+
+            # lava hangs the OS: the soft app reboot sends its commands, but no #IT arrives before the timeout
+            for i in range(3):
+                policy.begin_recovery(tier=EndStatus.SOFT_APP_REBOOT, codename="lava", start_time=i * 100)
+                policy.end_recovery(success=False, now=i * 100 + 45)
+                policy.record_attempt(tier=EndStatus.SOFT_OS_REBOOT, codename="lava", success=False, duration=40)
+                policy.begin_recovery(tier=EndStatus.HARD_REBOOT, codename="lava", start_time=i * 100 + 90)
+                policy.end_recovery(success=True, now=i * 100 + 120)
+            # A pending recovery is only decided once
+            policy.end_recovery(success=True, now=1000)
+            self.assertEqual(policy.tier_stats(tier=EndStatus.HARD_REBOOT).attempts, 3)
+            self.assertEqual(policy.escalation_order(codename="lava"), [EndStatus.HARD_REBOOT])
+            # The board stats are used for a codename without enough history
+            self.assertEqual(policy.escalation_order(codename="vit"), [EndStatus.HARD_REBOOT])
+
+            # On vit the soft app reboot works and it is cheap
+            for _ in range(3):
+                policy.record_attempt(tier=EndStatus.SOFT_APP_REBOOT, codename="vit", success=True, duration=5)
+            self.assertEqual(policy.escalation_order(codename="vit"), list(REBOOT_TIERS))
+            expected_times = policy.expected_recovery_times(codename="lava")
+            self.assertAlmostEqual(expected_times["HARD_REBOOT"], 30)
+            self.assertAlmostEqual(expected_times["SOFT_OS_REBOOT"], 40 + 0.8 * 30)
+
+            # The history survives a restart, the explore interval tries all the tiers
+            policy = HistoryRebootPolicy(hostname="carol", logger_name="REBOOT_POLICY", history_file=history_file,
+                                         min_attempts=3, explore_interval=2)
+            self.assertEqual(policy.escalation_order(codename="lava"), [EndStatus.HARD_REBOOT])
+            self.assertEqual(policy.escalation_order(codename="lava"), list(REBOOT_TIERS))
+
+    def test_history_policy_without_soft_os_reboot(self):
+        tiers = (EndStatus.SOFT_APP_REBOOT, EndStatus.HARD_REBOOT)
+        policy = HistoryRebootPolicy(hostname="carol", logger_name="REBOOT_POLICY", tiers=tiers, min_attempts=2)
+        for _ in range(2):
+            policy.record_attempt(tier=EndStatus.SOFT_APP_REBOOT, codename="lava", success=False, duration=60)
+            policy.record_attempt(tier=EndStatus.HARD_REBOOT, codename="lava", success=True, duration=30)
+        self.assertEqual(policy.escalation_order(codename="lava"), [EndStatus.HARD_REBOOT])
+        self.assertNotIn("SOFT_OS_REBOOT", policy.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import glob
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+from benchmarks.replay_capture import replay_pipeline, replay_udp
+from benchmarks.run_benchmarks import _SimulatedFleet, _benchmark_logging
+from server.traffic_capture import TrafficCaptureWriter, dut_logs_digest, read_capture
+
+
+class TrafficCaptureTestCase(unittest.TestCase):
+    def test_capture_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            capture_file = os.path.join(tmp_dir, "test.cap")
+            writer = TrafficCaptureWriter(capture_file=capture_file)
+            records = [(1_000_000_000, b"\x0e#HEADER test"), (1_500_000_000, b"\x0e#IT Ite:0"),
+                       (3_000_000_000, b"\x0e#SDC Ite:1")]
+            for timestamp_ns, data in records:
+                writer.write(data=memoryview(data), timestamp_ns=timestamp_ns)
+            writer.close()
+            self.assertEqual(list(read_capture(capture_file=capture_file)), records)
+
+            # A capture interrupted in the middle of a record ends at the last complete one
+            with open(capture_file, "rb+") as fp:
+                fp.truncate(os.path.getsize(capture_file) - 3)
+            self.assertEqual(list(read_capture(capture_file=capture_file)), records[:2])
+
+            with open(capture_file, "wb") as fp:
+                fp.write(b"not a capture")
+            with self.assertRaises(ValueError):
+                list(read_capture(capture_file=capture_file))
+
+    def test_udp_replay_timing(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver:
+            receiver.bind(("127.0.0.1", 0))
+            receiver.settimeout(1)
+            capture_file = os.path.join(tmp_dir, "test.cap")
+            writer = TrafficCaptureWriter(capture_file=capture_file)
+            for i in range(5):
+                writer.write(data=b"\x0e#IT Ite:%d" % i, timestamp_ns=i * 100_000_000)
+            writer.close()
+            # 0.4s of traffic at 2x
+            result = replay_udp(capture_file=capture_file, server_address=receiver.getsockname(), speed=2)
+            received = [receiver.recv(64) for _ in range(5)]
+        self.assertEqual(received, [b"\x0e#IT Ite:%d" % i for i in range(5)])
+        self.assertGreaterEqual(result["duration"], 0.19)
+        self.assertLess(result["duration"], 0.4)
+
+    def test_replay_rotates_the_logs_and_sheds_the_errors(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            capture_file = os.path.join(tmp_dir, "flood.cap")
+            writer = TrafficCaptureWriter(capture_file=capture_file)
+            timestamp_ns = 0
+            for app_start in range(2):
+                writer.write(data=b"\x0e#HEADER flood", timestamp_ns=timestamp_ns)
+                # One second of 100 #ERR per iteration, 10 iterations per second
+                for iteration in range(10):
+                    timestamp_ns += 100_000_000
+                    writer.write(data=b"\x0e#SDC Ite:%d" % iteration, timestamp_ns=timestamp_ns)
+                    for error in range(100):
+                        writer.write(data=b"\x0e#ERR Ite:%d pos:[%d]" % (iteration, error), timestamp_ns=timestamp_ns)
+                    writer.write(data=b"\x0e#IT Ite:%d" % iteration, timestamp_ns=timestamp_ns)
+                timestamp_ns += 5_000_000_000
+            writer.close()
+            result = replay_pipeline(capture_file=capture_file, log_dir=os.path.join(tmp_dir, "replay"),
+                                     max_err_rate=100)
+            logs = list()
+            for log_file in result["log_files"]:
+                with open(log_file) as fp:
+                    logs.append(fp.read())
+
+        # One DUT log per app start, the shed #ERR lines are counted on the #SERVER_SHED lines
+        self.assertEqual(len(logs), 2)
+        self.assertEqual(result["message_types"]["#ERR"], 2000)
+        self.assertGreater(result["shed"]["#ERR"], 1000)
+        for log in logs:
+            self.assertEqual(log.count("#SDC Ite:"), 10)
+            self.assertIn("#SERVER_SHED", log)
+
+    def test_replay_matches_machine_logs(self):
+        with tempfile.TemporaryDirectory() as work_dir, _benchmark_logging(work_dir):
+            capture_dir = os.path.join(work_dir, "captures")
+            fleet = _SimulatedFleet(work_dir=work_dir, boards=1, iterations_per_second=200, sdc_interval=20,
+                                    errors_per_sdc=3, duplicate_interval=7,
+                                    machine_parameters={"capture_dir": capture_dir, "dedup_window": 2.0})
+            fleet.start()
+            # The Machine reads the socket after the app start wait
+            time.sleep(3)
+            fleet.stop()
+            machine_log_files = sorted(glob.glob(os.path.join(fleet.log_dir, "simulated0", "**", "*.log"),
+                                                 recursive=True))
+            machine_digest = dut_logs_digest(log_files=machine_log_files)
+            with open(machine_log_files[0]) as fp:
+                duplicate_lines = [line for line in fp if line.startswith("#SERVER_DUPLICATE #")]
+            del fleet
+            capture_files = glob.glob(os.path.join(capture_dir, "*_simulated0.cap"))
+            replay_dir = os.path.join(work_dir, "replay")
+            result = replay_pipeline(capture_file=capture_files[0], log_dir=replay_dir, dedup_window=2.0)
+
+        self.assertGreater(result["message_types"]["#IT"], 100)
+        self.assertGreater(result["duplicates"], 0)
+        # The dropped messages are kept on the DUT log as server lines
+        self.assertGreater(len(duplicate_lines), 0)
+        self.assertEqual(result["digest"], machine_digest)
+
+
+if __name__ == '__main__':
+    unittest.main()